@@ -3,13 +3,15 @@ Given a protein alignment and unaligned nucleotides, align the nucleotides
 using the protein alignment.
 
 Protein and nucleotide sequence files must contain the same number of
-sequences, in the same order, with the same IDs.
+sequences, in the same order, with the same IDs, unless --match-ids is
+specified.
 """
 
-# TODO: Add tests
-
+import collections
 import itertools
 import logging
+import multiprocessing
+import re
 import sys
 
 from Bio import SeqIO
@@ -17,7 +19,7 @@ from Bio.Data import CodonTable
 from Bio.Seq import Seq
 from Bio.SeqRecord import SeqRecord
 
-from seqmagick import fileformat
+from seqmagick import fileformat, transform
 
 from . import common
 
@@ -38,6 +40,16 @@ def build_parser(parser):
                         table to use. [Default: %(default)s]""")
     parser.add_argument('-a', '--fail-action', choices=('fail', 'warn', 'none'), default='fail',
                         help="""Action to take on an ambiguous codon [default: %(default)s]""")
+    parser.add_argument('--match-ids', action='store_true', default=False,
+                        help="""Pair each protein with the nucleotide sequence
+                        sharing its ID, rather than by position. The
+                        nucleotide file may be in any order: only the offset
+                        of each record in the file is held in memory, not
+                        the sequences.""")
+    parser.add_argument('--threads', default=1,
+                        type=common.positive_value(int),
+                        help="""Number of processes for mapping sequences
+                        [default: %(default)s]""")
 
     return parser
 
@@ -54,17 +66,63 @@ def batch(iterable, chunk_size):
             raise StopIteration()
         yield r
 
+# Number of sequence pairs sent to a worker process at a time with --threads
+DEFAULT_CHUNK_SIZE = 200
+
+# Runs of gap or non-gap characters in a protein alignment
+_RUNS = re.compile(r'-+|[^-]+')
+
+def codon_lookup(translation_table):
+    """
+    Precompute a dict mapping from every codon translatable by
+    ``translation_table`` (including ambiguous codons, for ambiguous tables)
+    to its amino acid.
+    """
+    forward_table = translation_table.forward_table
+    letters = translation_table.nucleotide_alphabet.letters
+    if not letters:
+        return dict(forward_table)
+    result = {}
+    for codon in itertools.product(letters.upper(), repeat=3):
+        codon = ''.join(codon)
+        try:
+            result[codon] = forward_table[codon]
+        except (KeyError, CodonTable.TranslationError):
+            pass
+    return result
+
 class AlignmentMapper(object):
     def __init__(self, translation_table, unknown_action='fail'):
         self.translation_table = translation_table
         self.unknown_action = unknown_action
+        self.codon_lookup = codon_lookup(translation_table)
+        # As above, with gaps aligned to gaps
+        self._aligned_lookup = dict(self.codon_lookup)
+        self._aligned_lookup['---'] = '-'
+
+    def _translates(self, aligned_prot, aligned_nucl):
+        """
+        Whether every codon in aligned_nucl translates exactly to the
+        corresponding residue in aligned_prot, or is a gap aligned to a gap.
+        """
+        codons = [aligned_nucl[i:i+3] for i in xrange(0, len(aligned_nucl), 3)]
+        n = min(len(codons), len(aligned_prot))
+        # Unknown codons map to a character absent from any protein
+        translated = ''.join(itertools.imap(self._aligned_lookup.get,
+            itertools.islice(codons, n), itertools.repeat('\0', n)))
+        return translated == aligned_prot[:n]
 
     def _validate_translation(self, aligned_prot, aligned_nucl):
         """
         Given a seq for protein and nucleotide, ensure that the translation holds
         """
-        codons = [''.join(i) for i in batch(str(aligned_nucl), 3)]
-        for codon, aa in zip(codons, str(aligned_prot)):
+        aligned_prot, aligned_nucl = str(aligned_prot), str(aligned_nucl)
+        if self._translates(aligned_prot, aligned_nucl):
+            return True
+
+        # Check codon by codon, for reporting
+        codons = [''.join(i) for i in batch(aligned_nucl, 3)]
+        for codon, aa in zip(codons, aligned_prot):
             # Check gaps
             if codon == '---' and aa == '-':
                 continue
@@ -94,13 +152,15 @@ class AlignmentMapper(object):
                  prot_seq.id, nucl_seq.id)
 
         # Ungap nucleotides
-        codons = batch(str(nucl_seq.seq.ungap('-')), 3)
-        codons = [''.join(i) for i in codons]
-        codon_iter = iter(codons)
+        nucl = str(nucl_seq.seq.ungap('-'))
+        prot = str(prot_seq.seq)
+        # A trailing partial codon counts as a codon
+        codon_count = (len(nucl) + 2) // 3
 
-        ungapped_prot = str(prot_seq.seq).translate(None, '-')
+        ungapped_prot = prot.translate(None, '-')
 
-        if len(ungapped_prot) != len(codons):
+        if len(ungapped_prot) != codon_count:
+            codons = [''.join(i) for i in batch(nucl, 3)]
             table = self.translation_table.forward_table
             prot_str = ' '.join(' ' + p + ' ' for p in ungapped_prot)
             codon_str = ' '.join(codons)
@@ -113,11 +173,17 @@ Codons:        {4}
 Trans. Codons: {5}""".format(len(codons), len(ungapped_prot), nucl_seq.id, prot_str,
                             codon_str, trans_str))
 
-        try:
-            nucl_align = ['---' if p == '-' else next(codon_iter)
-                          for p in str(prot_seq.seq)]
-        except StopIteration:
-            assert False  # Should be checked above
+        # Copy codons for each run of residues, and gaps for each run of gaps
+        nucl_align = []
+        codon_index = 0
+        for run in _RUNS.finditer(prot):
+            length = run.end() - run.start()
+            if prot[run.start()] == '-':
+                nucl_align.append('---' * length)
+            else:
+                nucl_align.append(
+                    nucl[3 * codon_index:3 * (codon_index + length)])
+                codon_index += length
 
         result = SeqRecord(Seq(''.join(nucl_align)), id=nucl_seq.id,
                            description=nucl_seq.description)
@@ -131,14 +197,96 @@ Trans. Codons: {5}""".format(len(codons), len(ungapped_prot), nucl_seq.id, prot_
         """
         Convert protein sequences to nucleotide alignment
         """
-        zipped = itertools.izip_longest(prot_alignment, nucl_sequences)
-        for p, n in zipped:
-            if p is None:
-                raise ValueError("Exhausted protein sequences")
-            elif n is None:
-                raise ValueError("Exhausted nucleotide sequences")
+        for p, n in pair_records(prot_alignment, nucl_sequences):
+            yield self.map_alignment(p, n)
+
+    def map_all_by_id(self, prot_alignment, nucl_index):
+        """
+        Convert protein sequences to nucleotide alignment, pairing each
+        protein with the record of the same ID in ``nucl_index``, a mapping
+        from ID to record such as that returned by SeqIO.index.
+        """
+        for p, n in pair_records_by_id(prot_alignment, nucl_index):
             yield self.map_alignment(p, n)
 
+    def map_parallel(self, pairs, processes, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Convert (protein, nucleotide) pairs to a nucleotide alignment with
+        ``processes`` worker processes, sending ``chunk_size`` pairs at a time.
+
+        Records are yielded in input order, and the error raised is the same
+        as for a single process: the first, in input order.
+        """
+        pool = multiprocessing.Pool(processes, _init_worker, (self,))
+        # Results in input order, at most 2 per process in flight
+        pending = collections.deque()
+        try:
+            pairs = iter(pairs)
+            chunk = []
+            while True:
+                try:
+                    chunk.append(next(pairs))
+                except StopIteration:
+                    break
+                except Exception:
+                    # Pairing failed: preceding records are mapped first, as
+                    # any error there takes precedence.
+                    exc_info = sys.exc_info()
+                    if chunk:
+                        pending.append(pool.apply_async(_map_chunk, (chunk,)))
+                    for result in pending:
+                        for record in result.get():
+                            yield record
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if len(chunk) == chunk_size:
+                    pending.append(pool.apply_async(_map_chunk, (chunk,)))
+                    chunk = []
+                    if len(pending) > 2 * processes:
+                        for record in pending.popleft().get():
+                            yield record
+            if chunk:
+                pending.append(pool.apply_async(_map_chunk, (chunk,)))
+            while pending:
+                for record in pending.popleft().get():
+                    yield record
+            pool.close()
+        finally:
+            pool.terminate()
+
+def pair_records(prot_alignment, nucl_sequences):
+    """
+    Pair protein and nucleotide records by position
+    """
+    zipped = itertools.izip_longest(prot_alignment, nucl_sequences)
+    for p, n in zipped:
+        if p is None:
+            raise ValueError("Exhausted protein sequences")
+        elif n is None:
+            raise ValueError("Exhausted nucleotide sequences")
+        yield p, n
+
+def pair_records_by_id(prot_alignment, nucl_index):
+    """
+    Pair each protein record with the record of the same ID in nucl_index
+    """
+    for p in prot_alignment:
+        try:
+            n = nucl_index[p.id]
+        except KeyError:
+            raise ValueError("No nucleotide sequence with ID {0}".format(
+                p.id))
+        yield p, n
+
+# Mapper used by worker processes in AlignmentMapper.map_parallel
+_worker_mapper = None
+
+def _init_worker(mapper):
+    global _worker_mapper
+    _worker_mapper = mapper
+
+def _map_chunk(pairs):
+    return [_worker_mapper.map_alignment(p, n) for p, n in pairs]
+
 def action(arguments):
     """
     Run
@@ -149,11 +297,23 @@ def action(arguments):
 
     prot_sequences = SeqIO.parse(arguments.protein_align,
                                  fileformat.from_handle(arguments.protein_align))
-    nucl_sequences = SeqIO.parse(arguments.nucl_align,
-                                 fileformat.from_handle(arguments.nucl_align))
+    nucl_format = fileformat.from_handle(arguments.nucl_align)
 
     instance = AlignmentMapper(TRANSLATION_TABLES[arguments.translation_table],
                                arguments.fail_action)
+    out_format = fileformat.from_filename(arguments.out_file.name)
+
+    def write(pairs):
+        if arguments.threads > 1:
+            mapped = instance.map_parallel(pairs, arguments.threads)
+        else:
+            mapped = (instance.map_alignment(p, n) for p, n in pairs)
+        SeqIO.write(mapped, arguments.out_file, out_format)
 
-    SeqIO.write(instance.map_all(prot_sequences, nucl_sequences),
-                arguments.out_file, fileformat.from_filename(arguments.out_file.name))
+    if arguments.match_ids:
+        with transform.record_index(arguments.nucl_align,
+                                    nucl_format) as nucl_index:
+            write(pair_records_by_id(prot_sequences, nucl_index))
+    else:
+        nucl_sequences = SeqIO.parse(arguments.nucl_align, nucl_format)
+        write(pair_records(prot_sequences, nucl_sequences))
@@ -11,6 +11,8 @@ import signal
 import sys
 import tempfile
 
+from Bio.Data import CodonTable, IUPACData
+
 from seqmagick import fileformat
 
 def get_umask():
@@ -122,6 +124,42 @@ def typed_range(type_func, minimum, maximum):
     return inner
 
 
+def motif_list(string):
+    """
+    A custom argparse 'type' for a comma-separated list of DNA motifs, written
+    with IUPAC codes (e.g. GGNCC,AGATCGGAAGAGC)
+    """
+    motifs = string.split(',')
+    for motif in motifs:
+        invalid = set(motif) - set(IUPACData.ambiguous_dna_values)
+        if not motif or invalid:
+            msg = "{0} is not a valid DNA motif.".format(motif)
+            raise argparse.ArgumentTypeError(msg)
+    return motifs
+
+
+def translation_table(string):
+    """
+    A custom argparse 'type' for NCBI genetic codes, specified by ID or
+    (case-insensitive) name, e.g. 2 or "Vertebrate Mitochondrial".
+
+    Returns the ID of the genetic code.
+    """
+    tables = CodonTable.ambiguous_dna_by_id
+    try:
+        table_id = int(string)
+    except ValueError:
+        names = dict((name.lower(), table.id) for name, table in
+                     CodonTable.ambiguous_dna_by_name.items())
+        table_id = names.get(string.lower())
+    if table_id not in tables:
+        msg = "{0} is not an NCBI genetic code. Choose from: {1}".format(
+            string, ', '.join('{0} ({1})'.format(i, tables[i].names[0])
+                              for i in sorted(tables)))
+        raise argparse.ArgumentTypeError(msg)
+    return table_id
+
+
 def partial_append_action(fn, argument_keys=None):
     """
     Creates a new class extending argparse.Action, which appends a
@@ -4,10 +4,10 @@ Convert between sequence formats
 import argparse
 import functools
 import logging
+import sys
 
 from Bio import Alphabet, SeqIO
 from Bio.Alphabet import IUPAC
-from Bio.SeqIO import FastaIO
 from seqmagick import transform
 from seqmagick.fileformat import from_handle
 
@@ -105,10 +105,18 @@ def add_options(parser):
     seq_mods.add_argument('--translate', dest='transforms',
             action=partial_action(transform.translate, 'translate'),
             choices=['dna2protein', 'rna2protein', 'dna2proteinstop',
-                'rna2proteinstop'], help="""Translate from generic DNA/RNA to
+                'rna2proteinstop', 'dna2sixframe', 'rna2sixframe', 'dna2orf',
+                'rna2orf'], help="""Translate from generic DNA/RNA to
             proteins. Options with "stop" suffix will NOT translate through
-            stop codons .  Source sequences must be the correct alphabet or
+            stop codons. "sixframe" options translate each sequence in all six
+            reading frames, appending the frame (e.g. _frame-2) to the ID;
+            "orf" options keep only the longest stop-free stretch of any
+            frame. Source sequences must be the correct alphabet or
             this action will likely produce incorrect results.""")
+    seq_mods.add_argument('--translation-table', metavar='TABLE',
+            type=common.translation_table, help="""NCBI genetic code to use
+            with --translate, given by ID or name, e.g. 2 or "Vertebrate
+            Mitochondrial". [Default: 1, Standard]""")
     seq_mods.add_argument('--ungap',
             action=partial_action(transform.ungap_sequences),
             dest='transforms', help='Remove gaps in the sequence alignment')
@@ -126,6 +134,26 @@ def add_options(parser):
         metavar='FILE', dest='deduplicate_sequences', default=False,
         type=common.FileType('w'),
         help='Write all of the deduplicated sequences to a file')
+    seq_select.add_argument('--deduplicate-verify', action='store_true',
+        default=False, help="""When deduplicating sequences, compare
+        sequences with matching 128-bit digests, to guard against hash
+        collisions. Uses temporary disk space for each distinct
+        sequence.""")
+    seq_select.add_argument('--deduplicate-mode',
+        choices=transform.DEDUPLICATE_MODES, default='exact', help="""How
+        sequences are deduplicated: 'exact' removes identical sequences;
+        'prefix' and 'substring' dereplicate, also collapsing sequences into
+        any longer sequence of which they are a prefix or substring, and
+        preceding each group in --deduplicated-sequences-file with its size
+        [default: %(default)s]""")
+    seq_select.add_argument('--deduplicate-shards', metavar='N',
+        type=common.positive_value(int), help="""Deduplicate sequences or
+        taxa on disk rather than in memory, partitioned into N shards, each
+        of which must fit in memory""")
+    seq_select.add_argument('--deduplicate-processes', metavar='N',
+        type=common.positive_value(int), default=1, help="""Number of
+        processes to deduplicate shards with, for --deduplicate-shards
+        [default: %(default)s]""")
     seq_select.add_argument('--deduplicate-taxa',
             action=partial_action(transform.deduplicate_taxa),
             dest='transforms', help="""Remove any duplicate sequences by ID,
@@ -138,6 +166,23 @@ def add_options(parser):
             type=common.FileType('r'), help="""Filter sequences, keeping only
             those sequence IDs in the specified file""", dest='transforms',
             action=partial_action(transform.include_from_file, 'handle'))
+    seq_select.add_argument('--compact-id-sets', action='store_true',
+            default=False, help="""Load the files given to
+            --include-from-file and --exclude-from-file as compact sets of
+            64-bit ID fingerprints, using ~6 bytes per ID. Files saved by
+            "seqmagick extract-ids --id-set" are always loaded this way.""")
+    seq_select.add_argument('--exclude-prefixes-from-file', metavar='FILE',
+            type=common.FileType('r'), help="""Filter sequences, removing
+            those with IDs starting with any of the prefixes in the specified
+            file""", dest='transforms',
+            action=partial_action(transform.exclude_prefixes_from_file,
+                'handle'))
+    seq_select.add_argument('--include-prefixes-from-file', metavar='FILE',
+            type=common.FileType('r'), help="""Filter sequences, keeping only
+            those with IDs starting with one of the prefixes in the specified
+            file""", dest='transforms',
+            action=partial_action(transform.include_prefixes_from_file,
+                'handle'))
     seq_select.add_argument('--head', metavar='N', dest='transforms',
             action=partial_action(transform.head, 'head'), help="""Trim
             down to top N sequences. With the leading `-', print all but the last N sequences.""")
@@ -164,12 +209,35 @@ def add_options(parser):
             action=partial_action(transform.name_exclude, 'filter_regex'),
             dest='transforms', help="""Filter the sequences by regular
             expression in ID or description""")
+    seq_select.add_argument('--pattern-exclude-from-file', metavar='FILE',
+            type=common.FileType('r'), dest='transforms',
+            action=partial_action(transform.exclude_patterns_from_file,
+                'handle'), help="""Filter the sequences, removing those with
+            an ID or description matching any of the regular expressions in
+            the specified file, one per line""")
+    seq_select.add_argument('--pattern-include-from-file', metavar='FILE',
+            type=common.FileType('r'), dest='transforms',
+            action=partial_action(transform.include_patterns_from_file,
+                'handle'), help="""Filter the sequences, keeping only those
+            with an ID or description matching one of the regular expressions
+            in the specified file, one per line""")
     seq_select.add_argument('--prune-empty',
             action=partial_action(transform.prune_empty), dest='transforms',
             help="Prune sequences containing only gaps ('-')")
     seq_select.add_argument('--sample', metavar='N', dest='transforms', type=int,
             action=partial_action(transform.sample, 'k'),
             help = """ Select a random sampling of sequences """)
+    seq_select.add_argument('--sample-fraction', metavar='P',
+            dest='transforms', type=common.positive_value(float),
+            action=partial_action(transform.sample_fraction, 'fraction'),
+            help="""Select each sequence independently with probability P,
+            in input order""")
+    seq_select.add_argument('--sample-seed', metavar='SEED', type=int,
+            help="""Seed for the random number generator used by --sample and
+            --sample-fraction, for reproducible samples""")
+    seq_select.add_argument('--sample-keep-order', action='store_true',
+            default=False, help="""Output the records selected by --sample
+            in input order""")
     seq_select.add_argument('--seq-pattern-include', metavar='REGEX',
             action=partial_action(transform.seq_include, 'filter_regex'),
             dest='transforms', help="""Filter the sequences by regular
@@ -178,6 +246,20 @@ def add_options(parser):
             action=partial_action(transform.seq_exclude, 'filter_regex'),
             dest='transforms', help="""Filter the sequences by regular
             expression in sequence""")
+    seq_select.add_argument('--seq-motif-include', metavar='MOTIF[,MOTIF2]',
+            action=partial_action(transform.seq_motif_include, 'motifs'),
+            type=common.motif_list, dest='transforms', help="""Filter the
+            sequences, keeping only those containing any of the
+            comma-separated DNA motifs, which may include IUPAC ambiguity
+            codes (e.g. R for A or G). Matching is case-sensitive.""")
+    seq_select.add_argument('--seq-motif-exclude', metavar='MOTIF[,MOTIF2]',
+            action=partial_action(transform.seq_motif_exclude, 'motifs'),
+            type=common.motif_list, dest='transforms', help="""Filter the
+            sequences, removing those containing any of the comma-separated
+            DNA motifs, as in --seq-motif-include""")
+    seq_select.add_argument('--motif-reverse-complement', action='store_true',
+            default=False, help="""Also match --seq-motif-include and
+            --seq-motif-exclude motifs on the reverse strand""")
     seq_select.add_argument('--tail', metavar='N', dest='transforms',
             action=partial_action(transform.tail, 'tail'),
         help="""Trim down to bottom N sequences.  Use +N to output sequences starting with the Nth.""")
@@ -212,6 +294,14 @@ def add_options(parser):
 
     parser.add_argument('--alphabet', choices=ALPHABETS,
             help="""Input alphabet. Required for writing NEXUS.""")
+    parser.add_argument('--explain-plan', action='store_true', default=False,
+            help="""Print the passes over the records used to apply the
+            transforms to stderr, showing which are fused into a single
+            record pass and the order their steps run in.""")
+    parser.add_argument('--no-lazy', dest='lazy', action='store_false',
+            default=True, help="""Decode every FASTA sequence as it is read,
+            rather than only when used. Sequences are otherwise decoded
+            lazily if the installed Biopython supports it.""")
 
     return parser
 
@@ -234,10 +324,85 @@ def transform_file(source_file, destination_file, arguments):
     destination_file_type = (arguments.output_format or
             from_handle(destination_file))
 
+    # Plan the transform functions in transforms, a copy of
+    # arguments.transforms: mogrify calls transform_file once per input file,
+    # and the --relative-to reference differs between files
+    transforms = list(arguments.transforms or [])
+    if transforms:
+
+        # Special case handling for --cut and --relative-to
+        if arguments.cut_relative:
+            reference = None
+            for o, n in ((transform.multi_cut_sequences,
+                          transform.cut_sequences_relative),
+                         (transform.multi_mask_sequences,
+                          transform.mask_sequences_relative)):
+                # Add a function to trim any columns which are gaps in the
+                # sequence ID
+                try:
+                    f = next(f for f in transforms if f.func == o)
+                except StopIteration:
+                    continue
+                i = transforms.index(f)
+                transforms.pop(i)
+
+                # If no earlier transform can alter the reference record,
+                # find it in the input up front rather than buffering every
+                # record.
+                keywords = dict(f.keywords, record_id=arguments.cut_relative)
+                if all(g.func in _REFERENCE_PRESERVING
+                       for g in transforms[:i]):
+                    if reference is None:
+                        reference = transform.find_record(
+                            source_file, source_file_type,
+                            arguments.cut_relative)
+                    keywords['reference'] = reference
+                transforms.insert(i, functools.partial(n, **keywords))
+
+        # Special case handling for --translation-table
+        if arguments.translation_table:
+            _bind_keywords(transforms, transform.translate,
+                           table=arguments.translation_table)
+
+        # Special case handling for --motif-reverse-complement
+        if arguments.motif_reverse_complement:
+            for f in (transform.seq_motif_include,
+                      transform.seq_motif_exclude):
+                _bind_keywords(transforms, f, reverse_complement=True)
+
+        # Special case handling for --compact-id-sets
+        if arguments.compact_id_sets:
+            for f in (transform.include_from_file,
+                      transform.exclude_from_file):
+                _bind_keywords(transforms, f, compact=True)
+
+        # Special case handling for --deduplicate-shards
+        if arguments.deduplicate_shards:
+            _bind_keywords(transforms, transform.deduplicate_taxa,
+                           shards=arguments.deduplicate_shards,
+                           processes=arguments.deduplicate_processes)
+
+        # Special case handling for --sample-seed, --sample-keep-order
+        if arguments.sample_seed is not None:
+            for f in (transform.sample, transform.sample_fraction):
+                _bind_keywords(transforms, f, seed=arguments.sample_seed)
+        if arguments.sample_keep_order:
+            _bind_keywords(transforms, transform.sample, keep_order=True)
+
+        # Filter adjacent ID selections, select adjacent --cut, --drop and
+        # --squeeze columns, and map adjacent case, gap and complement
+        # transforms, in a single pass; then apply each run of remaining
+        # record-at-a-time maps and filters in a single pass
+        transforms = transform.fuse_id_selections(transforms)
+        transforms = transform.fuse_column_selections(transforms)
+        transforms = transform.fuse_sequence_maps(transforms)
+        transforms = transform.fuse_record_steps(transforms)
+
     # Get an iterator.
     sorters = {'length': transform.sort_length,
                'name': transform.sort_name,}
     directions = {'asc': 1, 'desc': 0}
+    reader_filters = []
     if arguments.sort:
         # Sorted iterator
         key, direction = arguments.sort.split('-')
@@ -245,44 +410,33 @@ def transform_file(source_file, destination_file, arguments):
                 source_file_type=source_file_type,
                 direction=directions[direction])
     else:
-        # Unsorted iterator.
-        records = SeqIO.parse(source_file, source_file_type,
-                alphabet=ALPHABETS.get(arguments.alphabet))
+        # Unsorted iterator. Leading filters on IDs and lengths are applied
+        # while reading, before each record is built; FASTA sequences are
+        # only decoded if needed, unless --no-lazy.
+        reader_filters, transforms = transform.pushdown_filters(transforms)
+        records = transform.parse_filtered(source_file, source_file_type,
+                alphabet=ALPHABETS.get(arguments.alphabet),
+                filters=reader_filters, lazy=arguments.lazy)
 
+    if arguments.explain_plan:
+        sys.stderr.write(transform.explain_plan(transforms, reader_filters))
 
     #########################################
     # Apply generator functions to iterator.#
     #########################################
 
     # Apply all the transform functions in transforms
-    if arguments.transforms:
-
-        # Special case handling for --cut and --relative-to
-        if arguments.cut_relative:
-            for o, n in ((transform.multi_cut_sequences,
-                          transform.cut_sequences_relative),
-                         (transform.multi_mask_sequences,
-                          transform.mask_sequences_relative)):
-                # Add a function to trim any columns which are gaps in the
-                # sequence ID
-                try:
-                    f = next(f for f in arguments.transforms
-                             if f.func == o)
-                except StopIteration:
-                    continue
-                i = arguments.transforms.index(f)
-                arguments.transforms.pop(i)
-                arguments.transforms.insert(i,
-                        functools.partial(n,
-                            record_id=arguments.cut_relative, **f.keywords))
-
-        for function in arguments.transforms:
-            records = function(records)
+    for function in transforms:
+        records = function(records)
 
     if (arguments.deduplicate_sequences or
             arguments.deduplicate_sequences is None):
         records = transform.deduplicate_sequences(
-            records, arguments.deduplicate_sequences)
+            records, arguments.deduplicate_sequences,
+            verify=arguments.deduplicate_verify,
+            shards=arguments.deduplicate_shards,
+            processes=arguments.deduplicate_processes,
+            mode=arguments.deduplicate_mode)
 
     # Apply all the partial functions
     if arguments.apply_function:
@@ -296,7 +450,7 @@ def transform_file(source_file, destination_file, arguments):
                 arguments.line_wrap)
 
         with destination_file:
-            writer = FastaIO.FastaWriter(
+            writer = transform.VerbatimFastaWriter(
                 destination_file, wrap=arguments.line_wrap)
             writer.write_file(records)
     else:
@@ -308,7 +462,27 @@ def transform_file(source_file, destination_file, arguments):
         # loading the entire sequence file up into memory.
         logging.info("Applying transformations, writing to %s",
                 destination_file)
-        SeqIO.write(records, destination_file, destination_file_type)
+        if destination_file_type == 'fasta':
+            # Sequences which were never decoded are copied as read, where
+            # possible
+            transform.VerbatimFastaWriter(destination_file).write_file(records)
+        else:
+            SeqIO.write(records, destination_file, destination_file_type)
+
+
+# Transforms which leave the ID and gap positions of each record unchanged
+_REFERENCE_PRESERVING = (transform.lower_sequences, transform.upper_sequences)
+
+
+def _bind_keywords(transforms, func, **kwargs):
+    """
+    Add kwargs to the keyword arguments of each partial application of func in
+    transforms, in place.
+    """
+    for i, f in enumerate(transforms):
+        if f.func == func:
+            keywords = dict(f.keywords, **kwargs)
+            transforms[i] = functools.partial(func, *f.args, **keywords)
 
 
 def module_function(string):
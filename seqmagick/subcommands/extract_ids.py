@@ -1,11 +1,10 @@
 """
 Extract the sequence IDs from a file
 """
+import itertools
 import sys
 
-from Bio import SeqIO
-
-from seqmagick import fileformat
+from seqmagick import fileformat, transform
 
 from . import common
 
@@ -19,6 +18,13 @@ def build_parser(parser):
     parser.add_argument('-d', '--include-description', action='store_true',
             default=False, help="""Include the sequence description in output
             [default: %(default)s]""")
+    parser.add_argument('--id-set', action='store_true', default=False,
+            help="""Write a compact, binary set of the IDs, for use with
+            convert --include-from-file and --exclude-from-file""")
+    parser.add_argument('--threads', default=1,
+            type=common.positive_value(int), help="""Number of processes
+            for scanning uncompressed FASTA and FASTQ files
+            [default: %(default)s]""")
 
 def action(arguments):
     common.exit_on_sigpipe()
@@ -28,11 +34,17 @@ def action(arguments):
             fileformat.from_handle(arguments.sequence_file))
 
     with arguments.sequence_file:
-        sequences = SeqIO.parse(arguments.sequence_file, source_format)
-        if arguments.include_description:
-            ids = (sequence.description for sequence in sequences)
-        else:
-            ids = (sequence.id for sequence in sequences)
+        # Only header lines are read from FASTA and FASTQ files
+        chunks = transform.scan_headers(
+            arguments.sequence_file, source_format,
+            descriptions=arguments.include_description,
+            processes=arguments.threads)
         with arguments.output_file:
-            for i in ids:
-                print >> arguments.output_file, i
+            if arguments.id_set:
+                ids = itertools.chain.from_iterable(
+                    chunk.split('\n')[:-1] for chunk in chunks)
+                transform.CompactIdSet.from_ids(ids).save(
+                    arguments.output_file)
+            else:
+                for chunk in chunks:
+                    arguments.output_file.write(chunk)
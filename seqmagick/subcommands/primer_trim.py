@@ -60,13 +60,7 @@ def ungap_index_map(sequence, gap_chars='-'):
     >>> ungap_index_map('AC-TG-')
     {0: 0, 1: 1, 2: 3, 3: 4}
     """
-    counter = itertools.count(0).next
-    ungap_indexes = [counter() if c not in gap_chars else None
-                     for c in iter(sequence)]
-    return  dict((ungapped, gapped)
-                 for ungapped, gapped in zip(ungap_indexes,
-                                             xrange(len(sequence)))
-                 if ungapped is not None)
+    return dict(enumerate(transform.CoordinateMap(sequence, gap_chars).gapped))
 
 
 def gap_index_map(sequence, gap_chars='-'):
@@ -149,12 +143,12 @@ class PrimerAligner(object):
                         self.gap_extend, one_alignment_only=True)[0]
 
         # Get an ungapped mapping on the sequence
-        index_map = gap_index_map(seq_aln)
-        ungap_map = ungap_index_map(primer_aln)
+        seq_map = transform.CoordinateMap(seq_aln, '-')
+        primer_map = transform.CoordinateMap(primer_aln, '-')
 
         # Trim to primer
-        start = ungap_map[0]
-        end = ungap_map[len(self.primer) - 1]
+        start = primer_map.to_gapped(0)
+        end = primer_map.to_gapped(len(self.primer) - 1)
 
         trimmed = seq_aln[start:end+1]
 
@@ -166,15 +160,15 @@ class PrimerAligner(object):
         # and return maxint for the hamming distance
         if trimmed.endswith('-'):
             tail = len(trimmed) - len(trimmed.rstrip('-'))
-            end = index_map[end-tail] + 1
+            end = seq_map.to_ungapped(end-tail) + 1
             ham_dist = sys.maxint
         else:
-            end = index_map[end]
+            end = seq_map.to_ungapped(end)
         if trimmed.startswith('-'):
             start = 0
             ham_dist = sys.maxint
         else:
-            start = index_map[start]
+            start = seq_map.to_ungapped(start)
 
         return ham_dist, start, end
 
@@ -214,19 +208,21 @@ def locate_primers(sequences, forward_primer, reverse_primer,
         elif len(sequence) != seq_length:
             raise ValueError(("Sequence Length Heterogeneity: {0} != {1}. "
                     "Is this an alignment?").format(len(sequence), seq_length))
-        index_map = ungap_index_map(sequence.seq)
+        coordinates = transform.CoordinateMap(sequence.seq, '-')
         if forward_loc is None:
             ham_dist, start, end = \
                     forward_aligner.align(sequence.seq.ungap())
             if ham_dist <= max_hamming_distance:
-                forward_loc = index_map[start], index_map[end]
+                forward_loc = (coordinates.to_gapped(start),
+                               coordinates.to_gapped(end))
                 logging.info("Forward in sequence %d: indexes %d to %d", i + 1,
                              *forward_loc)
         if reverse_loc is None:
             ham_dist, start, end = \
                     reverse_aligner.align(sequence.seq.ungap())
             if ham_dist <= max_hamming_distance:
-                reverse_loc = index_map[start], index_map[end]
+                reverse_loc = (coordinates.to_gapped(start),
+                               coordinates.to_gapped(end))
                 logging.info("Reverse in sequence %d: indexes %d to %d", i + 1,
                              *reverse_loc)
         if forward_loc and reverse_loc:
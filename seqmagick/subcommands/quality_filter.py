@@ -3,6 +3,7 @@ Filter reads based on quality scores
 """
 
 import collections
+import cPickle as pickle
 import csv
 import itertools
 import logging
@@ -19,11 +20,22 @@ except ImportError:
 from Bio.SeqIO import QualityIO
 
 from seqmagick import fileformat, __version__
-from .common import typed_range, FileType
+from .common import typed_range, positive_value, FileType
 
 # Default minimummean quality score
 DEFAULT_MEAN_SCORE = 25.0
 
+# Demultiplexing: maximum number of per-sample files open at once, and number
+# of records buffered for each sample between writes
+DEFAULT_MAX_OPEN = 64
+DEFAULT_DEMULTIPLEX_BUFFER = 100
+
+# Number of rows collected between writes to --details-out
+DEFAULT_DETAILS_BATCH = 1000
+
+# Number of records passed to batch event handlers at a time
+DEFAULT_EVENT_BATCH = 1000
+
 # Tools for working with ambiguous bases
 # Map from Ambiguous Base to regex
 _AMBIGUOUS_MAP = {
@@ -69,6 +81,10 @@ def build_parser(parser):
             stdout]""")
     output_group.add_argument('--details-out', type=FileType('w'),
              help="""Output file to report fate of each sequence""")
+    output_group.add_argument('--details-format', choices=('csv', 'pickle'),
+            default='csv', help="""Format for --details-out: CSV, or a
+            binary, column-oriented series of pickles (faster to write and
+            load) [default: %(default)s]""")
     output_group.add_argument('--no-details-comment', action='store_false',
             default=True, dest='details_comment', help="""Do not write comment
             lines with version and call to start --details-out""")
@@ -129,6 +145,14 @@ def build_parser(parser):
             attribute of the csv module defining the quoting behavior for
             `SAMPLE_MAP`.  [default: %(default)s]""", default='QUOTE_MINIMAL',
             choices=[s for s in dir(csv) if s.startswith('QUOTE_')])
+    barcode_group.add_argument('--demultiplex-dir', metavar='DIRECTORY',
+            help="""Also write each read passing all filters to a file for its
+            sample in DIRECTORY, named <sample_id>.<format>. Requires
+            --barcode-file.""")
+    barcode_group.add_argument('--demultiplex-max-open', metavar='N',
+            type=positive_value(int), default=DEFAULT_MAX_OPEN,
+            help="""Maximum number of per-sample files to hold open at once
+            with --demultiplex-dir [default: %(default)s]""")
 
 def mean(sequence):
     """
@@ -164,10 +188,17 @@ class RecordEventListener(object):
     Contains and dispatches to handlers on events around sequence records
 
     Event handlers take a single positional argument, the record, and optional
-    additional keyword arguments.
+    additional keyword arguments. Batch handlers, registered with
+    ``register_batch_handler``, take a list of records, and are only called for
+    events fired through ``iterable_hook``.
+
+    ``dispatcher`` and ``iterable_hook`` look up the handlers for an event when
+    called, so all handlers should be registered before the pipeline is built.
+    Events without handlers then cost nothing.
     """
     def __init__(self):
         self.listeners = collections.defaultdict(set)
+        self.batch_listeners = collections.defaultdict(set)
 
     def __call__(self, event, record, **kwargs):
         """
@@ -187,38 +218,122 @@ class RecordEventListener(object):
         """
         self.listeners[event].add(handler)
 
-    def iterable_hook(self, name, iterable):
+    def register_batch_handler(self, event, handler):
+        """
+        Register ``handler`` to receive lists of records for ``event``
+        """
+        self.batch_listeners[event].add(handler)
+
+    def dispatcher(self, event):
+        """
+        Returns a function triggering ``event`` with the handlers currently
+        registered, or None if there are no handlers for ``event``.
         """
-        Fire an event named ``name`` with each item in iterable
+        handlers = tuple(self.listeners.get(event, ()))
+        if not handlers:
+            return None
+        elif len(handlers) == 1:
+            return handlers[0]
+
+        def dispatch(record, **kwargs):
+            for handler in handlers:
+                handler(record, **kwargs)
+        return dispatch
+
+    def iterable_hook(self, name, iterable, batch_size=DEFAULT_EVENT_BATCH):
+        """
+        Fire an event named ``name`` with each item in iterable.
+
+        Batch handlers receive the items ``batch_size`` at a time. If there are
+        no handlers for ``name``, ``iterable`` is returned unchanged.
         """
+        dispatch = self.dispatcher(name)
+        batch_handlers = tuple(self.batch_listeners.get(name, ()))
+        if batch_handlers:
+            return self._batch_hook(iterable, dispatch, batch_handlers,
+                    batch_size)
+        elif dispatch is not None:
+            return self._hook(iterable, dispatch)
+        return iterable
+
+    @staticmethod
+    def _hook(iterable, dispatch):
         for record in iterable:
-            self(name, record)
+            dispatch(record)
             yield record
 
+    @staticmethod
+    def _batch_hook(iterable, dispatch, batch_handlers, batch_size):
+        batch = []
+        for record in iterable:
+            if dispatch is not None:
+                dispatch(record)
+            batch.append(record)
+            if len(batch) >= batch_size:
+                for handler in batch_handlers:
+                    handler(batch)
+                batch = []
+            yield record
+        if batch:
+            for handler in batch_handlers:
+                handler(batch)
+
 class RecordReportHandler(object):
     """
     Generates a report to a CSV file detailing every record processed.
 
     Listens for events: [read, write, failed_filter, found_barcode]
+
+    Rows are collected and written ``batch_size`` at a time; call ``close``
+    once all records are processed to write the final batch.
     """
     HEADERS = ('sequence_name', 'in_length', 'in_mean_qual', 'sample',
                'out_length', 'out_mean_qual', 'fail_filter', 'fail_value')
-    def __init__(self, fp, args, write_comments=True):
+    # Indexes of values in a row
+    (_NAME, _IN_LENGTH, _IN_MEAN_QUAL, _SAMPLE, _OUT_LENGTH, _OUT_MEAN_QUAL,
+     _FAIL_FILTER, _FAIL_VALUE) = range(len(HEADERS))
+
+    # Value for fields which do not apply to a record
+    MISSING = ''
+
+    # Number of records between checks of the progress clock
+    REPORT_INTERVAL = 1000
+
+    def __init__(self, fp, args, write_comments=True,
+            batch_size=DEFAULT_DETAILS_BATCH):
+        self.fp = fp
+        comments = []
         if write_comments:
-            fp.write('# Generated by `seqmagick quality-filter` version {0}\n'.format(__version__))
-            fp.write('# Arguments: {0}\n'.format(' '.join(args)))
-            fp.write('# Working directory: {0}\n'.format(os.getcwd()))
+            comments = ['Generated by `seqmagick quality-filter` version {0}'.format(__version__),
+                        'Arguments: {0}'.format(' '.join(args)),
+                        'Working directory: {0}'.format(os.getcwd())]
+        self._start(comments)
 
-        self.writer = csv.DictWriter(fp, self.HEADERS, lineterminator='\n',
-                quoting=csv.QUOTE_NONNUMERIC)
-        self.writer.writeheader()
+        self.batch = []
+        self.batch_size = batch_size
         self.current_record = None
+        # Quality scores of the current record, as read
+        self.current_quality = None
 
         self.read = 0
         self.failed = 0
+        self.interactive = sys.stdout.isatty()
         self.start = time.time()
         self.last_report = 0.0
 
+    def _start(self, comments):
+        """
+        Write comments and headers
+        """
+        for comment in comments:
+            self.fp.write('# {0}\n'.format(comment))
+        self.writer = csv.writer(self.fp, lineterminator='\n',
+                quoting=csv.QUOTE_NONNUMERIC)
+        self.writer.writerow(self.HEADERS)
+
+    def _write_batch(self, rows):
+        self.writer.writerows(rows)
+
     def register_with(self, listener):
         listener.register_handler('failed_filter', self._record_failed)
         listener.register_handler('read', self._read_record)
@@ -227,43 +342,65 @@ class RecordReportHandler(object):
 
     def _write(self):
         assert self.current_record
-        self.writer.writerow(self.current_record)
+        self.batch.append(self.current_record)
         self.current_record = None
+        self.current_quality = None
+        if len(self.batch) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write any collected rows
+        """
+        if self.batch:
+            self._write_batch(self.batch)
+            self.batch = []
+
+    def close(self):
+        self.flush()
 
     def _record_failed(self, record, filter_name, value=None):
-        self.current_record.update({'fail_filter': filter_name,
-                                    'fail_value': value})
+        row = self.current_record
+        row[self._FAIL_FILTER] = filter_name
+        row[self._FAIL_VALUE] = self.MISSING if value is None else value
 
         self._write()
         self.failed += 1
         self._report()
 
     def _read_record(self, record):
-        self.current_record = {'sequence_name': record.id,
-                               'in_length': len(record)}
-        if 'phred_quality' in record.letter_annotations:
-            self.current_record['in_mean_qual'] = \
-                    mean(record.letter_annotations['phred_quality'])
+        m = self.MISSING
+        row = [record.id, len(record), m, m, m, m, m, m]
+        quality = record.letter_annotations.get('phred_quality')
+        if quality is not None:
+            row[self._IN_MEAN_QUAL] = mean(quality)
+        self.current_record = row
+        self.current_quality = quality
         self.read += 1
 
     def _found_barcode(self, record, sample, barcode=None):
         """Hook called when barcode is found"""
-        assert record.id == self.current_record['sequence_name']
-        self.current_record['sample'] = sample
+        assert record.id == self.current_record[self._NAME]
+        self.current_record[self._SAMPLE] = sample
 
     def _wrote_record(self, record):
-        self.current_record['out_length'] = len(record)
-        if 'phred_quality' in record.letter_annotations:
-            self.current_record['out_mean_qual'] = \
-                    mean(record.letter_annotations['phred_quality'])
+        row = self.current_record
+        row[self._OUT_LENGTH] = len(record)
+        quality = record.letter_annotations.get('phred_quality')
+        if quality is not None:
+            if quality is self.current_quality:
+                # Not modified by any filter
+                row[self._OUT_MEAN_QUAL] = row[self._IN_MEAN_QUAL]
+            else:
+                row[self._OUT_MEAN_QUAL] = mean(quality)
         self._write()
         self._report()
 
     def _report(self):
-        if not sys.stdout.isatty():
+        if not self.interactive or self.read % self.REPORT_INTERVAL:
             return
         t = time.time()
-        if t - self.last_report < 0.4 or not self.read:
+        if t - self.last_report < 0.4:
             return
 
         self.last_report = t
@@ -274,6 +411,134 @@ class RecordReportHandler(object):
             float(self.read - self.failed) / self.read * 100.0))
 
 
+class ColumnarRecordReportHandler(RecordReportHandler):
+    """
+    Generates a binary, column-oriented report detailing every record
+    processed.
+
+    The report is a series of pickles: first a dict with keys ``headers`` and
+    ``comments``, then one dict per batch, mapping each header to a list of
+    values. Use ``read_columnar_details`` to load it.
+    """
+    MISSING = None
+
+    def _start(self, comments):
+        self.pickler = pickle.Pickler(self.fp, pickle.HIGHEST_PROTOCOL)
+        self.pickler.dump({'headers': self.HEADERS, 'comments': comments})
+
+    def _write_batch(self, rows):
+        columns = itertools.izip(*rows)
+        self.pickler.dump(dict(zip(self.HEADERS, (list(c) for c in columns))))
+        self.pickler.clear_memo()
+
+
+def read_columnar_details(fp):
+    """
+    Load a report written by ColumnarRecordReportHandler.
+
+    Returns a dict mapping from each header to a list of values, one per
+    record.
+    """
+    unpickler = pickle.Unpickler(fp)
+    headers = unpickler.load()['headers']
+    result = dict((h, []) for h in headers)
+    while True:
+        try:
+            batch = unpickler.load()
+        except EOFError:
+            break
+        for h, values in batch.iteritems():
+            result[h].extend(values)
+    return result
+
+_DETAILS_HANDLERS = {'csv': RecordReportHandler,
+                     'pickle': ColumnarRecordReportHandler}
+
+
+class DemultiplexWriter(object):
+    """
+    Writes each record passing all filters to a file for its sample.
+
+    Listens for events: [read, found_barcode, write]
+
+    Records are buffered per sample and written ``buffer_size`` at a time. At
+    most ``max_open`` handles are held open: when another is needed, the least
+    recently used one is closed, to be re-opened for appending if that sample
+    is seen again.
+    """
+    def __init__(self, directory, file_format, max_open=DEFAULT_MAX_OPEN,
+            buffer_size=DEFAULT_DEMULTIPLEX_BUFFER):
+        if max_open < 1:
+            raise ValueError("max_open must be at least 1")
+        self.directory = directory
+        self.file_format = file_format
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+
+        self.buffers = collections.defaultdict(list)
+        # sample -> handle, least recently used first
+        self.handles = collections.OrderedDict()
+        # Samples for which a file has been created
+        self.created = set()
+        self.current_sample = None
+
+    def register_with(self, listener):
+        listener.register_handler('read', self._read_record)
+        listener.register_handler('found_barcode', self._found_barcode)
+        listener.register_handler('write', self._wrote_record)
+
+    def path(self, sample):
+        """
+        Path to the output file for ``sample``
+        """
+        name = '{0}.{1}'.format(sample.replace(os.sep, '_'), self.file_format)
+        return os.path.join(self.directory, name)
+
+    def _handle(self, sample):
+        try:
+            # Re-inserted below as most recently used
+            handle = self.handles.pop(sample)
+        except KeyError:
+            if len(self.handles) >= self.max_open:
+                _, lru = self.handles.popitem(last=False)
+                lru.close()
+            mode = 'a' if sample in self.created else 'w'
+            handle = open(self.path(sample), mode)
+            self.created.add(sample)
+        self.handles[sample] = handle
+        return handle
+
+    def _flush(self, sample):
+        records = self.buffers.pop(sample, None)
+        if records:
+            SeqIO.write(records, self._handle(sample), self.file_format)
+
+    def _read_record(self, record):
+        self.current_sample = None
+
+    def _found_barcode(self, record, sample, barcode=None):
+        self.current_sample = sample
+
+    def _wrote_record(self, record):
+        sample = self.current_sample
+        if sample is None:
+            return
+        buf = self.buffers[sample]
+        buf.append(record)
+        if len(buf) >= self.buffer_size:
+            self._flush(sample)
+
+    def close(self):
+        """
+        Write any buffered records, then close all handles
+        """
+        for sample in list(self.buffers):
+            self._flush(sample)
+        while self.handles:
+            _, handle = self.handles.popitem()
+            handle.close()
+
+
 class BaseFilter(object):
     """
     Base class for filters
@@ -294,10 +559,19 @@ class BaseFilter(object):
         """
         raise NotImplementedError("Override in subclass")
 
+    def _bind_events(self):
+        """
+        Look up the dispatchers for events fired while filtering
+        """
+        listener = self.listener
+        self._failed = listener.dispatcher('failed_filter') if listener else None
+
     def filter_records(self, records):
         """
         Apply the filter to records
         """
+        self._bind_events()
+        failed = self._failed
         for record in records:
             try:
                 filtered = self.filter_record(record)
@@ -311,8 +585,8 @@ class BaseFilter(object):
             except FailedFilter as e:
                 self.failed += 1
                 v = e.value
-                if self.listener:
-                    self.listener('failed_filter', record, filter_name=self.name, value=v)
+                if failed is not None:
+                    failed(record, filter_name=self.name, value=v)
 
     @property
     def passed(self):
@@ -530,12 +804,19 @@ class PrimerBarcodeFilter(BaseFilter):
         super(PrimerBarcodeFilter, self).__init__()
         self.trim = True
         self.trie = trie
+        self._found_barcode = None
+
+    def _bind_events(self):
+        super(PrimerBarcodeFilter, self)._bind_events()
+        listener = self.listener
+        self._found_barcode = (listener.dispatcher('found_barcode')
+                               if listener else None)
 
     def filter_record(self, record):
         m = triefind.match(str(record.seq), self.trie)
         if m:
-            if self.listener:
-                self.listener('found_barcode', record, barcode=m, sample=self.trie[m])
+            if self._found_barcode is not None:
+                self._found_barcode(record, barcode=m, sample=self.trie[m])
             if self.trim:
                 record = record[len(m):]
             return record
@@ -583,6 +864,9 @@ def action(arguments):
         raise ValueError("--quality-window-mean-qual specified without "
                 "--quality-window")
 
+    if arguments.demultiplex_dir and not arguments.barcode_file:
+        raise ValueError("--demultiplex-dir specified without --barcode-file")
+
     if trie is None or triefind is None:
         raise ValueError('Missing Bio.trie and/or Bio.triefind modules. Cannot continue')
 
@@ -597,14 +881,13 @@ def action(arguments):
             sequences = SeqIO.parse(fp, input_type)
 
         listener = RecordEventListener()
+        rh = None
         if arguments.details_out:
-            rh = RecordReportHandler(arguments.details_out, arguments.argv,
+            handler_cls = _DETAILS_HANDLERS[arguments.details_format]
+            rh = handler_cls(arguments.details_out, arguments.argv,
                     arguments.details_comment)
             rh.register_with(listener)
 
-        # Track read sequences
-        sequences = listener.iterable_hook('read', sequences)
-
         # Add filters
         if arguments.min_mean_quality and input_type == 'fastq':
             qfilter = QualityScoreFilter(arguments.min_mean_quality)
@@ -646,6 +929,18 @@ def action(arguments):
                 def barcode_handler(record, sample, barcode=None):
                     barcode_writer.writerow((record.id, sample))
                 listener.register_handler('found_barcode', barcode_handler)
+
+        demultiplexer = None
+        if arguments.demultiplex_dir:
+            if not os.path.isdir(arguments.demultiplex_dir):
+                os.makedirs(arguments.demultiplex_dir)
+            demultiplexer = DemultiplexWriter(arguments.demultiplex_dir,
+                    output_type, arguments.demultiplex_max_open)
+            demultiplexer.register_with(listener)
+
+        # All handlers are registered: track read sequences
+        sequences = listener.iterable_hook('read', sequences)
+
         for f in filters:
             f.listener = listener
             sequences = f.filter_records(sequences)
@@ -653,8 +948,14 @@ def action(arguments):
         # Track sequences which passed all filters
         sequences = listener.iterable_hook('write', sequences)
 
-        with arguments.output_file:
-            SeqIO.write(sequences, arguments.output_file, output_type)
+        try:
+            with arguments.output_file:
+                SeqIO.write(sequences, arguments.output_file, output_type)
+        finally:
+            if rh is not None:
+                rh.close()
+            if demultiplexer is not None:
+                demultiplexer.close()
 
     rpt_rows = (f.report_dict() for f in filters)
 
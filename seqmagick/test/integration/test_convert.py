@@ -95,6 +95,9 @@ class ConvertUngapCutTestCase(CommandLineTestMixIn, unittest.TestCase):
     expected_path = p('output2_ungap_cut.fasta')
     command = 'convert --ungap --cut 1:3 --tail 2 {input} {output}'
 
+class ConvertNoLazyTestCase(ConvertUngapCutTestCase):
+    command = 'convert --no-lazy --ungap --cut 1:3 --tail 2 {input} {output}'
+
 class ConvertToStdOutTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -31,6 +31,12 @@ test3 sequence 3
         cli.main(args)
         self.assertEquals(self.expected_desc, self.tempfile.read())
 
+    def test_threads(self):
+        args = ['extract-ids', self.seq_file, '-o', self.tempfile.name,
+                '--threads', '2']
+        cli.main(args)
+        self.assertEquals(self.expected, self.tempfile.read())
+
 
 class SimpleExtractIdsTestCase(ExtractIdsMixin, unittest.TestCase):
     seq_file = data_path('input2.fasta')
@@ -4,6 +4,7 @@ import os.path
 import shlex
 import shutil
 import tempfile
+import unittest
 
 from seqmagick.scripts import cli
 from seqmagick.subcommands.common import FileType
@@ -48,3 +49,31 @@ class MogrifyGzipInputTestCase(CommandLineTestMixIn, test_convert.GzipInputConve
     command = 'mogrify {input}'
     expected_path = data_path('output2.fasta')
     out_suffix='fasta.gz'
+
+class MogrifyRelativeToTestCase(unittest.TestCase):
+    """
+    The --relative-to reference is found in each file
+    """
+    inputs = ('>ref\nAC--GTAA\n>s\nAGGGGCTT\n', '>ref\nACGTAA\n>s\nAGGCTT\n')
+    expected = ('>ref\nAC--GT\n>s\nAGGGGC\n', '>ref\nACGT\n>s\nAGGC\n')
+
+    def setUp(self):
+        self.input_files = []
+        for text in self.inputs:
+            with tempfile.NamedTemporaryFile(suffix='.fasta',
+                                             delete=False) as tf:
+                tf.write(text)
+            self.input_files.append(tf.name)
+
+    def tearDown(self):
+        for path in self.input_files:
+            os.remove(path)
+
+    def test_run(self):
+        cli.main(['mogrify', '--cut', '1:4', '--relative-to', 'ref'] +
+                 self.input_files)
+        actual = []
+        for path in self.input_files:
+            with open(path) as fp:
+                actual.append(fp.read())
+        self.assertEqual(list(self.expected), actual)
@@ -1,3 +1,4 @@
+import itertools
 import unittest
 
 from Bio.Seq import Seq
@@ -28,6 +29,20 @@ class BatchTestCase(unittest.TestCase):
         self.assertEquals([[0, 1], [2, 3], [4]], list(b))
 
 
+class CodonLookupTestCase(unittest.TestCase):
+    def test_unambiguous(self):
+        table = CodonTable.unambiguous_dna_by_name['Standard']
+        lookup = backtrans_align.codon_lookup(table)
+        self.assertEqual(table.forward_table, lookup)
+
+    def test_ambiguous(self):
+        lookup = backtrans_align.codon_lookup(
+                CodonTable.ambiguous_dna_by_name['Standard'])
+        self.assertEqual('K', lookup['AAR'])
+        self.assertEqual('L', lookup['YTR'])
+        self.assertNotIn('NNN', lookup)
+        self.assertNotIn('TAA', lookup)
+
 class AlignmentMapperTestCase(unittest.TestCase):
     def setUp(self):
         self.instance = backtrans_align.AlignmentMapper(CodonTable.unambiguous_dna_by_name['Standard'])
@@ -38,6 +53,10 @@ class AlignmentMapperTestCase(unittest.TestCase):
 
         self.assertTrue(self.instance._validate_translation(prot, nucl))
 
+    def test_validate_gaps(self):
+        self.assertTrue(self.instance._validate_translation('F-K',
+                                                            'TTT---AAG'))
+
     def test_validate_invalid(self):
         nucl = 'AAGTTT'
         prot = 'KK'
@@ -67,6 +86,24 @@ class AlignmentMapperTestCase(unittest.TestCase):
         mapped = self.instance.map_all(prot, nucl)
         self.assertRaises(ValueError, list, mapped)
 
+    def test_map_all_by_id(self):
+        nucl = {'1': SeqRecord(Seq('AAGTTT'), id='1'), # KF
+                '2': SeqRecord(Seq('AAGGTCTTC'), id='2')} # KVF
+        prot = [SeqRecord(Seq('-KVF'), id='2'),
+                SeqRecord(Seq('-K-F'), id='1')]
+
+        result = self.instance.map_all_by_id(prot, nucl)
+        result = [(s.id, str(s.seq)) for s in result]
+        self.assertEqual([('2', '---AAGGTCTTC'),
+                          ('1', '---AAG---TTT')], result)
+
+    def test_map_all_by_id_missing(self):
+        nucl = {'1': SeqRecord(Seq('AAGTTT'), id='1')}
+        prot = [SeqRecord(Seq('KV'), id='3')]
+        mapped = self.instance.map_all_by_id(prot, nucl)
+        self.assertRaisesRegexp(ValueError, 'No nucleotide sequence with ID 3',
+                list, mapped)
+
     def test_map_alignment_excess_codons(self):
         nucl = [SeqRecord(Seq('AAGTTT'), id='1'), # KF
                 SeqRecord(Seq('AAGGTCTTC'), id='2')]  # KVF
@@ -74,3 +111,34 @@ class AlignmentMapperTestCase(unittest.TestCase):
                 SeqRecord(Seq('KV-'), id='2')]
         mapped = self.instance.map_all(prot, nucl)
         self.assertRaises(ValueError, list, mapped)
+
+class MapParallelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instance = backtrans_align.AlignmentMapper(CodonTable.unambiguous_dna_by_name['Standard'])
+        self.nucl = [SeqRecord(Seq('AAGTTT' * (i + 1)), id=str(i))
+                     for i in xrange(10)]
+        self.prot = [SeqRecord(Seq('K-F' * (i + 1)), id=str(i))
+                     for i in xrange(10)]
+
+    def test_order(self):
+        pairs = backtrans_align.pair_records(self.prot, self.nucl)
+        result = self.instance.map_parallel(pairs, 2, chunk_size=3)
+        self.assertEqual([(s.id, str(s.seq)) for s in
+                          self.instance.map_all(self.prot, self.nucl)],
+                         [(s.id, str(s.seq)) for s in result])
+
+    def test_first_error(self):
+        # Mapping fails for record 4; pairing fails after record 7
+        self.prot[4] = SeqRecord(Seq('KK' * 5), id='4')
+        pairs = backtrans_align.pair_records(self.prot, self.nucl[:8])
+        result = self.instance.map_parallel(pairs, 3, chunk_size=2)
+        self.assertRaisesRegexp(ValueError, 'Codon TTT translates to F, not K',
+                                list, result)
+
+    def test_pairing_error(self):
+        pairs = backtrans_align.pair_records(self.prot, self.nucl[:7])
+        result = self.instance.map_parallel(pairs, 2, chunk_size=3)
+        self.assertEqual([str(i) for i in xrange(7)],
+                         [s.id for s in itertools.islice(result, 7)])
+        self.assertRaisesRegexp(ValueError, 'Exhausted nucleotide sequences',
+                                next, result)
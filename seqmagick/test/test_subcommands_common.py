@@ -58,6 +58,31 @@ class PositiveValueTestCase(unittest.TestCase):
     def test_zero(self):
         self.assertEqual(0, common.positive_value(int)('0'))
 
+class MotifListTestCase(unittest.TestCase):
+
+    def test_motifs(self):
+        self.assertEqual(['ACGT', 'GGNCC'], common.motif_list('ACGT,GGNCC'))
+
+    def test_invalid(self):
+        self.assertRaises(argparse.ArgumentTypeError,
+                common.motif_list, 'ACGT,')
+        self.assertRaises(argparse.ArgumentTypeError,
+                common.motif_list, 'AC-GT')
+
+class TranslationTableTestCase(unittest.TestCase):
+
+    def test_id(self):
+        self.assertEqual(11, common.translation_table('11'))
+
+    def test_name(self):
+        self.assertEqual(2, common.translation_table('vertebrate mitochondrial'))
+
+    def test_unknown(self):
+        self.assertRaises(argparse.ArgumentTypeError,
+                common.translation_table, '7')
+        self.assertRaises(argparse.ArgumentTypeError,
+                common.translation_table, 'Martian')
+
 class CutRangeTestCase(unittest.TestCase):
     def test_out_of_order(self):
         self.assertRaises(argparse.ArgumentTypeError,
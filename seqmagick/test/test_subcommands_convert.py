@@ -71,28 +71,40 @@ class SeqSelectTransformsTestCase(PopulateTransformsMixIn, unittest.TestCase):
         self.arguments = ['--deduplicate-taxa',
                 '--exclude-from-file', self.exclude_from,
                 '--include-from-file', self.exclude_from,
+                '--exclude-prefixes-from-file', self.exclude_from,
+                '--include-prefixes-from-file', self.exclude_from,
                 '--head', '10',
                 '--max-length', '50',
                 '--min-length', '50',
                 '--min-ungapped-length', '50',
                 '--pattern-include', 'pattern',
                 '--pattern-exclude', 'pattern',
+                '--pattern-exclude-from-file', self.exclude_from,
+                '--pattern-include-from-file', self.exclude_from,
                 '--prune-empty',
                 '--seq-pattern-include', 'pattern',
                 '--seq-pattern-exclude', 'pattern',
+                '--seq-motif-include', 'ACGT',
+                '--seq-motif-exclude', 'ACGT',
                 ]
         self.functions = [transform.deduplicate_taxa,
                 transform.exclude_from_file,
                 transform.include_from_file,
+                transform.exclude_prefixes_from_file,
+                transform.include_prefixes_from_file,
                 transform.head,
                 transform.max_length_discard,
                 transform.min_length_discard,
                 transform.min_ungap_length_discard,
                 transform.name_include,
                 transform.name_exclude,
+                transform.exclude_patterns_from_file,
+                transform.include_patterns_from_file,
                 transform.prune_empty,
                 transform.seq_include,
                 transform.seq_exclude,
+                transform.seq_motif_include,
+                transform.seq_motif_exclude,
                 ]
         super(SeqSelectTransformsTestCase, self).setUp()
 
@@ -1,5 +1,8 @@
 from cStringIO import StringIO
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 
 from Bio.Seq import Seq
@@ -200,6 +203,93 @@ class PrimerBarcodeFilterTestCase(unittest.TestCase):
         self.assertEqual(2, len(actual))
         self.assertEqual(['CGAT', 'CGCT'], [str(s.seq) for s in actual])
 
+class DemultiplexWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.listener = quality_filter.RecordEventListener()
+        # A single open handle and record buffer forces re-opening files
+        self.instance = quality_filter.DemultiplexWriter(self.directory,
+                'fasta', max_open=1, buffer_size=1)
+        self.instance.register_with(self.listener)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _process(self, record, sample=None):
+        self.listener('read', record)
+        if sample is not None:
+            self.listener('found_barcode', record, sample=sample)
+        self.listener('write', record)
+
+    def _read(self, sample):
+        with open(os.path.join(self.directory, sample + '.fasta')) as fp:
+            return [line.strip() for line in fp if line.startswith('>')]
+
+    def test_split(self):
+        self._process(SeqRecord(Seq('ACGT'), 'seq1', description=''), 'S1')
+        self._process(SeqRecord(Seq('ACGG'), 'seq2', description=''), 'S2')
+        self._process(SeqRecord(Seq('ACGA'), 'seq3', description=''), 'S1')
+        self._process(SeqRecord(Seq('ACGC'), 'seq4', description=''))
+        self.instance.close()
+
+        self.assertEqual(['>seq1', '>seq3'], self._read('S1'))
+        self.assertEqual(['>seq2'], self._read('S2'))
+        self.assertEqual(['S1.fasta', 'S2.fasta'],
+                         sorted(os.listdir(self.directory)))
+        self.assertEqual({}, self.instance.handles)
+
+class RecordReportHandlerTestCase(unittest.TestCase):
+    handler_cls = quality_filter.RecordReportHandler
+
+    def setUp(self):
+        self.fp = StringIO()
+        self.listener = quality_filter.RecordEventListener()
+        self.instance = self.handler_cls(self.fp, [], write_comments=False,
+                batch_size=2)
+        self.instance.register_with(self.listener)
+
+        self.records = [SeqRecord(Seq('ACGT'), 'seq1'),
+                        SeqRecord(Seq('ACGG'), 'seq2'),
+                        SeqRecord(Seq('ACGA'), 'seq3')]
+        for record in self.records:
+            record.letter_annotations['phred_quality'] = [20, 30, 40, 30]
+
+    def _process(self):
+        r1, r2, r3 = self.records
+        self.listener('read', r1)
+        self.listener('write', r1)
+        self.listener('read', r2)
+        self.listener('found_barcode', r2, sample='S1')
+        self.listener('write', r2[:2])
+        self.listener('read', r3)
+        self.listener('failed_filter', r3, filter_name='f', value=1)
+
+    def test_batches(self):
+        self._process()
+        # Third row remains in the batch until closed
+        self.assertEqual(3, len(self.fp.getvalue().splitlines()))
+        self.instance.close()
+        self.assertEqual("""\
+"sequence_name","in_length","in_mean_qual","sample","out_length","out_mean_qual","fail_filter","fail_value"
+"seq1",4,30.0,"",4,30.0,"",""
+"seq2",4,30.0,"S1",2,25.0,"",""
+"seq3",4,30.0,"","","","f",1
+""", self.fp.getvalue())
+
+class ColumnarRecordReportHandlerTestCase(RecordReportHandlerTestCase):
+    handler_cls = quality_filter.ColumnarRecordReportHandler
+
+    def test_batches(self):
+        self._process()
+        self.instance.close()
+        self.fp.seek(0)
+        actual = quality_filter.read_columnar_details(self.fp)
+        self.assertEqual(['seq1', 'seq2', 'seq3'], actual['sequence_name'])
+        self.assertEqual([None, 'S1', None], actual['sample'])
+        self.assertEqual([4, 2, None], actual['out_length'])
+        self.assertEqual([30.0, 25.0, None], actual['out_mean_qual'])
+        self.assertEqual([None, None, 1], actual['fail_value'])
+
 class RecordEventListenerTestCase(unittest.TestCase):
 
     def test_send(self):
@@ -221,6 +311,32 @@ class RecordEventListenerTestCase(unittest.TestCase):
         rle('other', record, n=5)
         self.assertEqual(events, [1, 5])
 
+    def test_no_handlers(self):
+        rle = quality_filter.RecordEventListener()
+        records = [object()]
+        self.assertIsNone(rle.dispatcher('e'))
+        self.assertIs(records, rle.iterable_hook('e', records))
+
+    def test_dispatcher(self):
+        events = []
+        rle = quality_filter.RecordEventListener()
+        rle.register_handler('e', lambda record, n=1: events.append(('a', n)))
+        rle.register_handler('e', lambda record, n=1: events.append(('b', n)))
+        rle.dispatcher('e')(object(), n=2)
+        self.assertEqual([('a', 2), ('b', 2)], sorted(events))
+
+    def test_batch_handler(self):
+        events = []
+        batches = []
+        rle = quality_filter.RecordEventListener()
+        rle.register_handler('e', lambda record: events.append(record))
+        rle.register_batch_handler('e', lambda batch: batches.append(batch))
+        records = range(5)
+        result = list(rle.iterable_hook('e', records, batch_size=2))
+        self.assertEqual(records, result)
+        self.assertEqual(records, events)
+        self.assertEqual([[0, 1], [2, 3], [4]], batches)
+
 @unittest.skipIf(IS_PYPY, "Bio.trie not available on pypy.")
 class BarcodePrimerTrieTestCase(unittest.TestCase):
 
@@ -5,13 +5,20 @@ Tests for seqmagick.transform
 from cStringIO import StringIO
 import functools
 import logging
+import os
+import os.path
+import tempfile
 import unittest
 
 from Bio import Alphabet, SeqIO
+from Bio.Alphabet import IUPAC
+from Bio.Data import CodonTable
 from Bio.SeqRecord import SeqRecord
 from Bio.Seq import Seq
 
 from seqmagick import transform
+from seqmagick.subcommands.common import FileType
+from seqmagick.test.integration import data_path
 
 logging.basicConfig(level=logging.FATAL)
 
@@ -191,6 +198,106 @@ class SqueezeTestCase(unittest.TestCase):
         self.assertEqual([str(i.seq) for i in self.sequences],
                 [str(i.seq) for i in result])
 
+    def test_unaligned(self):
+        self.sequences.append(seqrecord('sequence_4', 'ACGT'))
+        self.assertRaises(ValueError, transform.gap_proportion,
+                          self.sequences)
+
+class AlignmentMatrixTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [
+            seqrecord('s0', 'ACGTACGTACGTACG', description='d0'),
+            seqrecord('s1', '--GTAC-TAC-TACG', description='d1')]
+
+    def _matrices(self):
+        for buffer_size in (transform.DEFAULT_BUFFER_SIZE, 0):
+            yield transform._AlignmentMatrix.from_records(
+                self.sequences, buffer_size=buffer_size, block_size=7)
+
+    def test_rows_columns(self):
+        for matrix in self._matrices():
+            with matrix:
+                self.assertEqual(2, len(matrix))
+                self.assertEqual(15, matrix.length)
+                self.assertEqual('--GTAC-TAC-TACG', matrix.row(1))
+                self.assertEqual('A-', matrix.column(0))
+                self.assertEqual([1, 1, 0], matrix.count_columns('-')[:3])
+
+    def test_records(self):
+        columns = [i for i in xrange(15) if i % 4 != 1] + [0]
+        expected = [''.join(str(r.seq)[i] for i in columns)
+                    for r in self.sequences]
+        for matrix in self._matrices():
+            with matrix:
+                for block_size in (1, 1 << 24):
+                    actual = list(matrix.records(columns, block_size))
+                    self.assertEqual(expected, [str(r.seq) for r in actual])
+                    self.assertEqual(['s0', 's1'], [r.id for r in actual])
+                    self.assertEqual(['d0', 'd1'],
+                                     [r.description for r in actual])
+
+    def test_column_runs(self):
+        self.assertEqual([(0, 2), (3, 4), (1, 2)],
+                         transform._column_runs([0, 1, 3, 1]))
+        self.assertEqual([], transform._column_runs([]))
+
+class ColumnPlanTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('s0', 'ACGT-ACGT-', description='d0'),
+                          seqrecord('s1', 'A-G--A-GT-', description='d1')]
+        for record in self.sequences:
+            record.letter_annotations['phred_quality'] = range(10)
+
+    def test_compile(self):
+        plan = transform._ColumnPlan([('cut', [slice(1, 8), slice(0, 1)]),
+                                      ('drop', [slice(0, 2)])])
+        self.assertEqual(([3, 4, 5, 6, 7, 0], [(3, 8), (0, 1)]),
+                         plan.compile(10))
+        self.assertTrue(plan.compile(10) is plan.compile(10))
+
+    def test_select_columns(self):
+        plan = transform._ColumnPlan([('drop', [slice(1, 3)]),
+                                      ('cut', [slice(0, 4), slice(5, 6)])])
+        actual = list(transform.select_columns(self.sequences, plan))
+        self.assertEqual(['AT-AG', 'A--AG'], [str(r.seq) for r in actual])
+        self.assertEqual([0, 3, 4, 5, 7],
+                         actual[0].letter_annotations['phred_quality'])
+        self.assertEqual(['d0', 'd1'], [r.description for r in actual])
+
+    def test_squeeze(self):
+        plan = transform._ColumnPlan([('cut', [slice(1, None)]),
+                                      ('squeeze', 1.0)])
+        actual = list(transform.select_columns(self.sequences, plan))
+        self.assertEqual(['CGTACGT', '-G-A-GT'], [str(r.seq) for r in actual])
+
+    def test_squeeze_after_cut(self):
+        # Sequences are aligned only once cut
+        sequences = [seqrecord('s0', 'AC-GTTTTT'), seqrecord('s1', 'A--GCC')]
+        plan = transform._ColumnPlan([('cut', [slice(0, 4)]),
+                                      ('squeeze', 1.0),
+                                      ('drop', [slice(0, 1)])])
+        actual = list(transform.select_columns(sequences, plan))
+        self.assertEqual(['CG', '-G'], [str(r.seq) for r in actual])
+
+    def test_fuse(self):
+        transforms = [functools.partial(transform.drop_columns,
+                                        slices=[slice(1, 3)]),
+                      functools.partial(transform.squeeze),
+                      functools.partial(transform.multi_cut_sequences,
+                                        slices=[slice(0, 4)]),
+                      transform.upper_sequences]
+        fused = transform.fuse_column_selections(transforms)
+        self.assertEqual(2, len(fused))
+        self.assertEqual(transform.upper_sequences, fused[1])
+        expected = self.sequences
+        for f in transforms[:3]:
+            expected = f(expected)
+        self.assertEqual([str(r.seq) for r in expected],
+                         [str(r.seq) for r in fused[0](self.sequences)])
+
+
 
 class SeqPatternTestCase(unittest.TestCase):
 
@@ -207,7 +314,9 @@ class SeqPatternTestCase(unittest.TestCase):
                       ('.*', self.sequences),
                       ('^AC', [self.sequences[0]]),
                       ('^ac', []),
-                      ('^ac(?i)', [self.sequences[0]])]
+                      ('^ac(?i)', [self.sequences[0]]),
+                      ('C-G', self.sequences[:2]),
+                      ('-', self.sequences)]
 
     def test_include(self):
         result = transform.seq_include(self.sequences, '^$')
@@ -224,6 +333,221 @@ class SeqPatternTestCase(unittest.TestCase):
             result = list(transform.seq_exclude(self.sequences, regex))
             self.assertEqual(expected, result)
 
+class MotifMatcherTestCase(unittest.TestCase):
+
+    def test_literal(self):
+        matcher = transform.MotifMatcher(['ACG', 'TTT'])
+        self.assertEqual(None, matcher.regex)
+        self.assertEqual([True, True, False],
+                         map(matcher, ['AACGA', 'GTTTG', 'AAAcg']))
+
+    def test_ambiguous(self):
+        matcher = transform.MotifMatcher(['GGNCC', 'AYA'])
+        self.assertEqual(['A', 'GG'], matcher.literals)
+        self.assertEqual([True, True, True, False, False],
+                         map(matcher, ['AGGTCCA', 'ACA', 'ATA', 'AGA', 'GGCC']))
+
+    def test_no_literal(self):
+        matcher = transform.MotifMatcher(['RY', 'AAA'])
+        self.assertEqual(None, matcher.literals)
+        self.assertEqual([True, False], map(matcher, ['TTGC', 'TTTC']))
+
+    def test_reverse_complement(self):
+        sequences = ['CCGATT', 'AATCGG', 'AATCGA']
+        matcher = transform.MotifMatcher(['CCGAT'])
+        self.assertEqual([True, False, False], map(matcher, sequences))
+        matcher = transform.MotifMatcher(['CCGAT'], reverse_complement=True)
+        self.assertEqual([True, True, False], map(matcher, sequences))
+        matcher = transform.MotifMatcher(['CYGAT'], reverse_complement=True)
+        self.assertEqual([True, True, False], map(matcher, sequences))
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, transform.MotifMatcher, ['AC-G'])
+        self.assertRaises(ValueError, transform.MotifMatcher, [''])
+
+class SeqMotifTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('a', 'ACGTTA'), seqrecord('b', 'TAACGA'),
+                          seqrecord('c', 'GGGGGG')]
+
+    def test_include(self):
+        actual = transform.seq_motif_include(self.sequences, ['TTR'])
+        self.assertEqual(self.sequences[:1], list(actual))
+        actual = transform.seq_motif_include(self.sequences, ['TTR'], True)
+        self.assertEqual(self.sequences[:2], list(actual))
+
+    def test_exclude(self):
+        actual = transform.seq_motif_exclude(self.sequences, ['TTR'], True)
+        self.assertEqual(self.sequences[2:], list(actual))
+
+class DigestTableTestCase(unittest.TestCase):
+
+    def test_add(self):
+        table = transform._DigestTable(capacity=2)
+        sequences = ['ACGT', 'A', 'ACGT', '', 'GG', 'A', '']
+        actual = [table.add(s) for s in sequences]
+        self.assertEqual([(0, True), (1, True), (0, False), (2, True),
+                          (3, True), (1, False), (2, False)], actual)
+        self.assertEqual(8, len(table.values))
+
+    def test_verify(self):
+        class CollidingTable(transform._DigestTable):
+            _hash = staticmethod(lambda s: transform.hashlib.md5(''))
+
+        table = CollidingTable(capacity=4, verify=True)
+        actual = [table.add(s) for s in ['ACGT', 'TTTT', 'ACGT', 'TTTT']]
+        self.assertEqual([(0, True), (1, True), (0, False), (1, False)],
+                         actual)
+        table.close()
+
+        table = CollidingTable(capacity=4)
+        self.assertEqual([(0, True), (0, False)],
+                         [table.add(s) for s in ['ACGT', 'TTTT']])
+
+class DeduplicateSequencesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('a', 'ACGT'), seqrecord('b', 'AAAA'),
+                          seqrecord('c', 'acgt'), seqrecord('d', 'ACGT'),
+                          seqrecord('e', 'CCCC')]
+
+    def test_deduplicate(self):
+        for verify in (False, True):
+            actual = list(transform.deduplicate_sequences(self.sequences, None,
+                                                          verify))
+            self.assertEqual(['a', 'b', 'e'], [i.id for i in actual])
+
+    def test_out_file(self):
+        for shards in (None, 3):
+            with tempfile.NamedTemporaryFile() as tf:
+                actual = list(transform.deduplicate_sequences(
+                    self.sequences, open(tf.name, 'w'), shards=shards))
+                self.assertEqual(['a c d', 'b', 'e'],
+                                 sorted(tf.read().splitlines()))
+            self.assertEqual(['a', 'b', 'e'], [i.id for i in actual])
+
+    def test_sharded(self):
+        sequences = [seqrecord(str(i), 'ACGT' * (i % 7)) for i in xrange(50)]
+        for verify, processes in ((False, 1), (True, 1), (False, 2)):
+            actual = list(transform.deduplicate_sequences(
+                sequences, None, verify=verify, shards=4,
+                processes=processes))
+            self.assertEqual(map(str, range(7)), [i.id for i in actual])
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, transform.deduplicate_sequences,
+                          self.sequences, None, mode='fuzzy')
+        self.assertRaises(ValueError, transform.deduplicate_sequences,
+                          self.sequences, None, shards=2, mode='prefix')
+
+class DereplicateSequencesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('a', 'ACG'), seqrecord('b', 'ACGTT'),
+                          seqrecord('c', 'GTT'), seqrecord('d', 'acgt'),
+                          seqrecord('e', 'ACGAA'), seqrecord('f', 'ACGTT'),
+                          seqrecord('g', 'CCCC')]
+
+    def _dereplicate(self, mode):
+        with tempfile.NamedTemporaryFile() as tf:
+            actual = list(transform.deduplicate_sequences(
+                self.sequences, open(tf.name, 'w'), mode=mode))
+            return [i.id for i in actual], sorted(tf.read().splitlines())
+
+    def test_prefix(self):
+        ids, groups = self._dereplicate('prefix')
+        self.assertEqual(['b', 'c', 'e', 'g'], ids)
+        # ACG is a prefix of both ACGAA and ACGTT: the first sorted wins
+        self.assertEqual(['1\tc', '1\tg', '2\ta e', '3\tb d f'], groups)
+
+    def test_substring(self):
+        ids, groups = self._dereplicate('substring')
+        self.assertEqual(['b', 'e', 'g'], ids)
+        self.assertEqual(['1\te', '1\tg', '5\ta b c d f'], groups)
+
+    def test_substring_short_keys(self):
+        full = 'A' * 20 + 'ACGTTGCA' * 5 + 'G' * 20
+        sequences = [full[i:len(full) - 2 * i] for i in xrange(10)]
+        sequences += ['AC', 'CG', 'AAAAC', 'GGGT']
+        actual = transform._dereplicate_substrings(sequences, k=8)
+        expected = [0] * 13 + [13]
+        self.assertEqual(expected, list(actual))
+
+    def test_prefix_chain(self):
+        sequences = ['AC', 'A', 'ACT', 'ACG', 'T', 'ACGT']
+        actual = transform._dereplicate_prefixes(sequences)
+        self.assertEqual(['ACGT', 'ACGT', 'ACT', 'ACGT', 'T', 'ACGT'],
+                         [sequences[i] for i in actual])
+
+class DeduplicateTaxaTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('1|a', 'A'), seqrecord('x', 'A'),
+                          seqrecord('1|b', 'A'), seqrecord('x', 'C'),
+                          seqrecord('2|a', 'A')]
+
+    def test_deduplicate(self):
+        for shards in (None, 2):
+            actual = transform.deduplicate_taxa(self.sequences, shards=shards)
+            self.assertEqual(['1|a', 'x', '2|a'], [i.id for i in actual])
+
+class SampleTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('sequence{0}'.format(i), 'A')
+                          for i in xrange(100)]
+
+    def test_size(self):
+        for k in (0, 1, 10, 99, 100, 150):
+            actual = transform.sample(self.sequences, k)
+            self.assertEqual(min(k, 100), len(actual))
+            self.assertEqual(len(actual), len(set(r.id for r in actual)))
+
+    def test_seed(self):
+        a = transform.sample(self.sequences, 10, seed=1)
+        b = transform.sample(self.sequences, 10, seed=1)
+        self.assertEqual([r.id for r in a], [r.id for r in b])
+
+    def test_keep_order(self):
+        actual = transform.sample(self.sequences, 20, seed=2, keep_order=True)
+        indexes = [self.sequences.index(r) for r in actual]
+        self.assertEqual(sorted(indexes), indexes)
+
+    def test_uniform(self):
+        counts = [0] * 10
+        for seed in xrange(2000):
+            for i in transform.sample(xrange(10), 3, seed=seed):
+                counts[i] += 1
+        # Each is expected 600 times, with a standard deviation of ~20
+        for count in counts:
+            self.assertTrue(500 < count < 700, counts)
+
+
+class SampleFractionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('sequence{0}'.format(i), 'A')
+                          for i in xrange(1000)]
+
+    def test_fraction(self):
+        actual = list(transform.sample_fraction(self.sequences, 0.2, seed=1))
+        # Expected 200, with a standard deviation of ~13
+        self.assertTrue(140 < len(actual) < 260, len(actual))
+        indexes = [self.sequences.index(r) for r in actual]
+        self.assertEqual(sorted(set(indexes)), indexes)
+
+    def test_seed(self):
+        a = transform.sample_fraction(self.sequences, 0.5, seed=3)
+        b = transform.sample_fraction(self.sequences, 0.5, seed=3)
+        self.assertEqual([r.id for r in a], [r.id for r in b])
+
+    def test_bounds(self):
+        self.assertEqual([], list(transform.sample_fraction(self.sequences,
+                                                            0)))
+        self.assertEqual(self.sequences,
+                         list(transform.sample_fraction(self.sequences, 1)))
+
 class HeadTestCase(unittest.TestCase):
     """
     Test for transform.head
@@ -415,6 +739,137 @@ class ExcludeFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
         self.assertEqual(2, len(actual))
         self.assertEqual(expected, actual)
 
+class CompactIdSetTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.ids = ['read{0}'.format(i) for i in xrange(1000)]
+        self.id_set = transform.CompactIdSet.from_ids(self.ids + self.ids[:10])
+
+    def check(self, id_set):
+        self.assertEqual(1000, len(id_set))
+        self.assertTrue(all(i in id_set for i in self.ids))
+        self.assertFalse(any('other{0}'.format(i) in id_set
+                             for i in xrange(1000)))
+
+    def test_contains(self):
+        self.check(self.id_set)
+        self.check(transform.CompactIdSet.from_ids(reversed(self.ids)))
+        self.assertEqual(0, len(transform.CompactIdSet.from_ids([])))
+
+    def test_save_load(self):
+        handle = StringIO()
+        self.id_set.save(handle)
+        handle.seek(0)
+        self.assertEqual(transform.CompactIdSet.MAGIC, handle.readline())
+        self.check(transform.CompactIdSet.load(handle))
+
+    def test_save_load_mapped(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            self.id_set.save(tf)
+            tf.flush()
+            with open(tf.name) as handle:
+                handle.readline()
+                id_set = transform.CompactIdSet.load(handle)
+            self.check(id_set)
+
+            # Reloaded sets can be saved again
+            handle = StringIO()
+            id_set.save(handle)
+            self.assertEqual(os.path.getsize(tf.name), len(handle.getvalue()))
+
+class CompactIncludeExcludeTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_compact(self):
+        expected = [self.sequences[0], self.sequences[1], self.sequences[3]]
+        actual = list(transform.include_from_file(self.sequences, self.handle,
+                                                  compact=True))
+        self.assertEqual(expected, actual)
+
+    def test_saved(self):
+        handle = StringIO()
+        ids = (line.strip() for line in self.handle)
+        transform.CompactIdSet.from_ids(ids).save(handle)
+        handle.seek(0)
+        expected = [self.sequences[2], self.sequences[4]]
+        actual = list(transform.exclude_from_file(self.sequences, handle))
+        self.assertEqual(expected, actual)
+
+class IncludePrefixesFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_filter(self):
+        handle = StringIO('sequenceid1\nte\n\n')
+        expected = [self.sequences[0], self.sequences[4]]
+        actual = list(transform.include_prefixes_from_file(self.sequences,
+                                                           handle))
+        self.assertEqual(expected, actual)
+
+class ExcludePrefixesFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_filter(self):
+        handle = StringIO('sequenceid1\nte\n')
+        expected = self.sequences[1:4]
+        actual = list(transform.exclude_prefixes_from_file(self.sequences,
+                                                           handle))
+        self.assertEqual(expected, actual)
+
+class IncludePatternsFromFileTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_filter(self):
+        handle = StringIO('id[13]$\n(?i)TEST SEQ\n')
+        expected = [self.sequences[0], self.sequences[2], self.sequences[4]]
+        actual = list(transform.include_patterns_from_file(self.sequences,
+                                                           handle))
+        self.assertEqual(expected, actual)
+
+class IdSelectorTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_combined(self):
+        selector = transform.IdSelector(ids=['sequenceid1'],
+                                        prefixes=['sequenceid2', 'tes'],
+                                        patterns=['id 4$'])
+        self.assertEqual([True, True, False, True, True],
+                         map(selector, self.sequences))
+
+    def test_patterns(self):
+        selector = transform.IdSelector(
+            patterns=['id1', r'(d)\1', '(?i)SEQUENCEID3', 'test'])
+        # Only patterns without groups or flags are combined
+        self.assertEqual(3, len(selector.patterns))
+        self.assertEqual([True, False, True, False, True],
+                         map(selector, self.sequences))
+
+    def test_empty(self):
+        selector = transform.IdSelector()
+        self.assertEqual([False] * 5, map(selector, self.sequences))
+
+class FuseIdSelectionsTestCase(IncludeExcludeMixIn, unittest.TestCase):
+
+    def test_fuse(self):
+        transforms = [
+            functools.partial(transform.head, head='4'),
+            functools.partial(transform.include_from_file,
+                              handle=self.handle),
+            functools.partial(transform.name_include,
+                              filter_regex='sequenceid[12]'),
+            functools.partial(transform.name_exclude, filter_regex='2'),
+            functools.partial(transform.exclude_prefixes_from_file,
+                              handle=StringIO('sequenceid4\n')),
+            functools.partial(transform.prune_empty),
+            functools.partial(transform.name_exclude, filter_regex='1')]
+        actual = transform.fuse_id_selections(transforms)
+        self.assertEqual([transform.head, transform.select_ids,
+                          transform.prune_empty, transform.name_exclude],
+                         [f.func for f in actual])
+        self.assertEqual(2, len(actual[1].keywords['includes']))
+
+        records = self.sequences
+        for f in actual:
+            records = f(records)
+        self.assertEqual([], list(records))
+
+        records = actual[1](self.sequences)
+        self.assertEqual([self.sequences[0]], list(records))
+
 class NameIncludeTestCase(IncludeExcludeMixIn, unittest.TestCase):
 
     def test_filter_id(self):
@@ -468,14 +923,15 @@ class CutTestCase(unittest.TestCase):
         self.assertEqual(['BC', 'CD', 'EF', 'FG'], [str(s.seq) for s in
             actual])
 
-class CodonWarningTableTestCase(unittest.TestCase):
+class CodonTranslatorTestCase(unittest.TestCase):
 
     def warn(self, *args, **kwargs):
         self.warnings.append((args, kwargs))
 
     def setUp(self):
         self.warnings = []
-        self.warning_dict = transform.CodonWarningTable({'UUU': 'F'})
+        self.translator = transform.CodonTranslator(
+            CodonTable.ambiguous_rna_by_name['Standard'])
         self.old_warn = transform.logging.warn
         transform.logging.warn = self.warn
 
@@ -483,16 +939,40 @@ class CodonWarningTableTestCase(unittest.TestCase):
         transform.logging.warn = self.old_warn
 
     def test_nowarn(self):
-        actual = self.warning_dict['UUU']
-        self.assertEqual('F', actual)
+        actual = self.translator.translate('UUU---')
+        self.assertEqual('F-', actual)
         self.assertEqual([], self.warnings)
 
     def test_warn(self):
         codon = 'UU-'
-        actual = self.warning_dict[codon]
-        self.assertEqual('X', actual)
+        actual = self.translator.translate(codon * 2)
+        self.assertEqual('XX', actual)
         self.assertEqual([(("Unknown Codon: %s", codon), {})], self.warnings)
 
+    def test_ambiguous(self):
+        self.assertEqual('LX*X', self.translator.translate('YUGUANUARNNN'))
+
+    def test_invalid(self):
+        self.assertRaises(CodonTable.TranslationError,
+                          self.translator.translate, 'UUUUU?')
+
+    def test_to_stop(self):
+        self.assertEqual('F', self.translator.translate('uuuuaauu?',
+                                                        to_stop=True))
+
+    def test_translate_frames(self):
+        actual = self.translator.translate_frames('AUGGCCUAAC')
+        self.assertEqual(['MA*', 'WPN', 'GL', 'VRP', 'LGH', '*A'], actual)
+
+    def test_longest_orf(self):
+        # Frame -1 (CUAGGCCAUUUCAUA) is longest
+        actual = self.translator.longest_orf('UUAUGAAAUGGCCUAG')
+        self.assertEqual(('LGHFI', '-1', 1, 16), actual)
+
+    def test_longest_orf_tie(self):
+        actual = self.translator.longest_orf('UUUUUU')
+        self.assertEqual(('FF', '+1', 0, 6), actual)
+
 class TranslateTestCase(unittest.TestCase):
 
     def test_dna_protein_nogap(self):
@@ -519,6 +999,27 @@ class TranslateTestCase(unittest.TestCase):
         actual = transform.translate(sequences, 'dna2proteinstop')
         self.assertEqual(expected, [str(i.seq) for i in actual])
 
+    def test_dna_sixframe(self):
+        sequences = [seqrecord('A', 'ATGGCCTAAC')]
+        actual = list(transform.translate(sequences, 'dna2sixframe'))
+        self.assertEqual(['A_frame+1', 'A_frame+2', 'A_frame+3', 'A_frame-1',
+                          'A_frame-2', 'A_frame-3'], [i.id for i in actual])
+        self.assertEqual(['MA*', 'WPN', 'GL', 'VRP', 'LGH', '*A'],
+                         [str(i.seq) for i in actual])
+
+    def test_dna_orf(self):
+        sequences = [seqrecord('A', 'TTATGAAATGGCCTAG', description='A'), seqrecord('B', 'TA')]
+        actual = list(transform.translate(sequences, 'dna2orf'))
+        self.assertEqual(['A'], [i.id for i in actual])
+        self.assertEqual(['LGHFI'], [str(i.seq) for i in actual])
+        self.assertEqual('A frame=-1 location=2..16', actual[0].description)
+
+    def test_dna_protein_table(self):
+        sequences = [seqrecord('A', 'TTTTGAATA')]
+        for table in (2, 'Vertebrate Mitochondrial'):
+            actual = transform.translate(sequences, 'dna2protein', table)
+            self.assertEqual(['FWM'], [str(i.seq) for i in actual])
+
 class UngapSequencesTestCase(unittest.TestCase):
 
     def test_dot_gap(self):
@@ -537,6 +1038,469 @@ class UngapSequencesTestCase(unittest.TestCase):
         ungapped = list(transform.ungap_sequences(sequences))
         self.assertEqual(["AAA", "AG", "A"], [str(s.seq) for s in ungapped])
 
+class SequenceMapTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [
+            SeqRecord(Seq('ac-gT', Alphabet.generic_dna), id='s1',
+                      letter_annotations={'phred_quality': range(5)}),
+            SeqRecord(Seq('AUG.c'), id='s2', description='d2')]
+
+    def test_complement_tables(self):
+        from Bio import Seq as BioSeq
+        self.assertEqual(BioSeq._dna_complement_table,
+                         transform._DNA_COMPLEMENT)
+        self.assertEqual(BioSeq._rna_complement_table,
+                         transform._RNA_COMPLEMENT)
+
+    def test_upper(self):
+        actual = list(transform.upper_sequences(self.sequences))
+        self.assertEqual(['AC-GT', 'AUG.C'], [str(r.seq) for r in actual])
+        self.assertEqual(range(5),
+                         actual[0].letter_annotations['phred_quality'])
+
+    def test_reverse_complement(self):
+        actual = list(transform.reverse_complement_sequences(self.sequences))
+        # The second sequence contains U, so is complemented as RNA
+        self.assertEqual(['Ac-gt', 'g.CAU'], [str(r.seq) for r in actual])
+        self.assertEqual(range(5)[::-1],
+                         actual[0].letter_annotations['phred_quality'])
+        self.assertRaises(ValueError, list,
+                          transform.reverse_complement_sequences(
+                              [SeqRecord(Seq('UT'), id='mixed')]))
+
+    def test_fused(self):
+        transforms = [functools.partial(transform.ungap_sequences),
+                      functools.partial(transform.upper_sequences),
+                      functools.partial(transform.reverse_complement_sequences),
+                      functools.partial(transform.transcribe,
+                                        transcribe='rna2dna'),
+                      functools.partial(transform.squeeze),
+                      functools.partial(transform.lower_sequences)]
+        fused = transform.fuse_sequence_maps(transforms)
+        self.assertEqual([transform.map_sequences, transform.squeeze,
+                          transform.lower_sequences],
+                         [f.func for f in fused])
+        actual = list(fused[0](self.sequences))
+        self.assertEqual(['ACGT', 'GCAT'], [str(r.seq) for r in actual])
+        self.assertEqual(['<unknown description>', 'd2'],
+                         [r.description for r in actual])
+        self.assertEqual(IUPAC.ambiguous_dna, actual[0].seq.alphabet)
+
+class FuseRecordStepsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.sequences = [seqrecord('s1', 'ac-gt', description='s1 x'),
+                          seqrecord('s2', 'ACG'),
+                          seqrecord('t3', 'acgtac')]
+        self.transforms = [
+            functools.partial(transform.upper_sequences),
+            functools.partial(transform.name_append_suffix, suffix='_a'),
+            functools.partial(transform.name_exclude, filter_regex='^s2'),
+            functools.partial(transform.min_length_discard, min_length=4),
+            functools.partial(transform.head, head='2'),
+            functools.partial(transform.ungap_sequences),
+            functools.partial(transform.min_length_discard, min_length=5)]
+
+    def test_fused(self):
+        fused = transform.fuse_record_steps(self.transforms)
+        self.assertEqual([transform.apply_record_steps, transform.head,
+                          transform.apply_record_steps],
+                         [f.func for f in fused])
+        # The length filter runs before the maps, which do not change the
+        # length; the ID filter waits for the new ID, and the last length
+        # filter for ungapping.
+        self.assertEqual([transform.min_length_discard,
+                          transform.upper_sequences,
+                          transform.name_append_suffix,
+                          transform.name_exclude],
+                         [s.transform.func for s in fused[0].keywords['steps']])
+        self.assertEqual([transform.ungap_sequences,
+                          transform.min_length_discard],
+                         [s.transform.func for s in fused[2].keywords['steps']])
+
+        records = self.sequences
+        for f in fused:
+            records = f(records)
+        actual = list(records)
+        self.assertEqual(['t3_a'], [r.id for r in actual])
+        self.assertEqual(['ACGTAC'], [str(r.seq) for r in actual])
+
+    def test_matches_unfused(self):
+        for transforms in (self.transforms,
+                           transform.fuse_record_steps(self.transforms)):
+            records = [seqrecord(r.id, str(r.seq), description=r.description)
+                       for r in self.sequences]
+            for f in transforms:
+                records = f(records)
+            self.assertEqual(['t3_a'], [r.id for r in records])
+
+    def test_filter_order(self):
+        transforms = [
+            functools.partial(transform.seq_motif_exclude, motifs=['GN']),
+            functools.partial(transform.name_include, filter_regex='s'),
+            functools.partial(transform.seq_include, filter_regex='A'),
+            functools.partial(transform.max_length_discard, max_length=5)]
+        fused = transform.fuse_record_steps(transforms)
+        # Cheaper filters first, otherwise in order
+        self.assertEqual([transform.name_include,
+                          transform.max_length_discard,
+                          transform.seq_include,
+                          transform.seq_motif_exclude],
+                         [s.transform.func for s in fused[0].keywords['steps']])
+
+    def test_squeeze_not_fused(self):
+        transforms = [functools.partial(transform.upper_sequences),
+                      functools.partial(transform.squeeze),
+                      functools.partial(transform.lower_sequences)]
+        self.assertEqual(transforms, transform.fuse_record_steps(transforms))
+
+    def test_explain_plan(self):
+        fused = transform.fuse_record_steps(self.transforms)
+        self.assertEqual("""1. record pass:
+     filter min_length_discard(min_length=4)
+     map    upper_sequences()
+     map    name_append_suffix(suffix='_a')
+     filter name_exclude(filter_regex='^s2')
+2. stream head(head='2')
+3. record pass:
+     map    ungap_sequences()
+     filter min_length_discard(min_length=5)
+""", transform.explain_plan(fused))
+
+class ParseFilteredTestCase(unittest.TestCase):
+
+    fasta = """leading text
+>s1 first
+ac-g
+t
+>s2
+ACG T\r
+>t3 third
+
+acgtac
+"""
+
+    fastq = """@s1 first
+ACGT
++
+IIII
+@s2
+AC
++s2
+I5
+@t3 third
+ACGTAC
++
+!!!!!!
+"""
+
+    def setUp(self):
+        self.filters, _ = transform.pushdown_filters([
+            functools.partial(transform.name_exclude, filter_regex='first'),
+            functools.partial(transform.min_length_discard, min_length=3)])
+
+    def assertRecordsEqual(self, expected, actual):
+        self.assertEqual([(r.id, r.name, r.description, str(r.seq),
+                           r.seq.alphabet, r.letter_annotations)
+                          for r in expected],
+                         [(r.id, r.name, r.description, str(r.seq),
+                           r.seq.alphabet, r.letter_annotations)
+                          for r in actual])
+
+    def _check(self, text, file_format, expected_ids):
+        expected = [r for r in SeqIO.parse(StringIO(text), file_format)
+                    if 'first' not in r.description and len(r) >= 3]
+        actual = list(transform.parse_filtered(
+            StringIO(text), file_format, filters=self.filters))
+        self.assertRecordsEqual(expected, actual)
+        self.assertEqual(expected_ids, [r.id for r in actual])
+
+    def test_fasta(self):
+        self._check(self.fasta, 'fasta', ['s2', 't3'])
+
+    def test_fastq(self):
+        self._check(self.fastq, 'fastq', ['t3'])
+
+    def test_empty_title(self):
+        # Older Biopython releases fail on FASTA records without a title,
+        # so these are not compared with SeqIO.parse
+        actual = transform.parse_filtered(StringIO('>\nACG\n'), 'fasta',
+                                          filters=self.filters)
+        self.assertEqual([('', '', '', 'ACG')],
+                         [(r.id, r.name, r.description, str(r.seq))
+                          for r in actual])
+
+    def test_fastq_invalid_quality(self):
+        # Also in records which do not pass the filters
+        text = self.fastq.replace('IIII', 'II I')
+        self.assertRaises(ValueError, list, SeqIO.parse(StringIO(text),
+                                                        'fastq'))
+        self.assertRaises(ValueError, list, transform.parse_filtered(
+            StringIO(text), 'fastq', filters=self.filters))
+
+    def test_other_format(self):
+        record = next(SeqIO.parse(StringIO(self.fastq), 'fastq',
+                                  alphabet=Alphabet.generic_dna))
+        text = record.format('genbank')
+        self.assertEqual([], list(transform.parse_filtered(
+            StringIO(text), 'genbank', filters=self.filters)))
+
+    def test_no_filters(self):
+        self.assertRecordsEqual(
+            SeqIO.parse(StringIO(self.fasta), 'fasta'),
+            transform.parse_filtered(StringIO(self.fasta), 'fasta'))
+
+    def test_pushdown(self):
+        transforms = [
+            functools.partial(transform.min_length_discard, min_length=3),
+            functools.partial(transform.upper_sequences),
+            functools.partial(transform.seq_include, filter_regex='A'),
+            functools.partial(transform.name_include, filter_regex='s'),
+            functools.partial(transform.name_append_suffix, suffix='_a'),
+            functools.partial(transform.max_length_discard, max_length=5)]
+        filters, rest = transform.pushdown_filters(
+            transform.fuse_record_steps(transforms))
+        self.assertEqual([transform.min_length_discard,
+                          transform.name_include,
+                          transform.max_length_discard],
+                         [s.transform.func for s in filters])
+        self.assertEqual([transform.apply_record_steps],
+                         [f.func for f in rest])
+        self.assertEqual([transform.upper_sequences, transform.seq_include,
+                          transform.name_append_suffix],
+                         [s.transform.func for s in rest[0].keywords['steps']])
+
+    def test_lazy(self):
+        with tempfile.NamedTemporaryFile() as tf:
+            tf.write(self.fasta)
+            tf.flush()
+            with open(tf.name) as fp:
+                actual = list(transform.parse_filtered(
+                    fp, 'fasta', filters=self.filters, lazy=True))
+        self.assertRecordsEqual(transform.parse_filtered(
+            StringIO(self.fasta), 'fasta', filters=self.filters), actual)
+
+    def test_pushdown_stops(self):
+        transforms = [
+            functools.partial(transform.min_length_discard, min_length=3),
+            functools.partial(transform.head, head='2'),
+            functools.partial(transform.max_length_discard, max_length=5)]
+        filters, rest = transform.pushdown_filters(transforms)
+        self.assertEqual([transform.min_length_discard],
+                         [s.transform.func for s in filters])
+        self.assertEqual(transforms[1:], rest)
+
+class LazyRecordTestCase(unittest.TestCase):
+
+    fasta = """>s1 first
+ACGTA
+CG
+>s2
+AC GT
+A\r
+>s3
+>s4 fourth
+ACG
+"""
+
+    def setUp(self):
+        self.tf = tempfile.NamedTemporaryFile()
+        self.tf.write(self.fasta)
+        self.tf.flush()
+        self.handle = open(self.tf.name)
+
+    def tearDown(self):
+        self.handle.close()
+        self.tf.close()
+
+    def records(self):
+        return list(transform.parse_filtered(self.handle, 'fasta', lazy=True))
+
+    def test_parse(self):
+        actual = self.records()
+        self.assertTrue(all(isinstance(r, transform._LazyRecord)
+                            for r in actual))
+        self.assertEqual(['ACGTA\nCG\n', 'AC GT\nA\r\n', '', 'ACG\n'],
+                         [r.raw for r in actual])
+        expected = list(SeqIO.parse(StringIO(self.fasta), 'fasta'))
+        self.assertEqual([(r.id, r.name, r.description, str(r.seq), len(r))
+                          for r in expected],
+                         [(r.id, r.name, r.description, str(r.seq), len(r))
+                          for r in actual])
+        # Decoded once accessed
+        self.assertEqual([None] * 4, [r.raw for r in actual])
+
+    def test_supported(self):
+        # Fails if the installed Biopython changes the SeqRecord internals
+        # _LazyRecord overrides; parse_filtered then decodes every sequence
+        self.assertTrue(transform._lazy_records_work())
+        self.assertTrue(transform.LAZY_RECORDS)
+
+    def test_unsupported(self):
+        supported = transform.LAZY_RECORDS
+        transform.LAZY_RECORDS = False
+        try:
+            actual = self.records()
+        finally:
+            transform.LAZY_RECORDS = supported
+        self.assertFalse(any(isinstance(r, transform._LazyRecord)
+                             for r in actual))
+        self.assertEqual(
+            [(r.id, str(r.seq)) for r in SeqIO.parse(StringIO(self.fasta),
+                                                     'fasta')],
+            [(r.id, str(r.seq)) for r in actual])
+
+    def test_unmapped(self):
+        self.assertEqual(
+            [r.id for r in SeqIO.parse(StringIO(self.fasta), 'fasta')],
+            [r.id for r in transform.parse_filtered(
+                StringIO(self.fasta), 'fasta', lazy=True)])
+
+    def test_record_operations(self):
+        record = self.records()[0]
+        record.letter_annotations['x'] = range(7)
+        self.assertEqual('CGT', str(record[1:4].seq))
+        self.assertEqual([1, 2, 3], record[1:4].letter_annotations['x'])
+
+        record = self.records()[3]
+        renamed = transform._first_name(record)
+        self.assertEqual(('s4', '', 'ACG\n'),
+                         (renamed.id, renamed.description, renamed.raw))
+        record.seq = Seq('TT')
+        self.assertEqual(None, record.raw)
+        self.assertEqual('TT', str(record.seq))
+
+    def test_pickle(self):
+        import cPickle as pickle
+        actual = pickle.loads(pickle.dumps(self.records()[0], 2))
+        self.assertEqual(SeqRecord, type(actual))
+        self.assertEqual(('s1', 'ACGTACG'), (actual.id, str(actual.seq)))
+
+    def test_verbatim_writer(self):
+        for wrap in (None, 3, 5, 60):
+            expected = StringIO()
+            SeqIO.FastaIO.FastaWriter(expected, wrap=wrap).write_file(
+                SeqIO.parse(StringIO(self.fasta), 'fasta'))
+            self.handle.seek(0)
+            actual = StringIO()
+            transform.VerbatimFastaWriter(actual, wrap=wrap).write_file(
+                self.records())
+            self.assertEqual(expected.getvalue(), actual.getvalue())
+
+    def test_is_wrapped(self):
+        self.assertTrue(transform._is_wrapped('ACGTA\nCG\n', 5))
+        self.assertTrue(transform._is_wrapped('ACGTA\nCGTTA\n', 5))
+        self.assertFalse(transform._is_wrapped('ACGTA\nCG\n', 4))
+        self.assertFalse(transform._is_wrapped('ACGTA\nCG\n', 6))
+        self.assertFalse(transform._is_wrapped('ACGTA\nCG', 5))
+        self.assertFalse(transform._is_wrapped('ACGTA\r\nCG\r\n', 60))
+        self.assertFalse(transform._is_wrapped('ACGTA\n\nCG\n', 5))
+        self.assertFalse(transform._is_wrapped('', 5))
+        self.assertTrue(transform._is_wrapped('ACGTACG\n', None))
+        self.assertFalse(transform._is_wrapped('ACGTA\nCG\n', None))
+
+class ScanHeadersTestCase(unittest.TestCase):
+
+    fasta = ParseFilteredTestCase.fasta
+
+    fastq = """@s1 first
+ACGT
++
+@III
+@s2
+AC
++s2
+@5
+@t3  third\r
+ACGTAC\r
++\r
+!!!!!!\r
+"""
+
+    # The second record spans several lines
+    multiline = """@s1 first
+ACGT
++
+IIII
+@m2 multi
+AC
+GT
++
+@I
+II
+@t3 third
+ACGTAC
++
+!!!!!!
+"""
+
+    def setUp(self):
+        self.block = transform.HEADER_SCAN_BLOCK
+        self.tf = tempfile.NamedTemporaryFile()
+
+    def tearDown(self):
+        transform.HEADER_SCAN_BLOCK = self.block
+        self.tf.close()
+
+    def _check(self, text, file_format, blocks=None, **kwargs):
+        expected = list(SeqIO.parse(StringIO(text), file_format))
+        for descriptions in (False, True):
+            attribute = 'description' if descriptions else 'id'
+            # Line by line
+            chunks = transform.scan_headers(StringIO(text), file_format,
+                                            descriptions)
+            self.assertEqual(
+                ''.join(getattr(r, attribute) + '\n' for r in expected),
+                ''.join(chunks))
+            # Mapped, with every region size by default
+            self.tf.seek(0)
+            self.tf.truncate()
+            self.tf.write(text)
+            self.tf.flush()
+            for block in blocks or xrange(1, len(text) + 1):
+                transform.HEADER_SCAN_BLOCK = block
+                with open(self.tf.name) as handle:
+                    chunks = list(transform.scan_headers(
+                        handle, file_format, descriptions, **kwargs))
+                self.assertEqual([getattr(r, attribute) for r in expected],
+                                 ''.join(chunks).splitlines())
+
+    def test_fasta(self):
+        self._check(self.fasta, 'fasta')
+
+    def test_fasta_empty_title(self):
+        self.assertEqual('\n\ns2\n', ''.join(transform.scan_headers(
+            StringIO('>\nAC\n> \n>s2\n'), 'fasta')))
+
+    def test_fastq(self):
+        self._check(self.fastq, 'fastq')
+
+    def test_fastq_multiline(self):
+        self._check(self.multiline, 'fastq')
+
+    def test_processes(self):
+        self._check(self.fastq * 3, 'fastq', blocks=(1, 40),
+                    processes=2)
+        self._check(self.multiline * 3, 'fastq', blocks=(1, 40),
+                    processes=2)
+
+    def test_fastq_boundary(self):
+        # Quality lines beginning with @ are not record boundaries
+        self.assertEqual(self.fastq.index('@s2'),
+                         transform._fastq_boundary(self.fastq, 15))
+        self.assertEqual(self.fastq.index('@t3'),
+                         transform._fastq_boundary(self.fastq, 25))
+        self.assertEqual(self.multiline.index('@t3'),
+                         transform._fastq_boundary(self.multiline, 15))
+
+    def test_other_format(self):
+        record = next(SeqIO.parse(StringIO(self.fastq), 'fastq',
+                                  alphabet=Alphabet.generic_dna))
+        text = record.format('genbank')
+        self.assertEqual(['s1\n'], list(transform.scan_headers(
+            StringIO(text), 'genbank')))
+
 # Name Modification functions
 class IdModifyMixin(object):
     """
@@ -608,6 +1572,20 @@ class MultiMaskSequences(unittest.TestCase):
         self.assertEqual(['A-A', 'B-B', 'D-DD', 'E-E'],
                 [str(a.seq) for a in actual])
 
+    def test_mask_overlapping(self):
+        masks = [slice(0, 1), slice(0, 2), slice(3, None)]
+        actual = list(transform.multi_mask_sequences(self.sequences, masks))
+        self.assertEqual(['--A', '--B', '--D-', '--E'],
+                [str(a.seq) for a in actual])
+
+    def test_mask_letter_annotations(self):
+        for record in self.sequences:
+            record.letter_annotations['phred_quality'] = range(len(record))
+        actual = list(transform.multi_mask_sequences(self.sequences,
+                                                     [slice(1, 2)]))
+        self.assertEqual([0, 1, 2, 3],
+                         actual[2].letter_annotations['phred_quality'])
+
 class RecordBufferTestCase(unittest.TestCase):
     def setUp(self):
         self.sequences = [SeqRecord(Seq("AAA"), id="s1"),
@@ -636,6 +1614,107 @@ class RecordBufferTestCase(unittest.TestCase):
             records = list(iter_f())
             self._compare(records)
 
+class RecordIndexTestCase(unittest.TestCase):
+    def _check(self, path):
+        with FileType('r')(path) as fp:
+            with transform.record_index(fp, 'fasta') as index:
+                self.assertEqual(['test1', 'test2', 'test3'], sorted(index))
+                self.assertEqual('test2 test sequence 2',
+                                 index['test2'].description)
+
+    def test_plain(self):
+        self._check(data_path('input2.fasta'))
+
+    def test_gzip(self):
+        self._check(data_path('input2.fasta.gz'))
+
+    def test_bzip2(self):
+        self._check(data_path('input2.fasta.bz2'))
+
+    def test_pipe(self):
+        r, w = os.pipe()
+        with open(data_path('input2.fasta')) as fp:
+            os.write(w, fp.read())
+        os.close(w)
+        with os.fdopen(r) as fp:
+            self.assertRaises(IOError, fp.tell)
+            with transform.record_index(fp, 'fasta') as index:
+                self.assertEqual(['test1', 'test2', 'test3'], sorted(index))
+
+class CoordinateMapTestCase(unittest.TestCase):
+    def setUp(self):
+        self.instance = transform.CoordinateMap('-AC-.TG-')
+
+    def test_to_gapped(self):
+        self.assertEqual(4, len(self.instance))
+        self.assertEqual([1, 2, 5, 6],
+                         [self.instance.to_gapped(i) for i in xrange(4)])
+        self.assertRaises(KeyError, self.instance.to_gapped, 4)
+        self.assertRaises(KeyError, self.instance.to_gapped, -1)
+
+    def test_to_ungapped(self):
+        self.assertEqual([0, 1, 2, 3], [self.instance.to_ungapped(i)
+                                        for i in (1, 2, 5, 6)])
+        for i in (0, 3, 4, 7, 8):
+            self.assertRaises(KeyError, self.instance.to_ungapped, i)
+
+    def test_gap_chars(self):
+        instance = transform.CoordinateMap('-AC-.TG-', '-')
+        self.assertEqual(4, instance.to_gapped(2))
+
+class FindRecordTestCase(unittest.TestCase):
+    def _check(self, path):
+        with FileType('r')(path) as fp:
+            record = transform.find_record(fp, 'fasta', 'test2')
+            self.assertEqual('test2 test sequence 2', record.description)
+            self.assertEqual(3, len(list(SeqIO.parse(fp, 'fasta'))))
+
+    def test_plain(self):
+        self._check(data_path('input2.fasta'))
+
+    def test_gzip(self):
+        self._check(data_path('input2.fasta.gz'))
+
+    def test_bzip2(self):
+        self._check(data_path('input2.fasta.bz2'))
+
+    def test_other_format(self):
+        handle = StringIO('@a\nAC\n+\nII\n@b\nGT\n+\nII\n')
+        record = transform.find_record(handle, 'fastq', 'b')
+        self.assertEqual('GT', str(record.seq))
+        self.assertEqual(0, handle.tell())
+
+    def test_not_found(self):
+        with open(data_path('input2.fasta')) as fp:
+            self.assertRaises(ValueError, transform.find_record, fp, 'fasta',
+                              'missing')
+            self.assertEqual(0, fp.tell())
+
+    def test_unseekable(self):
+        r, w = os.pipe()
+        os.close(w)
+        with os.fdopen(r) as fp:
+            self.assertEqual(None,
+                             transform.find_record(fp, 'fasta', 'test2'))
+
+class CutRelativeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.sequences = [seqrecord('a', 'AC-GT'), seqrecord('ref', '-CG-T'),
+                          seqrecord('b', 'ACGTT')]
+
+    def test_reference(self):
+        slices = [slice(1, 3)]
+        for reference in (None, self.sequences[1]):
+            actual = transform.cut_sequences_relative(
+                self.sequences, slices, 'ref', reference=reference)
+            self.assertEqual(['-GT', 'G-T', 'GTT'],
+                             [str(r.seq) for r in actual])
+            actual = transform.mask_sequences_relative(
+                [r[:] for r in self.sequences], slices, 'ref',
+                reference=reference)
+            self.assertEqual(['AC---', '-C---', 'AC---'],
+                             [str(r.seq) for r in actual])
+
 class DropColumnsTestCase(unittest.TestCase):
     def setUp(self):
         self.sequences = [SeqRecord(Seq("AAA"), id="s1"),
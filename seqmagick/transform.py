@@ -1,28 +1,56 @@
 """
 Functions to transform / filter sequences
 """
+import array
+import bisect
 import collections
 import contextlib
-import copy
 import cPickle as pickle
-import gzip
+import functools
+import hashlib
+import heapq
 import itertools
 import logging
+import math
+import mmap
+import multiprocessing
+import operator
+import os.path
 import re
 import string
+import struct
 import tempfile
 import random
+import shutil
+import sys
+import warnings
+from cStringIO import StringIO
 
-from Bio import SeqIO
+from Bio import Alphabet, BiopythonWarning, SeqIO
 from Bio.Alphabet import IUPAC
-from Bio.Data import CodonTable
+from Bio.Data import CodonTable, IUPACData
 from Bio.Seq import Seq
+from Bio.SeqIO import FastaIO
+from Bio.SeqIO.QualityIO import FastqGeneralIterator, SANGER_SCORE_OFFSET
 from Bio.SeqRecord import SeqRecord
-from Bio.SeqUtils.CheckSum import seguid
+
+try:
+    # Private; used by _LazyRecord if available (see LAZY_RECORDS)
+    from Bio.SeqRecord import _RestrictedDict
+except ImportError:
+    _RestrictedDict = None
 
 # Characters to be treated as gaps
 GAP_CHARS = "-."
 
+# Splits a sequence into complete codons
+_CODONS = re.compile('...', re.DOTALL).findall
+# All overlapping codons in a sequence, one starting at each position
+_OVERLAPPING_CODONS = re.compile('(?=(...))', re.DOTALL).findall
+
+# Reading frames produced by CodonTranslator.translate_frames
+FRAMES = ('+1', '+2', '+3', '-1', '-2', '-3')
+
 # Size of temporary file buffer: default to 256MB
 DEFAULT_BUFFER_SIZE = 268435456  # 256 * 2**20
 
@@ -35,83 +63,529 @@ def _record_buffer(records, buffer_size=DEFAULT_BUFFER_SIZE):
     Value returned by context manager is a function which returns an iterator
     through records.
     """
+    # Records are pickled individually, each preceded by its length, so
+    # neither end keeps a memo of every record, and each record takes two
+    # reads from the (pure Python) SpooledTemporaryFile.
+    length = struct.Struct('<L')
     with tempfile.SpooledTemporaryFile(buffer_size, mode='wb+') as tf:
-        pickler = pickle.Pickler(tf)
         for record in records:
-            pickler.dump(record)
+            data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            tf.write(length.pack(len(data)))
+            tf.write(data)
 
         def record_iter():
             tf.seek(0)
-            unpickler = pickle.Unpickler(tf)
             while True:
-                try:
-                    yield unpickler.load()
-                except EOFError:
+                header = tf.read(length.size)
+                if not header:
                     break
+                yield pickle.loads(tf.read(length.unpack(header)[0]))
 
         yield record_iter
 
 
+@contextlib.contextmanager
+def record_index(handle, file_format):
+    """
+    Context manager indexing the records in ``handle`` by ID with
+    SeqIO.index, which holds only the offset of each record in memory,
+    reading records from the file as they are looked up.
+
+    SeqIO.index requires an uncompressed file on disk: other inputs are first
+    copied to a temporary file, removed on exit.  Seekable inputs are copied
+    from the start; others, such as pipes, from the current position.
+    """
+    path = getattr(handle, 'name', None)
+    if isinstance(handle, file) and path and os.path.isfile(path):
+        yield SeqIO.index(path, file_format)
+    else:
+        with tempfile.NamedTemporaryFile() as tf:
+            try:
+                position = handle.tell()
+            except IOError:
+                position = 0
+            if position:
+                handle.seek(0)
+            shutil.copyfileobj(handle, tf)
+            tf.flush()
+            yield SeqIO.index(tf.name, file_format)
+
+
 def dashes_cleanup(records, prune_chars='.:?~'):
     """
     Take an alignment and convert any undesirable characters such as ? or ~ to
     -.
     """
     logging.info("Applying _dashes_cleanup: converting any . or : to -.")
-    translation_table = string.maketrans(prune_chars, '-' * len(prune_chars))
-    for record in records:
-        record.seq = Seq(str(record.seq).translate(translation_table),
-                         record.seq.alphabet)
-        yield record
+    return map_sequences(records, [_dashes_step(prune_chars)])
 
 
-def deduplicate_sequences(records, out_file):
+class _DigestTable(object):
     """
-    Remove any duplicate records with identical sequences, keep the first
-    instance seen and discard additional occurences.
+    Open-addressing hash table assigning an ordinal (0, 1, ...) to each
+    distinct sequence, identified by its 128-bit MD5 digest.  Slots are kept
+    in a bytearray and an array, so each takes 24 bytes.
+
+    If verify is true, distinct sequences are also written to a temporary
+    file, and compared on matching digests, so that a digest collision cannot
+    merge different sequences.
     """
+    _WIDTH = 16
+    _MAX_LOAD = 0.7
+    _SLOT = struct.Struct('<Q')
+    _hash = hashlib.md5
+
+    def __init__(self, capacity=1 << 16, verify=False):
+        self.count = 0
+        self._allocate(capacity)
+        if verify:
+            self.sequences = tempfile.TemporaryFile()
+            self.offsets = array.array('L', [0])
+        else:
+            self.sequences = None
+
+    def _allocate(self, capacity):
+        self.mask = capacity - 1
+        self.digests = bytearray(capacity * self._WIDTH)
+        # Ordinal + 1 of the sequence in each slot; 0 for empty slots
+        self.values = array.array('L', [0]) * capacity
+
+    def _resize(self):
+        digests, values = self.digests, self.values
+        self._allocate(len(values) * 2)
+        width, mask, slot_of = self._WIDTH, self.mask, self._SLOT.unpack_from
+        new_digests, new_values = self.digests, self.values
+        for i in itertools.compress(xrange(len(values)), values):
+            digest = digests[i * width:(i + 1) * width]
+            slot = slot_of(buffer(digest))[0] & mask
+            while new_values[slot]:
+                slot = (slot + 1) & mask
+            new_digests[slot * width:(slot + 1) * width] = digest
+            new_values[slot] = values[i]
+
+    def _sequence(self, ordinal):
+        start, end = self.offsets[ordinal], self.offsets[ordinal + 1]
+        self.sequences.seek(start)
+        return self.sequences.read(end - start)
+
+    def add(self, sequence):
+        """
+        Add sequence, returning a tuple of its ordinal, and whether it is new
+        """
+        digest = self._hash(sequence).digest()
+        digests, values, mask = self.digests, self.values, self.mask
+        width = self._WIDTH
+        slot = self._SLOT.unpack_from(digest)[0] & mask
+        while values[slot]:
+            start = slot * width
+            if digests[start:start + width] == digest:
+                ordinal = values[slot] - 1
+                if (self.sequences is None or
+                        self._sequence(ordinal) == sequence):
+                    return ordinal, False
+            slot = (slot + 1) & mask
+
+        ordinal = self.count
+        digests[slot * width:(slot + 1) * width] = digest
+        values[slot] = ordinal + 1
+        self.count += 1
+        if self.sequences is not None:
+            self.sequences.seek(self.offsets[-1])
+            self.sequences.write(sequence)
+            self.offsets.append(self.offsets[-1] + len(sequence))
+        if self.count > self._MAX_LOAD * len(values):
+            self._resize()
+        return ordinal, True
+
+    def close(self):
+        if self.sequences is not None:
+            self.sequences.close()
+
+
+class _GroupSpill(object):
+    """
+    Collects the record IDs of each group of duplicate sequences, identified
+    by ordinal, in temporary files; ``write`` then writes each group as a
+    space-separated line.  Groups are spread across files by ordinal, so only
+    one file's worth is held in memory at a time.  With ``sizes``, each line
+    is preceded by the size of the group and a tab.
+    """
+
+    def __init__(self, buckets=64):
+        self.files = [tempfile.TemporaryFile() for _ in xrange(buckets)]
+
+    def add(self, ordinal, record_id):
+        f = self.files[ordinal % len(self.files)]
+        f.write('{0}\t{1}\n'.format(ordinal, record_id))
+
+    def write(self, out_file, sizes=False):
+        for f in self.files:
+            f.seek(0)
+            groups = collections.defaultdict(list)
+            for line in f:
+                ordinal, record_id = line.rstrip('\n').split('\t', 1)
+                groups[int(ordinal)].append(record_id)
+            for ordinal in sorted(groups):
+                group = groups[ordinal]
+                if sizes:
+                    out_file.write('%d\t' % len(group))
+                out_file.write('%s\n' % (' '.join(group),))
+            f.close()
+
+
+def _read_ordinals(path, chunk_size=8192):
+    """
+    Iterate over the ordinals in an array('L') saved at path
+    """
+    with open(path, 'rb') as fp:
+        while True:
+            ordinals = array.array('L')
+            try:
+                ordinals.fromfile(fp, chunk_size)
+            except EOFError:
+                # Partial final chunk
+                for ordinal in ordinals:
+                    yield ordinal
+                break
+            for ordinal in ordinals:
+                yield ordinal
+
+
+def _deduplicate_shard(path, groups=False):
+    """
+    Deduplicate a shard written by _external_deduplicate: lines of key,
+    record ordinal and ID, in ordinal order.
+
+    Writes the ordinal of the first record with each key to path + '.first',
+    in order.  If groups is true, also writes the IDs of the records with
+    each key, one key per line, to path + '.groups'.
+    """
+    # key -> [first ordinal, IDs...]
+    seen = {}
+    with open(path) as fp:
+        for line in fp:
+            key, ordinal, record_id = line.rstrip('\n').split('\t')
+            group = seen.get(key)
+            if group is None:
+                seen[key] = group = [int(ordinal)]
+            if groups:
+                group.append(record_id)
+    ordered = sorted(seen.itervalues())
+    with open(path + '.first', 'wb') as fp:
+        array.array('L', (group[0] for group in ordered)).tofile(fp)
+    if groups:
+        with open(path + '.groups', 'w') as fp:
+            for group in ordered:
+                fp.write('%s\n' % (' '.join(group[1:]),))
+
+
+def _external_deduplicate(records, key, shards, processes=1, out_file=None):
+    """
+    Remove records with the same key(record) as an earlier record, using
+    disk rather than memory.
+
+    Records are buffered to disk, while their keys are partitioned into
+    ``shards`` files by hash.  Each shard is then deduplicated independently
+    (in ``processes`` processes, if more than one), so holds only ~1/shards of
+    the distinct keys in memory, and the records first seen with each key are
+    yielded in input order by merging the shards' ordinals.  If out_file is
+    given, groups of IDs sharing a key are written to it, as in
+    deduplicate_sequences.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix='seqmagick-dedup-')
+    paths = [os.path.join(tmp_dir, str(i)) for i in xrange(shards)]
+
+    def partition(records):
+        """Write the key of each record to its shard, while buffering."""
+        files = [open(path, 'w') for path in paths]
+        try:
+            for ordinal, record in enumerate(records):
+                k = key(record)
+                digest = hashlib.md5(k).digest()
+                shard = struct.unpack_from('<L', digest)[0] % shards
+                files[shard].write('{0}\t{1}\t{2}\n'.format(
+                    k, ordinal, record.id))
+                yield record
+        finally:
+            for f in files:
+                f.close()
+
+    try:
+        with _record_buffer(partition(records)) as buffered:
+            worker = functools.partial(_deduplicate_shard,
+                                       groups=out_file is not None)
+            if processes > 1:
+                pool = multiprocessing.Pool(processes)
+                try:
+                    pool.map(worker, paths)
+                finally:
+                    pool.terminate()
+            else:
+                map(worker, paths)
+
+            first = heapq.merge(*[_read_ordinals(path + '.first')
+                                  for path in paths])
+            next_first = next(first, None)
+            for ordinal, record in enumerate(buffered()):
+                if ordinal == next_first:
+                    yield record
+                    next_first = next(first, None)
+
+        if out_file is not None:
+            with out_file:
+                for path in paths:
+                    with open(path + '.groups') as fp:
+                        shutil.copyfileobj(fp, out_file)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+DEDUPLICATE_MODES = ('exact', 'prefix', 'substring')
+
+
+def deduplicate_sequences(records, out_file, verify=False, shards=None,
+                          processes=1, mode='exact'):
+    """
+    Remove any duplicate records with identical sequences (ignoring case),
+    keep the first instance seen and discard additional occurences.
+
+    Sequences are compared by 128-bit MD5 digest, or, if verify is true,
+    exactly.  If out_file is given, the IDs of each group of records with
+    identical sequences are written to it, one group per line.
+
+    If shards is given, deduplicate on disk, in that many shards; see
+    _external_deduplicate.
+
+    With mode 'prefix' or 'substring', records are instead dereplicated: any
+    sequence which is a prefix (or substring) of a longer one is also
+    collapsed into it; see _dereplicate_sequences.
+    """
+    if mode not in DEDUPLICATE_MODES:
+        raise ValueError("Unknown deduplication mode: {0}".format(mode))
+    if mode != 'exact':
+        if shards:
+            raise ValueError("Sharded deduplication supports only exact "
+                             "matches")
+        logging.info('Applying _dereplicate_sequences generator: '
+                     'collapsing sequences into longer sequences containing '
+                     'them as a %s.', mode)
+        return _dereplicate_sequences(records, out_file,
+                                      substring=mode == 'substring')
 
     logging.info('Applying _deduplicate_sequences generator: '
                  'removing any duplicate records with identical sequences.')
-    checksum_sequences = collections.defaultdict(list)
-    for record in records:
-        checksum = seguid(record.seq)
-        sequences = checksum_sequences[checksum]
-        if not sequences:
+    if shards:
+        if verify:
+            key = lambda record: str(record.seq).upper()
+        else:
+            key = lambda record: hashlib.md5(
+                str(record.seq).upper()).hexdigest()
+        return _external_deduplicate(records, key, shards, processes,
+                                     out_file)
+    return _deduplicate_sequences(records, out_file, verify)
+
+
+def _deduplicate_sequences(records, out_file, verify):
+    table = _DigestTable(verify=verify)
+    spill = _GroupSpill() if out_file is not None else None
+    try:
+        for record in records:
+            ordinal, new = table.add(str(record.seq).upper())
+            if new:
+                yield record
+            if spill is not None:
+                spill.add(ordinal, record.id)
+    finally:
+        table.close()
+
+    if spill is not None:
+        with out_file:
+            spill.write(out_file)
+
+
+def _dereplicate_prefixes(sequences):
+    """
+    Map each of the distinct ``sequences`` to the index of a sequence of which
+    it is a prefix, and which is not itself a prefix of any other.
+
+    In sorted order, a sequence which is a prefix of any other is a prefix of
+    the next, so one pass back through the sorted sequences suffices.  A
+    prefix of several such sequences is mapped to the first in sorted order.
+    """
+    order = sorted(xrange(len(sequences)), key=sequences.__getitem__)
+    representatives = array.array('L', xrange(len(sequences)))
+    for i in xrange(len(order) - 2, -1, -1):
+        u, v = order[i], order[i + 1]
+        if sequences[v].startswith(sequences[u]):
+            representatives[u] = representatives[v]
+    return representatives
+
+
+def _dereplicate_substrings(sequences, k=32):
+    """
+    Map each of the distinct ``sequences`` to the index of a sequence which
+    contains it, and which is not itself contained in any other.
+
+    Each sequence is bucketed by its middle k-mer (or whole sequence, if
+    shorter).  Sequences are then taken longest first: those not already
+    contained in a longer sequence are representatives, and their k-mers are
+    looked up among the buckets, each candidate being verified by a substring
+    search.  Anything contained in a sequence is also contained in that
+    sequence's representative, so only representatives need to be scanned.
+    """
+    buckets = collections.defaultdict(list)
+    for u, sequence in enumerate(sequences):
+        start = max(0, (len(sequence) - k) // 2)
+        buckets[sequence[start:start + k]].append(u)
+    keys = set(buckets)
+    key_lengths = sorted(set(itertools.imap(len, keys)))
+
+    representatives = array.array('L', xrange(len(sequences)))
+    assigned = bytearray(len(sequences))
+    order = sorted(xrange(len(sequences)), key=lambda u: -len(sequences[u]))
+    for t in order:
+        if assigned[t]:
+            continue
+        assigned[t] = 1
+        sequence = sequences[t]
+        for length in key_lengths:
+            if length > len(sequence):
+                break
+            kmers = set(itertools.imap(
+                operator.getslice, itertools.repeat(sequence),
+                xrange(len(sequence) - length + 1),
+                xrange(length, len(sequence) + 1)))
+            for key in kmers & keys:
+                remaining = []
+                for u in buckets[key]:
+                    if assigned[u]:
+                        continue
+                    if (len(sequences[u]) < len(sequence) and
+                            sequences[u] in sequence):
+                        representatives[u] = t
+                        assigned[u] = 1
+                    else:
+                        remaining.append(u)
+                if remaining:
+                    buckets[key] = remaining
+                else:
+                    del buckets[key]
+                    keys.discard(key)
+    return representatives
+
+
+def _dereplicate_sequences(records, out_file, substring=False):
+    """
+    Collapse records whose sequence (ignoring case) is a prefix, or with
+    ``substring`` any substring, of a longer sequence into it, yielding the
+    first record with each remaining sequence, in input order.
+
+    Only the distinct sequences are held in memory: records are buffered to
+    disk.  If out_file is given, each cluster is written to it as its size, a
+    tab, and the IDs of its records.
+    """
+    sequences = []
+    distinct = {}
+    sequence_indexes = array.array('L')
+
+    def collect(records):
+        for record in records:
+            sequence = str(record.seq).upper()
+            u = distinct.setdefault(sequence, len(sequences))
+            if u == len(sequences):
+                sequences.append(sequence)
+            sequence_indexes.append(u)
             yield record
-        sequences.append(record.id)
 
-    if out_file is not None:
+    with _record_buffer(collect(records)) as buffered:
+        distinct.clear()
+        if substring:
+            representatives = _dereplicate_substrings(sequences)
+        else:
+            representatives = _dereplicate_prefixes(sequences)
+        del sequences[:]
+
+        spill = _GroupSpill() if out_file is not None else None
+        seen = bytearray(len(representatives))
+        for record, u in itertools.izip(buffered(), sequence_indexes):
+            representative = representatives[u]
+            if representative == u and not seen[u]:
+                seen[u] = 1
+                yield record
+            if spill is not None:
+                spill.add(representative, record.id)
+
+    if spill is not None:
         with out_file:
-            for sequences in checksum_sequences.itervalues():
-                out_file.write('%s\n' % (' '.join(sequences),))
+            spill.write(out_file, sizes=True)
+
+
+def _taxon(record):
+    """
+    Taxon of a record for deduplicate_taxa: the full ID, or the integer before
+    the first | if present.
+    """
+    # Default to full ID, split if | is found.
+    taxid = record.id
+    if '|' in record.id:
+        try:
+            taxid = int(record.id.split("|")[0])
+        except:
+            # If we couldn't parse an integer from the ID, just fall back
+            # on the ID
+            logging.warn("Unable to parse integer taxid from %s",
+                    taxid)
+    return taxid
 
 
-def deduplicate_taxa(records):
+def deduplicate_taxa(records, shards=None, processes=1):
     """
     Remove any duplicate records with identical IDs, keep the first
     instance seen and discard additional occurences.
+
+    If shards is given, deduplicate on disk, in that many shards; see
+    _external_deduplicate.
     """
     logging.info('Applying _deduplicate_taxa generator: ' + \
                  'removing any duplicate records with identical IDs.')
+    if shards:
+        key = lambda record: repr(_taxon(record))
+        return _external_deduplicate(records, key, shards, processes)
+    return _deduplicate_taxa(records)
+
+
+def _deduplicate_taxa(records):
     taxa = set()
     for record in records:
-        # Default to full ID, split if | is found.
-        taxid = record.id
-        if '|' in record.id:
-            try:
-                taxid = int(record.id.split("|")[0])
-            except:
-                # If we couldn't parse an integer from the ID, just fall back
-                # on the ID
-                logging.warn("Unable to parse integer taxid from %s",
-                        taxid)
+        taxid = _taxon(record)
         if taxid in taxa:
             continue
         taxa.add(taxid)
         yield record
 
 
+_WHITESPACE = re.compile(r'\s+')
+
+
+def _with_header(record, record_id, description):
+    """
+    New record with the sequence of record, and only the given ID and
+    description.  The sequence of a _LazyRecord is not decoded.
+    """
+    if isinstance(record, _LazyRecord):
+        return record.with_header(record_id, description)
+    return SeqRecord(record.seq, id=record_id, description=description)
+
+
+def _first_name(record):
+    """
+    Record with its description removed, if it contains whitespace
+    """
+    if _WHITESPACE.search(record.description):
+        return _with_header(record, record.id, "")
+    return record
+
+
 def first_name_capture(records):
     """
     Take only the first whitespace-delimited word as the name of the sequence.
@@ -120,37 +594,276 @@ def first_name_capture(records):
     logging.info('Applying _first_name_capture generator: '
                  'making sure ID only contains the first whitespace-delimited '
                  'word.')
-    whitespace = re.compile(r'\s+')
     for record in records:
-        if whitespace.search(record.description):
-            yield SeqRecord(record.seq, id=record.id,
-                            description="")
+        yield _first_name(record)
+
+
+def _read_lines(handle):
+    """
+    Iterator over the stripped, non-blank lines of handle
+    """
+    return itertools.ifilter(None, itertools.imap(str.strip, handle))
+
+
+class CompactIdSet(object):
+    """
+    Read-only set of IDs, storing a 64-bit fingerprint (from MD5) of each:
+    about 6.5 bytes per ID.
+
+    Fingerprints are sorted, and indexed by their leading bits into buckets
+    of ~8 on average, so a lookup is a search of one short block. With 100M
+    IDs, the chance of a given ID outside the set matching a fingerprint is
+    ~5e-12.
+
+    Sets can be saved to a file with ``save``; ``load`` memory-maps saved sets
+    where possible, so a set can be reused (and shared between processes)
+    without reading it in.
+    """
+    MAGIC = 'seqmagick-compact-id-set-1\n'
+    # Fingerprint bytes stored; the first two are also implied by the
+    # bucket, but are kept so entries are found at any index size.
+    _WIDTH = 6
+    _HEADER = struct.Struct('>B')
+    _BUCKET = struct.Struct('>I')
+
+    def __init__(self, bits, index, data, offset=0):
+        """
+        Fingerprints are bucketed by their first ``bits`` bits; ``index``
+        gives the number of fingerprints in preceding buckets, for each bucket
+        and one past the last. ``data`` holds bytes 2-7 of each fingerprint
+        in sorted order, starting at ``offset``.
+        """
+        self.bits = bits
+        self.index = index
+        self.data = data
+        self.offset = offset
+        self._shift = 32 - bits
+
+    @classmethod
+    def from_ids(cls, ids):
+        # Group by the first 16 bits, to sort in small pieces
+        groups = [bytearray() for _ in xrange(1 << 16)]
+        md5 = hashlib.md5
+        for i in ids:
+            digest = md5(i).digest()
+            groups[(ord(digest[0]) << 8) | ord(digest[1])] += digest[2:8]
+
+        width = cls._WIDTH
+        count = sum(itertools.imap(len, groups)) // width
+        bits = max(16, min(32, (count >> 3).bit_length()))
+        # Keys starting each bucket within a group
+        extra = bits - 16
+        bounds = [struct.pack('>H', b << (16 - extra))
+                  for b in xrange(1 << extra)]
+
+        index = array.array('I')
+        pieces = []
+        total = 0
+        for g, group in enumerate(groups):
+            group = str(group)
+            keys = sorted(frozenset(group[i:i + width]
+                                    for i in xrange(0, len(group), width)))
+            index.extend(total + bisect.bisect_left(keys, b) for b in bounds)
+            pieces.append(''.join(keys))
+            total += len(keys)
+            groups[g] = None
+        index.append(total)
+        return cls(bits, index, ''.join(pieces))
+
+    @classmethod
+    def load(cls, handle):
+        """
+        Load a set saved with ``save`` from handle, positioned after MAGIC.
+        """
+        bits, = cls._HEADER.unpack(handle.read(cls._HEADER.size))
+        index = array.array('I')
+        index_size = ((1 << bits) + 1) * index.itemsize
+        offset = len(cls.MAGIC) + cls._HEADER.size + index_size
+        path = getattr(handle, 'name', None)
+        if isinstance(handle, file) and path and os.path.isfile(path):
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+            index.fromstring(data[offset - index_size:offset])
         else:
-            yield record
+            index.fromstring(handle.read(index_size))
+            data, offset = handle.read(), 0
+        if sys.byteorder == 'little':
+            index.byteswap()
+        return cls(bits, index, data, offset)
+
+    def save(self, handle):
+        handle.write(self.MAGIC)
+        handle.write(self._HEADER.pack(self.bits))
+        index = array.array('I', self.index)
+        if sys.byteorder == 'little':
+            index.byteswap()
+        handle.write(index.tostring())
+        start = self.offset
+        handle.write(self.data[start:start + len(self) * self._WIDTH])
+
+    def __len__(self):
+        return self.index[-1]
+
+    def __contains__(self, record_id):
+        digest = hashlib.md5(record_id).digest()
+        bucket = self._BUCKET.unpack(digest[:4])[0] >> self._shift
+        width = self._WIDTH
+        start = self.offset + self.index[bucket] * width
+        block = self.data[start:self.offset + self.index[bucket + 1] * width]
+        key = digest[2:8]
+        i = block.find(key)
+        # Only matches aligned to an entry count
+        while i > 0 and i % width:
+            i = block.find(key, i + 1)
+        return i >= 0
+
+
+def _read_ids(handle, compact=False):
+    """
+    Arguments for IdSelector selecting the IDs listed in handle: either one
+    per line, or a CompactIdSet saved with CompactIdSet.save (detected from
+    its first line). If compact is true, IDs listed one per line are also
+    loaded as a CompactIdSet.
+    """
+    first = handle.readline()
+    if first == CompactIdSet.MAGIC:
+        return {'id_sets': [CompactIdSet.load(handle)]}
+    lines = _read_lines(itertools.chain([first], handle))
+    if compact:
+        return {'id_sets': [CompactIdSet.from_ids(lines)]}
+    return {'ids': lines}
+
+
+def _combine_patterns(patterns):
+    """
+    Compile patterns into as few regular expressions as possible, such that
+    some regex matches a string iff one of the patterns does.
+
+    Patterns without groups or flags are joined into a single alternation;
+    the remainder (where flags would apply to, or group numbers shift across,
+    the whole alternation) are compiled individually.
+    """
+    simple, result = [], []
+    for pattern in patterns:
+        regex = re.compile(pattern)
+        if regex.groups or regex.flags:
+            result.append(regex)
+        else:
+            simple.append(pattern)
+    if len(simple) == 1:
+        result.insert(0, re.compile(simple[0]))
+    elif simple:
+        result.insert(0, re.compile(
+            '|'.join('(?:{0})'.format(p) for p in simple)))
+    return result
 
 
-def include_from_file(records, handle):
+class IdSelector(object):
     """
-    Filter the records, keeping only sequences whose ID is contained in the
-    handle.
+    Matches records with an ID among ``ids`` or in any of the containers
+    ``id_sets`` (e.g. a CompactIdSet), an ID starting with any of
+    ``prefixes``, or an ID or description matching (per re.search) any of
+    ``patterns``.
     """
-    ids = set(i.strip() for i in handle)
 
+    def __init__(self, ids=(), prefixes=(), patterns=(), id_sets=()):
+        self.ids = frozenset(ids)
+        self.id_sets = list(id_sets)
+        # Prefixes are grouped by length, so each length takes one set lookup
+        by_length = collections.defaultdict(set)
+        for prefix in prefixes:
+            by_length[len(prefix)].add(prefix)
+        self.prefixes = sorted((length, frozenset(p))
+                               for length, p in by_length.items())
+        self.patterns = _combine_patterns(patterns)
+
+    def __call__(self, record):
+        record_id = record.id
+        if record_id in self.ids:
+            return True
+        for id_set in self.id_sets:
+            if record_id in id_set:
+                return True
+        for length, prefixes in self.prefixes:
+            if record_id[:length] in prefixes:
+                return True
+        for regex in self.patterns:
+            if regex.search(record_id) or regex.search(record.description):
+                return True
+        return False
+
+
+def select_ids(records, includes=(), exclude=None):
+    """
+    Filter the records, keeping only those matched by every IdSelector in
+    includes, and not by the IdSelector exclude, if given.
+    """
+    keep = _id_filter(includes, exclude)
     for record in records:
-        if record.id.strip() in ids:
+        if keep(record):
             yield record
 
 
-def exclude_from_file(records, handle):
+def _id_filter(includes=(), exclude=None):
+    """
+    Function of a record testing whether select_ids would keep it
+    """
+    includes = tuple(includes)
+    def keep(record):
+        if exclude is not None and exclude(record):
+            return False
+        return all(selector(record) for selector in includes)
+    return keep
+
+
+def include_from_file(records, handle, compact=False):
+    """
+    Filter the records, keeping only sequences whose ID is contained in the
+    handle.  See _read_ids for the handle format and compact.
+    """
+    return select_ids(records, [IdSelector(**_read_ids(handle, compact))])
+
+
+def exclude_from_file(records, handle, compact=False):
     """
     Filter the records, keeping only sequences whose ID is not contained in the
-    handle.
+    handle.  See _read_ids for the handle format and compact.
     """
-    ids = set(i.strip() for i in handle)
+    return select_ids(records,
+                      exclude=IdSelector(**_read_ids(handle, compact)))
 
-    for record in records:
-        if record.id.strip() not in ids:
-            yield record
+
+def include_prefixes_from_file(records, handle):
+    """
+    Filter the records, keeping only sequences whose ID starts with one of the
+    prefixes in the handle.
+    """
+    return select_ids(records, [IdSelector(prefixes=_read_lines(handle))])
+
+
+def exclude_prefixes_from_file(records, handle):
+    """
+    Filter the records, keeping only sequences whose ID does not start with
+    any of the prefixes in the handle.
+    """
+    return select_ids(records,
+                      exclude=IdSelector(prefixes=_read_lines(handle)))
+
+
+def include_patterns_from_file(records, handle):
+    """
+    Filter the records, keeping only sequences whose ID or description matches
+    one of the regular expressions in the handle.
+    """
+    return select_ids(records, [IdSelector(patterns=_read_lines(handle))])
+
+
+def exclude_patterns_from_file(records, handle):
+    """
+    Filter the records, keeping only sequences whose ID and description match
+    none of the regular expressions in the handle.
+    """
+    return select_ids(records,
+                      exclude=IdSelector(patterns=_read_lines(handle)))
 
 
 def isolate_region(sequences, start, end, gap_char='-'):
@@ -179,37 +892,180 @@ def _cut_sequences(records, cut_slice):
     for record in records:
         yield record[cut_slice]
 
+class _ColumnPlan(object):
+    """
+    A chain of column selection steps: ``('cut', slices)``, ``('drop',
+    slices)`` or ``('squeeze', gap_threshold)``, compiled for a sequence
+    length into the list of original columns kept, and runs of consecutive
+    columns.
+
+    Without a squeeze step, compiled plans are cached by length.  A squeeze
+    step depends on the whole alignment, so requires the gap proportion of
+    each original column.
+    """
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self.squeezes = any(kind == 'squeeze' for kind, _ in self.steps)
+        self._compiled = {}
+
+    def compile(self, length, gap_proportions=None):
+        """
+        Returns (columns, runs) for sequences of ``length``
+        """
+        try:
+            return self._compiled[length]
+        except KeyError:
+            pass
+
+        columns = range(length)
+        for kind, arg in self.steps:
+            if kind == 'cut':
+                columns = [c for s in arg for c in columns[s]]
+            elif kind == 'drop':
+                drop = set()
+                for s in arg:
+                    drop.update(xrange(*s.indices(len(columns))))
+                columns = [c for i, c in enumerate(columns) if i not in drop]
+            elif kind == 'squeeze':
+                columns = [c for c in columns if gap_proportions[c] < arg]
+            else:
+                raise ValueError("Unknown column step: {0}".format(kind))
+
+        result = columns, _column_runs(columns)
+        if not self.squeezes:
+            self._compiled[length] = result
+        return result
+
+
+def _project_record(record, runs):
+    """
+    Concatenate the runs of columns of ``record``, as for concatenating
+    ``record[start:stop]`` for each run, but in one pass.
+    """
+    if len(runs) == 1:
+        start, stop = runs[0]
+        return record[start:stop]
+    elif not runs:
+        return record[0:0]
+    elif record.features:
+        # Let SeqRecord shift any features
+        return reduce(lambda x, y: x + y,
+                      (record[start:stop] for start, stop in runs))
+
+    def join(value):
+        pieces = [value[start:stop] for start, stop in runs]
+        if isinstance(value, basestring):
+            return ''.join(pieces)
+        return type(value)(itertools.chain.from_iterable(pieces))
+
+    letter_annotations = dict((k, join(v)) for k, v in
+                              record.letter_annotations.iteritems())
+    return SeqRecord(Seq(join(str(record.seq)), record.seq.alphabet),
+                     id=record.id, name=record.name,
+                     description=record.description,
+                     letter_annotations=letter_annotations)
+
+
+def select_columns(records, plan):
+    """
+    Keep the columns of each record selected by ``plan``, a _ColumnPlan.
+
+    Records are projected one at a time, with the plan compiled once for
+    each distinct length; a plan which squeezes projects the whole alignment
+    at once (see squeeze), after any steps before the first squeeze are
+    applied to each record.
+    """
+    if plan.squeezes:
+        first = next(i for i, (kind, _) in enumerate(plan.steps)
+                     if kind == 'squeeze')
+        if first:
+            leading = _ColumnPlan(plan.steps[:first])
+            records = (_project_columns(record, leading)
+                       for record in records)
+            plan = _ColumnPlan(plan.steps[first:])
+        with _AlignmentMatrix.from_records(records) as matrix:
+            columns, _ = plan.compile(matrix.length, _gap_proportion(matrix))
+            for record in matrix.records(columns):
+                yield record
+    else:
+        for record in records:
+            yield _project_columns(record, plan)
+
+
+def _project_columns(record, plan):
+    """
+    Keep the columns of a single record selected by ``plan``, which must not
+    squeeze
+    """
+    _, runs = plan.compile(len(record))
+    return _project_record(record, runs)
+
+
 def drop_columns(records, slices):
     """
     Drop all columns present in ``slices`` from records
     """
-    for record in records:
-        # Generate a set of indices to remove
-        drop = set(i for slice in slices
-                   for i in range(*slice.indices(len(record))))
-        keep = [i not in drop for i in xrange(len(record))]
-        record.seq = Seq(''.join(itertools.compress(record.seq, keep)), record.seq.alphabet)
-        yield record
+    return select_columns(records, _ColumnPlan([('drop', slices)]))
 
 def multi_cut_sequences(records, slices):
-    # If only a single slice is specified, use _cut_sequences,
-    # since this preserves per-letter annotations
-    if len(slices) == 1:
-        for sequence in _cut_sequences(records, slices[0]):
-            yield sequence
-    else:
-        # For multiple slices, concatenate the slice results
-        for record in records:
-            pieces = (record[s] for s in slices)
-            # SeqRecords support addition as concatenation
-            yield reduce(lambda x, y: x + y, pieces)
+    """
+    Keep only the columns in ``slices``, concatenated.  Per-letter
+    annotations are preserved.
+    """
+    return select_columns(records, _ColumnPlan([('cut', slices)]))
+
+class CoordinateMap(object):
+    """
+    Maps between indexes in a gapped sequence and the same sequence without
+    gaps.
+
+    The gapped index of each non-gap character is held in an array, built in
+    a single pass; ungapped indexes are mapped to gapped by indexing it, and
+    gapped to ungapped by binary search.  Indexes with no counterpart raise
+    KeyError.
+
+    >>> m = CoordinateMap('AC-TG-')
+    >>> m.to_gapped(2), m.to_ungapped(4)
+    (3, 3)
+    """
+    _masks = {}
+
+    def __init__(self, sequence, gap_chars=GAP_CHARS):
+        sequence = str(sequence)
+        try:
+            mask = self._masks[gap_chars]
+        except KeyError:
+            mask = self._masks[gap_chars] = ''.join(
+                '\x00' if chr(i) in gap_chars else '\x01' for i in xrange(256))
+        self.gapped = array.array('l', itertools.compress(
+            xrange(len(sequence)), bytearray(sequence.translate(mask))))
+
+    def __len__(self):
+        return len(self.gapped)
+
+    def to_gapped(self, index):
+        """
+        Index in the gapped sequence of the character at ungapped ``index``
+        """
+        if not 0 <= index < len(self.gapped):
+            raise KeyError(index)
+        return self.gapped[index]
+
+    def to_ungapped(self, index):
+        """
+        Index in the ungapped sequence of the (non-gap) character at gapped
+        ``index``
+        """
+        i = bisect.bisect_left(self.gapped, index)
+        if i == len(self.gapped) or self.gapped[i] != index:
+            raise KeyError(index)
+        return i
+
 
 def _update_slices(record, slices):
-    n = itertools.count().next
-    # Generate a map from indexes in the specified sequence to those in the
-    # alignment
-    ungap_map = dict((n(), i) for i, base in enumerate(str(record.seq))
-                     if base not in GAP_CHARS)
+    # Map from indexes in the specified sequence to those in the alignment
+    coordinates = CoordinateMap(record.seq)
     def update_slice(s):
         """
         Maps a slice relative to ungapped record_id to a slice valid for the
@@ -218,7 +1074,7 @@ def _update_slices(record, slices):
         start, end = s.start, s.stop
         if start is not None:
             try:
-                start = ungap_map[start]
+                start = coordinates.to_gapped(start)
             except KeyError:
                 raise KeyError("""No index {0} in {1}.""".format(
                     start, record.id))
@@ -227,7 +1083,7 @@ def _update_slices(record, slices):
             # at end, otherwise insertions between end-1 and end will be
             # included.
             try:
-                end = ungap_map[end - 1] + 1
+                end = coordinates.to_gapped(end - 1) + 1
             except KeyError:
                 logging.warn("""No index %d in %s. Keeping columns to end
                     of alignment.""", end, record.id)
@@ -237,10 +1093,63 @@ def _update_slices(record, slices):
 
     return [update_slice(s) for s in slices]
 
-def cut_sequences_relative(records, slices, record_id):
+def _scan_fasta(handle, record_id):
     """
-    Cuts records to slices, indexed by non-gap positions in record_id
+    Find the record with ``record_id`` in a FASTA file, checking only header
+    lines until it is found.
+    """
+    lines = iter(handle)
+    for line in lines:
+        if line.startswith('>') and line[1:].split(None, 1)[:1] == [record_id]:
+            record_lines = [line]
+            for line in lines:
+                if line.startswith('>'):
+                    break
+                record_lines.append(line)
+            return SeqIO.read(StringIO(''.join(record_lines)), 'fasta')
+
+
+def find_record(handle, file_format, record_id):
+    """
+    Find the record with ``record_id`` in ``handle``, without spooling the
+    file, then rewind ``handle``.  FASTA files are scanned header by header;
+    other formats are parsed up to the record.
+
+    Returns None if ``handle`` is not seekable (e.g. piped standard input);
+    raises a ValueError if no record has the ID.
+    """
+    try:
+        start = handle.tell()
+        handle.seek(start)
+    except (AttributeError, IOError):
+        return None
+
+    try:
+        if file_format == 'fasta':
+            record = _scan_fasta(handle, record_id)
+        else:
+            record = next((r for r in SeqIO.parse(handle, file_format)
+                           if r.id == record_id), None)
+    finally:
+        handle.seek(start)
+
+    if record is None:
+        raise ValueError("Record with id {0} not found.".format(record_id))
+    return record
+
+
+def _relative(records, slices, record_id, reference, apply_slices):
     """
+    Apply ``apply_slices`` with slices indexed by the non-gap positions of
+    ``reference``, or, if None, the record with ``record_id``, found by
+    buffering records.
+    """
+    if reference is not None:
+        for record in apply_slices(records,
+                                   _update_slices(reference, slices)):
+            yield record
+        return
+
     with _record_buffer(records) as r:
         try:
             record = next(i for i in r() if i.id == record_id)
@@ -248,32 +1157,313 @@ def cut_sequences_relative(records, slices, record_id):
             raise ValueError("Record with id {0} not found.".format(record_id))
 
         new_slices = _update_slices(record, slices)
-        for record in multi_cut_sequences(r(), new_slices):
+        for record in apply_slices(r(), new_slices):
             yield record
 
+def cut_sequences_relative(records, slices, record_id, reference=None):
+    """
+    Cuts records to slices, indexed by non-gap positions in record_id
+
+    If ``reference``, the record with record_id, is given (see find_record),
+    records are cut in a single pass.
+    """
+    return _relative(records, slices, record_id, reference,
+                     multi_cut_sequences)
+
+def _mask_runs(slices, length):
+    """
+    Runs of columns of a sequence of ``length`` covered by any of ``slices``
+    """
+    masked = set()
+    for s in slices:
+        masked.update(xrange(*s.indices(length)))
+    return _column_runs(sorted(masked))
+
 def multi_mask_sequences(records, slices):
     """
     Replace characters sliced by slices with gap characters.
+
+    The masked runs are computed once for each distinct sequence length, then
+    written over a copy of each sequence by slice assignment.  Per-letter
+    annotations are preserved.
     """
+    mask = _masker(slices)
     for record in records:
-        record_indices = range(len(record))
-        keep_indices = reduce(lambda i, s: i - frozenset(record_indices[s]),
-                              slices, frozenset(record_indices))
-        seq = ''.join(b if i in keep_indices else '-'
-                      for i, b in enumerate(str(record.seq)))
-        record.seq = Seq(seq)
-        yield record
+        yield mask(record)
 
-def mask_sequences_relative(records, slices, record_id):
-    with _record_buffer(records) as r:
+def _masker(slices):
+    """
+    Function masking a single record in place, as multi_mask_sequences
+    """
+    compiled = {}
+    def mask(record):
+        length = len(record)
         try:
-            record = next(i for i in r() if i.id == record_id)
-        except StopIteration:
-            raise ValueError("Record with id {0} not found.".format(record_id))
+            runs = compiled[length]
+        except KeyError:
+            runs = compiled[length] = [(start, stop, '-' * (stop - start))
+                                       for start, stop in
+                                       _mask_runs(slices, length)]
+        sequence = bytearray(str(record.seq))
+        for start, stop, gaps in runs:
+            sequence[start:stop] = gaps
+
+        # The sequence can only be replaced without per-letter annotations;
+        # its length is unchanged, so they can be restored after.
+        letter_annotations = dict(record.letter_annotations)
+        record.letter_annotations = {}
+        record.seq = Seq(str(sequence), record.seq.alphabet)
+        record.letter_annotations = letter_annotations
+        return record
+    return mask
+
+def mask_sequences_relative(records, slices, record_id, reference=None):
+    """
+    Masks records in slices, indexed by non-gap positions in record_id, as
+    for cut_sequences_relative.
+    """
+    return _relative(records, slices, record_id, reference,
+                     multi_mask_sequences)
+
+
+class _ByteStep(object):
+    """
+    A transform of sequences which maps, deletes or reverses characters, for
+    _SequenceMap.
+
+    ``table`` and ``deletechars`` are as for str.translate; with
+    ``complement``, the table is the DNA or RNA complement, chosen as by
+    Seq.complement.  ``alphabet`` maps the alphabet of the input sequence to
+    that of the output.  ``metadata`` describes the record produced: 'keep'
+    copies every attribute of the input record, as SeqRecord.upper;
+    'reverse' keeps the ID, name and description, reversing annotations, as
+    reverse_sequences; 'fresh' keeps only the ID and description.
+    ``name`` describes the step, e.g. in explain_plan.
+    """
+
+    def __init__(self, table=None, deletechars='', reverse=False,
+                 complement=False, alphabet=None, metadata='keep', name=None):
+        self.table = table
+        self.deletechars = deletechars
+        self.reverse = reverse
+        self.complement = complement
+        self.alphabet = alphabet
+        self.metadata = metadata
+        self.name = name
+
+    def __repr__(self):
+        return self.name or super(_ByteStep, self).__repr__()
+
+
+def _complement_table(mapping):
+    before = ''.join(mapping)
+    after = ''.join(mapping.values())
+    return string.maketrans(before + before.lower(), after + after.lower())
+
+_DNA_COMPLEMENT = _complement_table(IUPACData.ambiguous_dna_complement)
+_RNA_COMPLEMENT = _complement_table(IUPACData.ambiguous_rna_complement)
+
+_UPPER_STEP = _ByteStep(string.maketrans(string.ascii_lowercase,
+                                         string.ascii_uppercase),
+                        alphabet=lambda a: a._upper(), name='upper')
+_LOWER_STEP = _ByteStep(string.maketrans(string.ascii_uppercase,
+                                         string.ascii_lowercase),
+                        alphabet=lambda a: a._lower(), name='lower')
+_REVERSE_STEP = _ByteStep(reverse=True, metadata='reverse', name='reverse')
+_REVERSE_COMPLEMENT_STEP = _ByteStep(reverse=True, complement=True,
+                                     metadata='reverse',
+                                     name='reverse_complement')
+_TRANSCRIBE_STEPS = {
+    'dna2rna': _ByteStep(string.maketrans('Tt', 'Uu'),
+                         alphabet=lambda a: IUPAC.ambiguous_rna,
+                         metadata='fresh', name='dna2rna'),
+    'rna2dna': _ByteStep(string.maketrans('Uu', 'Tt'),
+                         alphabet=lambda a: IUPAC.ambiguous_dna,
+                         metadata='fresh', name='rna2dna'),
+}
+
+
+def _dashes_step(prune_chars):
+    return _ByteStep(string.maketrans(prune_chars, '-' * len(prune_chars)),
+                     name='dash_gap')
+
+
+def _ungap_step(gap_chars):
+    return _ByteStep(deletechars=gap_chars,
+                     alphabet=lambda a: Alphabet.generic_alphabet,
+                     metadata='fresh', name='ungap')
+
+
+class _SequenceMap(object):
+    """
+    A chain of _ByteSteps, composed into a single translation table, set of
+    deleted characters and reversal, so each sequence is transformed in one
+    pass.
+
+    Compositions are cached by input alphabet and by the complement table
+    chosen for each complement step, which may depend on the sequence.
+    """
+    _characters = string.maketrans('', '')
+
+    def __init__(self, steps):
+        self.steps = list(steps)
+        self._compiled = {}
+        self._complement_plans = {}
+        self._complement = any(step.complement for step in self.steps)
+        # Steps from the last which keeps only the ID and description
+        fresh = [i for i, step in enumerate(self.steps)
+                 if step.metadata == 'fresh']
+        self._metadata_steps = self.steps[fresh[-1]:] if fresh else self.steps
 
-        new_slices = _update_slices(record, slices)
-        for record in multi_mask_sequences(r(), new_slices):
-            yield record
+    def _compile(self, alphabet, complements, count):
+        """
+        Compose the first ``count`` steps, for a sequence with ``alphabet``,
+        using the tables in ``complements`` for complement steps.
+        """
+        key = alphabet, complements, count
+        try:
+            return self._compiled[key]
+        except KeyError:
+            pass
+
+        table, deletechars, reverse = self._characters, '', False
+        complements = iter(complements)
+        for step in self.steps[:count]:
+            if step.deletechars:
+                deletechars += ''.join(
+                    c for c in self._characters
+                    if table[ord(c)] in step.deletechars
+                    and c not in deletechars)
+            step_table = next(complements) if step.complement else step.table
+            if step_table is not None:
+                table = table.translate(step_table)
+            reverse ^= step.reverse
+            if step.alphabet is not None:
+                alphabet = step.alphabet(alphabet)
+
+        result = self._compiled[key] = table, deletechars, reverse, alphabet
+        return result
+
+    def _preimage(self, alphabet, complements, count, chars):
+        """
+        Characters mapped to any of ``chars`` by the first ``count`` steps
+        """
+        key = alphabet, complements, count, chars
+        try:
+            return self._compiled[key]
+        except KeyError:
+            table, deletechars, _, _ = self._compile(alphabet, complements,
+                                                     count)
+            result = self._compiled[key] = [
+                c for c in self._characters
+                if table[ord(c)] in chars and c not in deletechars]
+            return result
+
+    def _complement_plan(self, alphabet):
+        """
+        For each complement step, its index and the complement table chosen
+        by the alphabet of its input, as Seq.complement, or None if the
+        alphabet is generic, so the choice depends on the sequence.
+        """
+        plan = []
+        for i, step in enumerate(self.steps):
+            if step.complement:
+                base = Alphabet._get_base_alphabet(alphabet)
+                if isinstance(base, Alphabet.ProteinAlphabet):
+                    raise ValueError("Proteins do not have complements!")
+                elif isinstance(base, Alphabet.DNAAlphabet):
+                    plan.append((i, _DNA_COMPLEMENT))
+                elif isinstance(base, Alphabet.RNAAlphabet):
+                    plan.append((i, _RNA_COMPLEMENT))
+                else:
+                    plan.append((i, None))
+            if step.alphabet is not None:
+                alphabet = step.alphabet(alphabet)
+        return plan
+
+    def _complements(self, sequence, alphabet):
+        """
+        Choose the complement table for each complement step, as
+        Seq.complement would on the sequence produced by the steps before it.
+        """
+        try:
+            plan = self._complement_plans[alphabet]
+        except KeyError:
+            plan = self._complement_plans[alphabet] = \
+                    self._complement_plan(alphabet)
+
+        complements = ()
+        for i, complement in plan:
+            if complement is None:
+                has_u = any(c in sequence for c in self._preimage(
+                    alphabet, complements, i, 'Uu'))
+                if has_u and any(c in sequence for c in self._preimage(
+                        alphabet, complements, i, 'Tt')):
+                    raise ValueError("Mixed RNA/DNA found")
+                complement = _RNA_COMPLEMENT if has_u else _DNA_COMPLEMENT
+            complements += (complement,)
+        return complements
+
+    def _metadata(self, record):
+        """
+        Attributes of the record produced by the chain of steps
+        """
+        if self._metadata_steps is not self.steps:
+            metadata = {'id': record.id, 'description': record.description}
+        else:
+            metadata = {'id': record.id, 'name': record.name,
+                        'description': record.description,
+                        'dbxrefs': record.dbxrefs[:],
+                        'features': record.features[:],
+                        'annotations': record.annotations.copy(),
+                        'letter_annotations':
+                            record.letter_annotations.copy()}
+        length = len(record)
+        for step in self._metadata_steps:
+            if step.metadata == 'fresh':
+                metadata = {'id': metadata['id'],
+                            'description': metadata['description']}
+            elif step.metadata == 'reverse':
+                annotations = dict(
+                    (k, v[::-1] if isinstance(v, (tuple, list)) and
+                        len(v) == length else v)
+                    for k, v in metadata.get('annotations', {}).iteritems())
+                letter_annotations = dict(
+                    (k, v[::-1]) for k, v in
+                    metadata.get('letter_annotations', {}).iteritems())
+                metadata = {'id': metadata['id'],
+                            'name': metadata.get('name', '<unknown name>'),
+                            'description': metadata['description'],
+                            'annotations': annotations,
+                            'letter_annotations': letter_annotations}
+            if step.deletechars:
+                # Only 'fresh' steps delete, so there is nothing left which
+                # depends on the length.
+                length = None
+        return metadata
+
+    def __call__(self, record):
+        sequence = str(record.seq)
+        alphabet = record.seq.alphabet
+        complements = ()
+        if self._complement:
+            complements = self._complements(sequence, alphabet)
+        table, deletechars, reverse, alphabet = self._compile(
+            alphabet, complements, len(self.steps))
+        sequence = sequence.translate(table, deletechars)
+        if reverse:
+            sequence = sequence[::-1]
+        return SeqRecord(Seq(sequence, alphabet), **self._metadata(record))
+
+
+def map_sequences(records, steps):
+    """
+    Apply the chain of _ByteSteps ``steps`` to each record, in a single pass
+    over each sequence.
+    """
+    sequence_map = _SequenceMap(steps)
+    for record in records:
+        yield sequence_map(record)
 
 
 def lower_sequences(records):
@@ -282,8 +1472,7 @@ def lower_sequences(records):
     """
     logging.info('Applying _lower_sequences generator: '
                  'converting sequences to all lowercase.')
-    for record in records:
-        yield record.lower()
+    return map_sequences(records, [_LOWER_STEP])
 
 
 def upper_sequences(records):
@@ -292,8 +1481,7 @@ def upper_sequences(records):
     """
     logging.info('Applying _upper_sequences generator: '
                  'converting sequences to all uppercase.')
-    for record in records:
-        yield record.upper()
+    return map_sequences(records, [_UPPER_STEP])
 
 
 def prune_empty(records):
@@ -301,28 +1489,15 @@ def prune_empty(records):
     Remove any sequences which are entirely gaps ('-')
     """
     for record in records:
-        if not all(c == '-' for c in str(record.seq)):
+        if not _is_empty(record):
             yield record
 
 
-def _reverse_annotations(old_record, new_record):
+def _is_empty(record):
     """
-    Copy annotations form old_record to new_record, reversing any
-    lists / tuples / strings.
+    Whether the record's sequence is entirely gaps ('-')
     """
-    # Copy the annotations over
-    for k, v in old_record.annotations.items():
-        # Trim if appropriate
-        if isinstance(v, (tuple, list)) and len(v) == len(old_record):
-            assert len(v) == len(old_record)
-            v = v[::-1]
-        new_record.annotations[k] = v
-
-    # Letter annotations must be lists / tuples / strings of the same
-    # length as the sequence
-    for k, v in old_record.letter_annotations.items():
-        assert len(v) == len(old_record)
-        new_record.letter_annotations[k] = v[::-1]
+    return not str(record.seq).strip('-')
 
 
 def reverse_sequences(records):
@@ -331,14 +1506,7 @@ def reverse_sequences(records):
     """
     logging.info('Applying _reverse_sequences generator: '
                  'reversing the order of sites in sequences.')
-    for record in records:
-        rev_record = SeqRecord(record.seq[::-1], id=record.id,
-                               name=record.name,
-                               description=record.description)
-        # Copy the annotations over
-        _reverse_annotations(record, rev_record)
-
-        yield rev_record
+    return map_sequences(records, [_REVERSE_STEP])
 
 
 def reverse_complement_sequences(records):
@@ -347,14 +1515,7 @@ def reverse_complement_sequences(records):
     """
     logging.info('Applying _reverse_complement_sequences generator: '
                  'transforming sequences into reverse complements.')
-    for record in records:
-        rev_record = SeqRecord(record.seq.reverse_complement(),
-                               id=record.id, name=record.name,
-                               description=record.description)
-        # Copy the annotations over
-        _reverse_annotations(record, rev_record)
-
-        yield rev_record
+    return map_sequences(records, [_REVERSE_COMPLEMENT_STEP])
 
 
 def ungap_sequences(records, gap_chars=GAP_CHARS):
@@ -363,8 +1524,7 @@ def ungap_sequences(records, gap_chars=GAP_CHARS):
     """
     logging.info('Applying _ungap_sequences generator: '
                  'removing gaps from the alignment.')
-    for record in records:
-        yield ungap_all(record, gap_chars)
+    return map_sequences(records, [_ungap_step(gap_chars)])
 
 def ungap_all(record, gap_chars=GAP_CHARS):
     record = SeqRecord(Seq(str(record.seq).translate(None, gap_chars)),
@@ -379,8 +1539,8 @@ def _update_id(record, new_id):
     record.id = new_id
 
     # At least for FASTA, record ID starts the description
-    record.description = re.sub('^' + re.escape(old_id), new_id,
-            record.description)
+    if record.description.startswith(old_id):
+        record.description = new_id + record.description[len(old_id):]
     return record
 
 
@@ -451,23 +1611,45 @@ def name_replace(records, search_regex, replace_pattern):
     """
     regex = re.compile(search_regex)
     for record in records:
-        maybe_id = record.description.split(None, 1)[0]
-        if maybe_id == record.id:
-            record.description = regex.sub(replace_pattern, record.description)
-            record.id = record.description.split(None, 1)[0]
-        else:
-            record.id = regex.sub(replace_pattern, record.id)
-            record.description = regex.sub(replace_pattern, record.description)
-        yield record
+        yield _replace_name(record, regex, replace_pattern)
+
+
+def _replace_name(record, regex, replace_pattern):
+    """
+    Apply name_replace to a single record, in place
+    """
+    maybe_id = record.description.split(None, 1)[0]
+    if maybe_id == record.id:
+        record.description = regex.sub(replace_pattern, record.description)
+        record.id = record.description.split(None, 1)[0]
+    else:
+        record.id = regex.sub(replace_pattern, record.id)
+        record.description = regex.sub(replace_pattern, record.description)
+    return record
+
+
+# Characters with special meaning in regular expressions
+_REGEX_METACHARACTERS = re.compile(r'[\\.^$*+?{}\[\]|()]')
+
+
+def _sequence_search(pattern):
+    """
+    Function testing whether a sequence contains a match to the regular
+    expression pattern.  Patterns which are plain literals are found with
+    str.find, rather than the regex engine.
+    """
+    if not _REGEX_METACHARACTERS.search(pattern):
+        return lambda sequence: pattern in sequence
+    return re.compile(pattern).search
 
 
 def seq_include(records, filter_regex):
     """
     Filter any sequences who's seq does not match the filter. Ignore case.
     """
-    regex = re.compile(filter_regex)
+    search = _sequence_search(filter_regex)
     for record in records:
-        if regex.search(str(record.seq)):
+        if search(str(record.seq)):
             yield record
 
 
@@ -475,26 +1657,248 @@ def seq_exclude(records, filter_regex):
     """
     Filter any sequences who's seq matches the filter. Ignore case.
     """
-    regex = re.compile(filter_regex)
+    search = _sequence_search(filter_regex)
     for record in records:
-        if not regex.search(str(record.seq)):
+        if not search(str(record.seq)):
             yield record
 
-def sample(records, k):
+
+# Bases represented by each IUPAC nucleotide code accepted in motifs
+MOTIF_CODES = IUPACData.ambiguous_dna_values
+_UNAMBIGUOUS_RUNS = re.compile('[ACGT]+')
+
+
+class MotifMatcher(object):
+    """
+    Tests whether sequences contain any of a set of DNA motifs, written with
+    IUPAC codes; each code matches any of the bases it represents (e.g. R
+    matches A or G), case-sensitively.  If reverse_complement is true, motifs
+    are also matched on the reverse strand.
+
+    All motifs are found with a single regular expression search.  Before
+    that, each motif's longest run of unambiguous bases is searched for with
+    str.find: sequences containing none of these cannot match.
+    """
+
+    def __init__(self, motifs, reverse_complement=False):
+        motifs = list(motifs)
+        for motif in motifs:
+            invalid = set(motif) - set(MOTIF_CODES)
+            if not motif or invalid:
+                raise ValueError("Invalid motif: {0!r}".format(motif))
+        if reverse_complement:
+            # Rather than reverse-complementing each sequence, search for
+            # the reverse complement of each motif.
+            complement = string.maketrans(
+                ''.join(IUPACData.ambiguous_dna_complement),
+                ''.join(IUPACData.ambiguous_dna_complement.values()))
+            motifs += [m.translate(complement)[::-1] for m in motifs]
+        motifs = sorted(frozenset(motifs))
+
+        # Longest unambiguous run in each motif, if all have one
+        self.literals = []
+        for motif in motifs:
+            runs = _UNAMBIGUOUS_RUNS.findall(motif)
+            if not runs:
+                self.literals = None
+                break
+            self.literals.append(max(runs, key=len))
+
+        if self.literals is not None and self.literals == motifs:
+            # Exact matching alone suffices
+            self.regex = None
+        else:
+            self.regex = re.compile('|'.join(
+                ''.join(c if len(MOTIF_CODES[c]) == 1 else
+                        '[' + MOTIF_CODES[c] + ']' for c in motif)
+                for motif in motifs))
+
+    def __call__(self, sequence):
+        if self.literals is not None:
+            for literal in self.literals:
+                if literal in sequence:
+                    break
+            else:
+                return False
+            if self.regex is None:
+                return True
+        return self.regex.search(sequence) is not None
+
+
+def seq_motif_include(records, motifs, reverse_complement=False):
     """
-    Choose a length-``k`` subset of ``records`` using reservoir sampling.  if k < len(records),
-    all are returned.
+    Filter the records, keeping only sequences containing any of motifs.  See
+    MotifMatcher.
+    """
+    matcher = MotifMatcher(motifs, reverse_complement)
+    for record in records:
+        if matcher(str(record.seq)):
+            yield record
+
+
+def seq_motif_exclude(records, motifs, reverse_complement=False):
     """
+    Filter the records, removing sequences containing any of motifs.  See
+    MotifMatcher.
+    """
+    matcher = MotifMatcher(motifs, reverse_complement)
+    for record in records:
+        if not matcher(str(record.seq)):
+            yield record
+
+# Filters selecting records by ID, which fuse_id_selections may combine. Maps
+# each filter to whether it includes (rather than excludes) the records it
+# matches, and a function from its keyword arguments to IdSelector arguments.
+_ID_SELECTIONS = {
+    include_from_file: (True, _read_ids),
+    exclude_from_file: (False, _read_ids),
+    include_prefixes_from_file: (True,
+        lambda handle: {'prefixes': _read_lines(handle)}),
+    exclude_prefixes_from_file: (False,
+        lambda handle: {'prefixes': _read_lines(handle)}),
+    include_patterns_from_file: (True,
+        lambda handle: {'patterns': _read_lines(handle)}),
+    exclude_patterns_from_file: (False,
+        lambda handle: {'patterns': _read_lines(handle)}),
+    name_include: (True, lambda filter_regex: {'patterns': [filter_regex]}),
+    name_exclude: (False, lambda filter_regex: {'patterns': [filter_regex]}),
+}
+
+
+def fuse_id_selections(transforms):
+    """
+    Given a list of partially applied transform functions, replace each run
+    of adjacent ID selection filters with a single select_ids pass.
+
+    Records must match every include filter in a run, so each becomes its
+    own IdSelector; exclude filters are merged into one.
+    """
+    def is_selection(f):
+        return getattr(f, 'func', None) in _ID_SELECTIONS
+
     result = []
-    for i, record in enumerate(records):
-        if len(result) < k:
-            result.append(record)
-        else:
-            r = random.randint(0, i)
-            if r < k:
-                result[r] = record
+    for selection, run in itertools.groupby(transforms, is_selection):
+        run = list(run)
+        if not selection or len(run) == 1:
+            result.extend(run)
+            continue
+        includes = []
+        excludes = collections.defaultdict(list)
+        for f in run:
+            include, selector_args = _ID_SELECTIONS[f.func]
+            kwargs = selector_args(**f.keywords)
+            if include:
+                includes.append(IdSelector(**kwargs))
+            else:
+                for k, v in kwargs.items():
+                    excludes[k].extend(v)
+        exclude = IdSelector(**excludes) if excludes else None
+        result.append(functools.partial(select_ids, includes=includes,
+                                        exclude=exclude))
+    return result
+
+
+def _column_step(f):
+    """
+    Step of a _ColumnPlan equivalent to a partially applied column transform
+    """
+    if f.func == multi_cut_sequences:
+        return 'cut', f.keywords['slices']
+    elif f.func == drop_columns:
+        return 'drop', f.keywords['slices']
+    return 'squeeze', (f.keywords or {}).get('gap_threshold', 1.0)
+
+
+def fuse_column_selections(transforms):
+    """
+    Given a list of partially applied transform functions, replace each run
+    of adjacent --cut, --drop and --squeeze transforms with a single
+    select_columns pass.
+    """
+    def is_column_selection(f):
+        return getattr(f, 'func', None) in (multi_cut_sequences, drop_columns,
+                                            squeeze)
+
+    result = []
+    for selection, run in itertools.groupby(transforms, is_column_selection):
+        run = list(run)
+        if not selection or len(run) == 1:
+            result.extend(run)
+            continue
+        plan = _ColumnPlan(_column_step(f) for f in run)
+        result.append(functools.partial(select_columns, plan=plan))
     return result
 
+
+def _uniform(rng):
+    """
+    Uniform random number in (0, 1), for taking logarithms
+    """
+    u = rng.random()
+    while not u:
+        u = rng.random()
+    return u
+
+
+def sample(records, k, seed=None, keep_order=False):
+    """
+    Choose a length-``k`` subset of ``records`` using reservoir sampling.  if k < len(records),
+    all are returned.
+
+    Uses Li's Algorithm L, drawing the number of records to skip before the
+    next replacement, so only O(k log(n/k)) random numbers are needed.  With
+    ``seed``, a private generator seeded with it is used; otherwise the
+    ``random`` module.  With ``keep_order``, the sample is returned in input
+    order.
+    """
+    rng = random.Random(seed) if seed is not None else random
+    iterator = enumerate(records)
+    reservoir = list(itertools.islice(iterator, k))
+    if len(reservoir) == k and k > 0:
+        w = math.exp(math.log(_uniform(rng)) / k)
+        while True:
+            skip = 0
+            if w < 1.0:
+                skip = int(math.log(_uniform(rng)) / math.log1p(-w))
+            item = next(itertools.islice(iterator, skip, None), None)
+            if item is None:
+                break
+            reservoir[rng.randrange(k)] = item
+            w *= math.exp(math.log(_uniform(rng)) / k)
+
+    if keep_order:
+        reservoir.sort()
+    return [record for _, record in reservoir]
+
+
+def sample_fraction(records, fraction, seed=None):
+    """
+    Choose each of ``records`` independently with probability ``fraction``,
+    streaming.
+
+    The gaps between chosen records are drawn from a geometric distribution,
+    so only one random number is needed per record chosen.  ``seed`` is as for
+    ``sample``.
+    """
+    logging.info('Applying _sample_fraction generator: '
+                 'selecting a fraction %s of records.', fraction)
+    if fraction >= 1:
+        for record in records:
+            yield record
+        return
+    if fraction <= 0:
+        return
+
+    rng = random.Random(seed) if seed is not None else random
+    log_q = math.log1p(-fraction)
+    iterator = iter(records)
+    while True:
+        skip = int(math.log(_uniform(rng)) / log_q)
+        record = next(itertools.islice(iterator, skip, None), None)
+        if record is None:
+            return
+        yield record
+
 def head(records, head):
     """
     Limit results to the top N records.
@@ -539,30 +1943,154 @@ def tail(records, tail):
                 yield record
 
 # Squeeze-related
-def gap_proportion(sequences, gap_chars='-'):
+def _column_runs(columns):
     """
-    Generates a list with the proportion of gaps by index in a set of
-    sequences.
+    Convert a list of column indexes to a list of (start, stop) pairs covering
+    the runs of consecutive columns.
     """
-    aln_len = None
-    gaps = []
-    for i, sequence in enumerate(sequences):
-        if aln_len is None:
-            aln_len = len(sequence)
-            gaps = [0] * aln_len
+    runs = []
+    for column in columns:
+        if runs and runs[-1][1] == column:
+            runs[-1][1] = column + 1
         else:
-            if not len(sequence) == aln_len:
+            runs.append([column, column + 1])
+    return [tuple(run) for run in runs]
+
+
+class _AlignmentMatrix(object):
+    """
+    Alignment held as a single N x L buffer of sequence bytes, row by row,
+    with the ID and description of each row alongside.
+
+    Columns are read with strided slices of the buffer, and rows are
+    projected onto sets of columns by joining slices, so no per-character
+    Python loops are needed.  Buffers larger than ``buffer_size`` are
+    spilled to a temporary file and memory mapped.
+    """
+
+    def __init__(self, data, length, ids, descriptions, handle=None):
+        self.data = data
+        self.length = length
+        self.ids = ids
+        self.descriptions = descriptions
+        self._handle = handle
+
+    @classmethod
+    def from_records(cls, records, buffer_size=DEFAULT_BUFFER_SIZE,
+                     block_size=1 << 20):
+        """
+        Build a matrix from records, which must all be the same length.
+        """
+        length = None
+        ids, descriptions = [], []
+        data = bytearray()
+        handle = None
+        for record in records:
+            sequence = str(record.seq)
+            if length is None:
+                length = len(sequence)
+            elif len(sequence) != length:
+                if handle is not None:
+                    handle.close()
                 raise ValueError(("Unexpected sequence length {0}. Is this "
                                   "an alignment?").format(len(sequence)))
+            ids.append(record.id)
+            descriptions.append(record.description)
+            data += sequence
+            if handle is None and len(data) > buffer_size:
+                handle = tempfile.TemporaryFile()
+            if handle is not None and len(data) >= block_size:
+                handle.write(data)
+                del data[:]
+
+        if handle is not None:
+            handle.write(data)
+            handle.flush()
+            data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(data, length or 0, ids, descriptions, handle)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def close(self):
+        if self._handle is not None:
+            self.data.close()
+            self._handle.close()
+            self._handle = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def row(self, i):
+        return str(self.data[i * self.length:(i + 1) * self.length])
+
+    def column(self, j):
+        return str(self.data[j::self.length])
+
+    def count_columns(self, chars):
+        """
+        Count the occurrences of any of ``chars`` in each column
+        """
+        return [len(self) - len(self.column(j).translate(None, chars))
+                for j in xrange(self.length)]
+
+    def _join_runs(self, runs):
+        for i in xrange(len(self)):
+            offset = i * self.length
+            yield ''.join(str(self.data[offset + start:offset + stop])
+                          for start, stop in runs)
+
+    def _project(self, columns, block_rows):
+        # Copy each kept column of a block of rows at once, by strided slice
+        # assignment
+        width = len(columns)
+        for first in xrange(0, len(self), block_rows):
+            n = min(block_rows, len(self) - first)
+            block = self.data[first * self.length:(first + n) * self.length]
+            projected = bytearray(n * width)
+            for k, j in enumerate(columns):
+                projected[k::width] = block[j::self.length]
+            for i in xrange(n):
+                yield str(projected[i * width:(i + 1) * width])
+
+    def records(self, columns=None, block_size=1 << 24):
+        """
+        Generate a SeqRecord for each row, limited to the column indexes in
+        ``columns``, if given.
+
+        Rows are built by joining runs of consecutive columns or, when there
+        are many runs, by copying the columns of ~block_size bytes of rows at
+        a time, whichever takes fewer slice operations.
+        """
+        if columns is None:
+            columns = xrange(self.length)
+        runs = _column_runs(columns)
+        block_rows = max(1, block_size // max(self.length, 1))
+        if len(columns) > block_rows * len(runs):
+            rows = self._join_runs(runs)
+        else:
+            rows = self._project(columns, block_rows)
+        for sequence, record_id, description in itertools.izip(
+                rows, self.ids, self.descriptions):
+            yield SeqRecord(Seq(sequence), id=record_id,
+                            description=description)
+
+
+def gap_proportion(sequences, gap_chars='-'):
+    """
+    Generates a list with the proportion of gaps by index in a set of
+    sequences.
+    """
+    with _AlignmentMatrix.from_records(sequences) as matrix:
+        return _gap_proportion(matrix, gap_chars)
 
-        # Update any gap positions in gap list
-        for j, char in enumerate(sequence.seq):
-            if char in gap_chars:
-                gaps[j] += 1
 
-    sequence_count = float(i + 1)
-    gap_props = [i / sequence_count for i in gaps]
-    return gap_props
+def _gap_proportion(matrix, gap_chars='-'):
+    sequence_count = float(len(matrix))
+    return [i / sequence_count for i in matrix.count_columns(gap_chars)]
 
 
 def squeeze(records, gap_threshold=1.0):
@@ -571,17 +2099,11 @@ def squeeze(records, gap_threshold=1.0):
     in an alignment.  Takes a second sequence iterator for determining gap
     positions.
     """
-    with _record_buffer(records) as r:
-        gap_proportions = gap_proportion(r())
-
-        keep_columns = [g < gap_threshold for g in gap_proportions]
-
-        for record in r():
-            sequence = str(record.seq)
-            # Trim
-            squeezed = itertools.compress(sequence, keep_columns)
-            yield SeqRecord(Seq(''.join(squeezed)), id=record.id,
-                            description=record.description)
+    with _AlignmentMatrix.from_records(records) as matrix:
+        columns = [i for i, g in enumerate(_gap_proportion(matrix))
+                   if g < gap_threshold]
+        for record in matrix.records(columns):
+            yield record
 
 def strip_range(records):
     """
@@ -590,19 +2112,27 @@ def strip_range(records):
     """
     logging.info('Applying _strip_range generator: '
                  'removing /<start>-<stop> ranges from IDs')
-    # Split up and be greedy.
-    cut_regex = re.compile(r"(?P<id>.*)\/(?P<start>\d+)\-(?P<stop>\d+)")
     for record in records:
-        name = record.id
-        match = cut_regex.match(str(record.id))
-        if match:
-            sequence_id = match.group('id')
-            start = int(match.group('start'))
-            stop = int(match.group('stop'))
-            if start > 0 and start <= stop:
-                name = sequence_id
-        yield SeqRecord(record.seq, id=name,
-                        description='')
+        yield _strip_range(record)
+
+
+# Split up and be greedy.
+_RANGE = re.compile(r"(?P<id>.*)\/(?P<start>\d+)\-(?P<stop>\d+)")
+
+
+def _strip_range(record):
+    """
+    Apply strip_range to a single record
+    """
+    name = record.id
+    match = _RANGE.match(str(record.id))
+    if match:
+        sequence_id = match.group('id')
+        start = int(match.group('start'))
+        stop = int(match.group('stop'))
+        if start > 0 and start <= stop:
+            name = sequence_id
+    return _with_header(record, name, '')
 
 
 def transcribe(records, transcribe):
@@ -614,49 +2144,172 @@ def transcribe(records, transcribe):
     """
     logging.info('Applying _transcribe generator: '
                  'operation to perform is ' + transcribe + '.')
-    for record in records:
-        sequence = str(record.seq)
-        description = record.description
-        name = record.id
-        if transcribe == 'dna2rna':
-            dna = Seq(sequence, IUPAC.ambiguous_dna)
-            rna = dna.transcribe()
-            yield SeqRecord(rna, id=name, description=description)
-        elif transcribe == 'rna2dna':
-            rna = Seq(sequence, IUPAC.ambiguous_rna)
-            dna = rna.back_transcribe()
-            yield SeqRecord(dna, id=name, description=description)
+    return map_sequences(records, [_TRANSCRIBE_STEPS[transcribe]])
+
+_SEQUENCE_MAPS = {
+    dashes_cleanup: lambda prune_chars='.:?~': _dashes_step(prune_chars),
+    lower_sequences: lambda: _LOWER_STEP,
+    upper_sequences: lambda: _UPPER_STEP,
+    reverse_sequences: lambda: _REVERSE_STEP,
+    reverse_complement_sequences: lambda: _REVERSE_COMPLEMENT_STEP,
+    ungap_sequences: lambda gap_chars=GAP_CHARS: _ungap_step(gap_chars),
+    transcribe: lambda transcribe: _TRANSCRIBE_STEPS[transcribe],
+}
+
+
+def fuse_sequence_maps(transforms):
+    """
+    Given a list of partially applied transform functions, replace each run
+    of adjacent case, gap, reverse, complement and transcription transforms
+    with a single map_sequences pass.
+    """
+    def is_sequence_map(f):
+        return getattr(f, 'func', None) in _SEQUENCE_MAPS
+
+    result = []
+    for mapping, run in itertools.groupby(transforms, is_sequence_map):
+        run = list(run)
+        if not mapping or len(run) == 1:
+            result.extend(run)
+            continue
+        steps = [_SEQUENCE_MAPS[f.func](*f.args, **(f.keywords or {}))
+                 for f in run]
+        result.append(functools.partial(map_sequences, steps=steps))
+    return result
+
 
 # Translate-related functions
-class CodonWarningTable(object):
+class CodonTranslator(object):
     """
-    Translation table for codons tht prints a warning when an unknown
-    codon is requested, then returns the value passed as missing_char
+    Translates nucleotide sequences using a lookup from every codon over the
+    alphabet of ``table`` (an ambiguous Bio.Data.CodonTable) to its residue,
+    computed once up front.
+
+    Codons translate as in Bio.Seq.translate: stop codons become
+    ``stop_symbol``, ambiguous codons which may be stops become 'X', and
+    codons with characters outside the alphabet raise a TranslationError.
+    Additionally, '---' translates to '-', and other codons containing a gap
+    to ``missing_char``, with a warning the first time each is seen.
     """
 
-    def __init__(self, wrapped, missing_char='X'):
-        self.wrapped = wrapped
+    def __init__(self, table, missing_char='X', stop_symbol='*'):
+        self.table = table
         self.missing_char = missing_char
-        self.seen = set()
+        self.stop_symbol = stop_symbol
+        self.lookup = self._build_lookup()
+        if 'U' in table.nucleotide_alphabet.letters:
+            complement = IUPACData.ambiguous_rna_complement
+        else:
+            complement = IUPACData.ambiguous_dna_complement
+        self._complement = string.maketrans(''.join(complement),
+                                            ''.join(complement.values()))
+
+    def _build_lookup(self):
+        forward_table = self.table.forward_table
+        stop_codons = frozenset(self.table.stop_codons)
+        lookup = {'---': '-'}
+        for codon in itertools.product(self.table.nucleotide_alphabet.letters,
+                                       repeat=3):
+            codon = ''.join(codon)
+            try:
+                lookup[codon] = forward_table[codon]
+            except (KeyError, CodonTable.TranslationError):
+                # Stop codon, or possible stop codon (e.g. TAN)
+                lookup[codon] = (self.stop_symbol if codon in stop_codons
+                                 else 'X')
+        return lookup
+
+    def _unknown(self, codon):
+        if '-' not in codon:
+            raise CodonTable.TranslationError(
+                "Codon '%s' is invalid" % codon)
+        logging.warn("Unknown Codon: %s", codon)
+        # Only warn once per codon
+        self.lookup[codon] = self.missing_char
+        return self.missing_char
+
+    def _translate_codons(self, codons):
+        try:
+            return ''.join(map(self.lookup.__getitem__, codons))
+        except KeyError:
+            return ''.join(self.lookup.get(codon) or self._unknown(codon)
+                           for codon in codons)
 
-    def get(self, codon, missing=None):
+    def translate(self, sequence, to_stop=False):
+        """
+        Translate ``sequence``, a string, returning a string.  If
+        ``to_stop`` is true, translation stops at the first in-frame stop
+        codon.
+        """
+        sequence = sequence.upper()
+        if len(sequence) % 3:
+            warnings.warn("Partial codon, len(sequence) not a multiple of "
+                          "three. Explicitly trim the sequence or add "
+                          "trailing N before translation. This may become "
+                          "an error in future.", BiopythonWarning)
+        codons = _CODONS(sequence)
         try:
-            return self.__getitem__(codon)
+            protein = ''.join(map(self.lookup.__getitem__, codons))
         except KeyError:
-            return missing
-
-    def __getitem__(self, codon):
-        if codon == '---':
-            return '-'
-        elif '-' in codon:
-            if codon not in self.seen:
-                logging.warn("Unknown Codon: %s", codon)
-                self.seen.add(codon)
-            return self.missing_char
-        else:
-            return self.wrapped.__getitem__(codon)
+            # Gapped or invalid codon: translate codon-by-codon, so nothing
+            # past a stop is considered when to_stop is set.
+            residues = []
+            for codon in codons:
+                residue = self.lookup.get(codon) or self._unknown(codon)
+                if to_stop and residue == self.stop_symbol:
+                    break
+                residues.append(residue)
+            return ''.join(residues)
 
-def translate(records, translate):
+        if to_stop:
+            protein = protein.split(self.stop_symbol, 1)[0]
+        return protein
+
+    def translate_frames(self, sequence):
+        """
+        Translate ``sequence`` in each of the six reading frames in FRAMES.
+        Frames -1, -2 and -3 start from the first, second and third base of
+        the reverse complement.
+        """
+        sequence = sequence.upper()
+        reverse = sequence.translate(self._complement)[::-1]
+        result = []
+        for strand in (sequence, reverse):
+            # Translate every overlapping codon once; frame f is then every
+            # third residue from f.
+            residues = self._translate_codons(_OVERLAPPING_CODONS(strand))
+            result.extend(residues[f::3] for f in xrange(3))
+        return result
+
+    def longest_orf(self, sequence):
+        """
+        Find the longest open reading frame in any of the six frames of
+        ``sequence``: the longest stretch of residues without a stop.
+
+        Returns a tuple of (protein, frame, start, end), where start and end
+        are the 0-based, half-open coordinates of the ORF on ``sequence``.
+        For ties, the first ORF in FRAMES order is returned.
+        """
+        length = len(sequence)
+        best = ('', FRAMES[0], 0, 0)
+        for i, (frame, protein) in enumerate(
+                zip(FRAMES, self.translate_frames(sequence))):
+            orfs = protein.split(self.stop_symbol)
+            lengths = map(len, orfs)
+            j = max(xrange(len(orfs)), key=lengths.__getitem__)
+            if lengths[j] <= len(best[0]):
+                continue
+            # Residue offset of the ORF: preceding ORFs and stops
+            offset = sum(lengths[:j]) + j
+            start = i % 3 + 3 * offset
+            end = start + 3 * lengths[j]
+            if i >= 3:
+                start, end = length - end, length - start
+            best = (orfs[j], frame, start, end)
+        return best
+
+
+def translate(records, translate, table='Standard'):
     """
     Perform translation from generic DNA/RNA to proteins.  Bio.Seq
     does not perform back-translation because the codons would
@@ -664,30 +2317,65 @@ def translate(records, translate):
     reaching a stop codon.  translate must be one of the following:
         dna2protein
         dna2proteinstop
+        dna2sixframe
+        dna2orf
         rna2protein
         rna2proteinstop
+        rna2sixframe
+        rna2orf
+
+    sixframe yields one record per reading frame, with the frame (see FRAMES)
+    appended to the ID; orf yields the longest open reading frame (see
+    CodonTranslator.longest_orf) of each record, with its frame and 1-indexed
+    location added to the description.
+
+    table is the name or ID of an NCBI genetic code.
     """
     logging.info('Applying translation generator: '
                  'operation to perform is ' + translate + '.')
 
     to_stop = translate.endswith('stop')
 
-    source_type = translate[:3]
-    alphabet = {'dna': IUPAC.ambiguous_dna, 'rna': IUPAC.ambiguous_rna}[source_type]
+    source_type, target = translate.split('2')
 
     # Get a translation table
-    table = {'dna': CodonTable.ambiguous_dna_by_name["Standard"],
-             'rna': CodonTable.ambiguous_rna_by_name["Standard"]}[source_type]
-
-    # Handle ambiguities by replacing ambiguous codons with 'X'
-    table = copy.deepcopy(table)
-    table.forward_table = CodonWarningTable(table.forward_table)
-
-    for record in records:
-        sequence = str(record.seq)
-        seq = Seq(sequence, alphabet)
-        protein = seq.translate(table, to_stop=to_stop)
-        yield SeqRecord(protein, id=record.id, description=record.description)
+    if isinstance(table, (int, long)):
+        tables = {'dna': CodonTable.ambiguous_dna_by_id,
+                  'rna': CodonTable.ambiguous_rna_by_id}[source_type]
+    else:
+        tables = {'dna': CodonTable.ambiguous_dna_by_name,
+                  'rna': CodonTable.ambiguous_rna_by_name}[source_type]
+    table = tables[table]
+    translator = CodonTranslator(table)
+    alphabets = (table.protein_alphabet,
+                 Alphabet.HasStopCodon(table.protein_alphabet,
+                                       translator.stop_symbol))
+
+    if target == 'sixframe':
+        for record in records:
+            frames = translator.translate_frames(str(record.seq))
+            for frame, protein in zip(FRAMES, frames):
+                alphabet = alphabets[translator.stop_symbol in protein]
+                result = SeqRecord(Seq(protein, alphabet), id=record.id,
+                                   description=record.description)
+                yield _update_id(result, record.id + '_frame' + frame)
+    elif target == 'orf':
+        for record in records:
+            protein, frame, start, end = translator.longest_orf(
+                str(record.seq))
+            if not protein:
+                logging.debug('No ORF found in %s', record.id)
+                continue
+            description = '{0} frame={1} location={2}..{3}'.format(
+                record.description, frame, start + 1, end)
+            yield SeqRecord(Seq(protein, alphabets[0]), id=record.id,
+                            description=description)
+    else:
+        for record in records:
+            protein = translator.translate(str(record.seq), to_stop=to_stop)
+            alphabet = alphabets[translator.stop_symbol in protein]
+            yield SeqRecord(Seq(protein, alphabet), id=record.id,
+                            description=record.description)
 
 
 def max_length_discard(records, max_length):
@@ -729,6 +2417,864 @@ def min_ungap_length_discard(records, min_length):
             yield record
 
 
+# Record-at-a-time transforms, which fuse_record_steps may apply in a single
+# pass.  Maps each transform to its kind, the record fields it reads and
+# writes and its cost (see _RecordStep), and a function from its keyword
+# arguments to a function of a single record.  ID selections, sequence maps
+# and column selections are classified by _record_step.
+_RECORD_STEPS = {
+    first_name_capture: ('map', ('id',), ('id',), 1,
+        lambda: _first_name),
+    name_append_suffix: ('map', ('id',), ('id',), 1,
+        lambda suffix: lambda r: _update_id(r, r.id + suffix)),
+    name_insert_prefix: ('map', ('id',), ('id',), 1,
+        lambda prefix: lambda r: _update_id(r, prefix + r.id)),
+    name_replace: ('map', ('id',), ('id',), 1,
+        lambda search_regex, replace_pattern: functools.partial(
+            _replace_name, regex=re.compile(search_regex),
+            replace_pattern=replace_pattern)),
+    strip_range: ('map', ('id',), ('id',), 1, lambda: _strip_range),
+    multi_mask_sequences: ('map', ('sequence',), ('sequence',), 1, _masker),
+    max_length_discard: ('filter', ('length',), (), 1,
+        lambda max_length: lambda r: len(r) <= max_length),
+    min_length_discard: ('filter', ('length',), (), 1,
+        lambda min_length: lambda r: len(r) >= min_length),
+    min_ungap_length_discard: ('filter', ('sequence',), (), 2,
+        lambda min_length: lambda r:
+            len(str(r.seq).translate(None, GAP_CHARS)) >= min_length),
+    prune_empty: ('filter', ('sequence',), (), 2,
+        lambda: lambda r: not _is_empty(r)),
+    seq_include: ('filter', ('sequence',), (), 2,
+        lambda filter_regex: _sequence_filter(
+            _sequence_search(filter_regex))),
+    seq_exclude: ('filter', ('sequence',), (), 2,
+        lambda filter_regex: _sequence_filter(
+            _sequence_search(filter_regex), include=False)),
+    seq_motif_include: ('filter', ('sequence',), (), 3,
+        lambda motifs, reverse_complement=False: _sequence_filter(
+            MotifMatcher(motifs, reverse_complement))),
+    seq_motif_exclude: ('filter', ('sequence',), (), 3,
+        lambda motifs, reverse_complement=False: _sequence_filter(
+            MotifMatcher(motifs, reverse_complement), include=False)),
+}
+
+
+def _sequence_filter(search, include=True):
+    """
+    Function of a record testing whether search finds its sequence (or, if
+    not include, does not)
+    """
+    return lambda record: bool(search(str(record.seq))) == include
+
+
+class _RecordStep(object):
+    """
+    A partially applied transform which acts on each record independently:
+    either a 'map', returning a replacement for each record, or a 'filter',
+    returning whether each record is kept.
+
+    ``reads`` and ``writes`` are the fields of a record the transform depends
+    on and may change: 'id' (with the description), 'sequence' and 'length'.
+    ``cost`` ranks filters by the work done per record.
+    """
+
+    def __init__(self, transform, kind, reads, writes, cost, factory):
+        self.transform = transform
+        self.kind = kind
+        self.reads = frozenset(reads)
+        self.writes = frozenset(writes)
+        self.cost = cost
+        self.factory = factory
+
+    def precedes(self, other):
+        """
+        Whether this filter may be moved ahead of the step ``other``: a map
+        writing none of the fields it reads, or a filter at least as
+        expensive.
+        """
+        if other.kind == 'map':
+            return not (self.reads & other.writes)
+        return self.cost <= other.cost
+
+    def compile(self):
+        """
+        Pair of whether the step is a filter, and its function of a record
+        """
+        keywords = self.transform.keywords or {}
+        return self.kind == 'filter', self.factory(*self.transform.args,
+                                                   **keywords)
+
+
+def _record_step(f):
+    """
+    _RecordStep for the partially applied transform f, or None if it acts on
+    the stream of records as a whole.
+    """
+    func = getattr(f, 'func', None)
+    keywords = getattr(f, 'keywords', None) or {}
+    if func in _RECORD_STEPS:
+        return _RecordStep(f, *_RECORD_STEPS[func])
+    elif func in _ID_SELECTIONS:
+        include, selector_args = _ID_SELECTIONS[func]
+        def factory(**kwargs):
+            selector = IdSelector(**selector_args(**kwargs))
+            if include:
+                return _id_filter(includes=[selector])
+            return _id_filter(exclude=selector)
+        return _RecordStep(f, 'filter', ('id',), (), 1, factory)
+    elif func == select_ids:
+        return _RecordStep(f, 'filter', ('id',), (), 1, _id_filter)
+    elif func in _SEQUENCE_MAPS or func == map_sequences:
+        if func == map_sequences:
+            steps = keywords['steps']
+            factory = _SequenceMap
+        else:
+            steps = [_SEQUENCE_MAPS[func](*f.args, **keywords)]
+            factory = lambda **kwargs: _SequenceMap(steps)
+        writes = ['sequence']
+        if any(step.deletechars for step in steps):
+            writes.append('length')
+        return _RecordStep(f, 'map', ('sequence',), writes, 1, factory)
+    elif func in (multi_cut_sequences, drop_columns, select_columns):
+        if func == select_columns:
+            plan = keywords['plan']
+        else:
+            plan = _ColumnPlan([_column_step(f)])
+        if plan.squeezes:
+            return None
+        return _RecordStep(f, 'map', ('sequence',), ('sequence', 'length'),
+                           1, lambda **kwargs: functools.partial(
+                               _project_columns, plan=plan))
+    return None
+
+
+def _order_record_steps(steps):
+    """
+    Move each filter in steps ahead of the preceding steps it may run before
+    (see _RecordStep.precedes), so that records are discarded as early as
+    possible.
+    """
+    ordered = []
+    for step in steps:
+        i = len(ordered)
+        if step.kind == 'filter':
+            while i and step.precedes(ordered[i - 1]):
+                i -= 1
+            # Keep filters of equal cost in order, unless moving past them
+            # moved this filter ahead of a map
+            while i < len(ordered) and ordered[i].kind == 'filter' and \
+                    ordered[i].cost == step.cost:
+                i += 1
+        ordered.insert(i, step)
+    return ordered
+
+
+def apply_record_steps(records, steps):
+    """
+    Apply the _RecordSteps ``steps`` to each record in turn, in a single pass
+    over the records.
+    """
+    steps = tuple(step.compile() for step in steps)
+    return _apply_record_steps(records, steps)
+
+
+def _apply_record_steps(records, steps):
+    for record in records:
+        for is_filter, function in steps:
+            if is_filter:
+                if not function(record):
+                    break
+            else:
+                record = function(record)
+        else:
+            yield record
+
+
+def fuse_record_steps(transforms):
+    """
+    Given a list of partially applied transform functions, replace each run
+    of adjacent record-at-a-time maps and filters with a single
+    apply_record_steps pass, moving filters ahead of the maps they do not
+    depend on.
+    """
+    steps = [(f, _record_step(f)) for f in transforms]
+    result = []
+    for fusable, run in itertools.groupby(steps,
+                                          lambda pair: pair[1] is not None):
+        run = list(run)
+        if not fusable or len(run) == 1:
+            result.extend(f for f, _ in run)
+            continue
+        ordered = _order_record_steps([step for _, step in run])
+        result.append(functools.partial(apply_record_steps, steps=ordered))
+    return result
+
+
+def _describe_value(value):
+    """
+    Short description of a transform argument
+    """
+    if isinstance(value, file):
+        value = value.name
+    if isinstance(value, (list, tuple)):
+        text = '[{0}]'.format(', '.join(_describe_value(v) for v in value))
+    else:
+        text = repr(value)
+        if text.startswith('<'):
+            text = type(value).__name__
+    if len(text) > 40:
+        text = text[:37] + '...'
+    return text
+
+
+def _describe_transform(f):
+    """
+    Description of a partially applied transform function
+    """
+    keywords = getattr(f, 'keywords', None) or {}
+    arguments = [_describe_value(a) for a in getattr(f, 'args', ())]
+    arguments.extend('{0}={1}'.format(k, _describe_value(v))
+                     for k, v in sorted(keywords.items()))
+    name = getattr(getattr(f, 'func', f), '__name__', repr(f))
+    return '{0}({1})'.format(name, ', '.join(arguments))
+
+
+def explain_plan(transforms, reader_filters=()):
+    """
+    Describe how the list of partially applied transform functions will be
+    applied, one line per pass over the records, indenting the steps of each
+    apply_record_steps pass.  ``reader_filters`` are the _RecordSteps passed
+    to parse_filtered, if any.
+    """
+    lines = []
+    if reader_filters:
+        lines.append('reader:')
+        lines.extend('     {0:<6} {1}'.format(
+            step.kind, _describe_transform(step.transform))
+            for step in reader_filters)
+    for i, f in enumerate(transforms, 1):
+        if getattr(f, 'func', None) == apply_record_steps:
+            lines.append('{0}. record pass:'.format(i))
+            lines.extend('     {0:<6} {1}'.format(
+                step.kind, _describe_transform(step.transform))
+                for step in f.keywords['steps'])
+        else:
+            step = _record_step(f)
+            kind = step.kind if step is not None else 'stream'
+            lines.append('{0}. {1:<6} {2}'.format(
+                i, kind, _describe_transform(f)))
+    return '\n'.join(lines) + '\n'
+
+
+def pushdown_filters(transforms):
+    """
+    Split the filters which run first in the list of partially applied
+    transforms, and read only the ID, description and length of records,
+    from the rest, so they can be applied by parse_filtered.
+
+    Returns a list of _RecordSteps, and the remaining transforms.
+    """
+    transforms = list(transforms)
+    pushed = []
+    while transforms:
+        f = transforms[0]
+        if getattr(f, 'func', None) == apply_record_steps:
+            steps = f.keywords['steps']
+        else:
+            steps = [_record_step(f)]
+            if steps[0] is None:
+                break
+        # Filters commute, so any filter ahead of the first map may be
+        # applied first
+        remaining = []
+        for i, step in enumerate(steps):
+            if step.kind != 'filter':
+                remaining.extend(steps[i:])
+                break
+            if step.reads <= _READER_FIELDS:
+                pushed.append(step)
+            else:
+                remaining.append(step)
+        if len(remaining) == len(steps):
+            break
+        transforms.pop(0)
+        if remaining:
+            transforms.insert(0, functools.partial(apply_record_steps,
+                                                   steps=remaining))
+            break
+    return pushed, transforms
+
+
+# Fields of a record known to parse_filtered before the record is built
+_READER_FIELDS = frozenset(['id', 'length'])
+
+
+class _RawRecord(object):
+    """
+    The ID, description and length of a record being read by parse_filtered,
+    on which filters are evaluated before the record is built.
+    """
+    __slots__ = ('id', 'description', 'length')
+
+    def __init__(self, record_id, description, length=None):
+        self.id = record_id
+        self.description = description
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+
+def _passes(predicates, record):
+    for predicate in predicates:
+        if not predicate(record):
+            return False
+    return True
+
+
+def parse_filtered(handle, file_format, alphabet=None, filters=(),
+                   lazy=False):
+    """
+    Parse records from handle as SeqIO.parse, keeping only those passing
+    ``filters``, _RecordSteps from pushdown_filters.
+
+    FASTA and FASTQ files are read here, evaluating filters before each
+    record is built: filters on the ID and description are evaluated on the
+    header line, skipping the sequence lines of records which fail; filters
+    on the length, once the sequence lines are read.  Records in other
+    formats are filtered after parsing.
+
+    With ``lazy``, FASTA files which can be memory-mapped are read as
+    _LazyRecords, whose sequences are only decoded if accessed, unless
+    LAZY_RECORDS is false.
+    """
+    data = None
+    if lazy and LAZY_RECORDS and file_format == 'fasta':
+        data = _map_file(handle)
+    if not filters and data is None:
+        return SeqIO.parse(handle, file_format, alphabet=alphabet)
+
+    predicates = [step.compile()[1] for step in filters]
+    if file_format == 'fasta':
+        header = [p for step, p in zip(filters, predicates)
+                  if 'length' not in step.reads]
+        length = [p for step, p in zip(filters, predicates)
+                  if 'length' in step.reads]
+        alphabet = alphabet or Alphabet.single_letter_alphabet
+        if data is not None:
+            return _parse_fasta_mapped(data, handle.tell(), alphabet, header,
+                                       length)
+        return _parse_fasta(handle, alphabet, header, length)
+    elif file_format in ('fastq', 'fastq-sanger'):
+        return _parse_fastq(handle, alphabet or Alphabet.single_letter_alphabet,
+                            predicates)
+    return (record for record in SeqIO.parse(handle, file_format,
+                                             alphabet=alphabet)
+            if _passes(predicates, record))
+
+
+def _parse_fasta(handle, alphabet, header_predicates, length_predicates):
+    """
+    Records of a FASTA file, as Bio.SeqIO.FastaIO.FastaIterator, which pass
+    the header_predicates and length_predicates of a _RawRecord.
+    """
+    def record(raw, lines):
+        # As SimpleFastaParser
+        sequence = ''.join(lines).replace(' ', '').replace('\r', '')
+        raw.length = len(sequence)
+        if _passes(length_predicates, raw):
+            return SeqRecord(Seq(sequence, alphabet), id=raw.id, name=raw.id,
+                             description=raw.description)
+
+    raw, lines = None, None
+    for line in handle:
+        if line[0] == '>':
+            if lines is not None:
+                result = record(raw, lines)
+                if result is not None:
+                    yield result
+            title = line[1:].rstrip()
+            first_word = title.split(None, 1)[0] if title else ''
+            raw = _RawRecord(first_word, title)
+            # None while skipping the sequence lines of a rejected record
+            lines = [] if _passes(header_predicates, raw) else None
+        elif lines is not None:
+            lines.append(line.rstrip())
+    if lines is not None:
+        result = record(raw, lines)
+        if result is not None:
+            yield result
+
+
+# Characters of Sanger FASTQ quality strings, for scores 0 to 93
+_SANGER_QUALITY_CHARS = ''.join(chr(SANGER_SCORE_OFFSET + i)
+                                for i in xrange(94))
+
+
+def _parse_fastq(handle, alphabet, predicates):
+    """
+    Records of a Sanger FASTQ file, as Bio.SeqIO.QualityIO.FastqPhredIterator,
+    which pass the predicates of a _RawRecord.  The quality string of every
+    record is validated, but scores are only decoded for records which pass.
+    """
+    scores = dict((chr(i), i - SANGER_SCORE_OFFSET) for i in xrange(256))
+    for title, sequence, quality in FastqGeneralIterator(handle):
+        if quality.translate(None, _SANGER_QUALITY_CHARS):
+            raise ValueError("Invalid character in quality string")
+        record_id = title.split()[0]
+        if not _passes(predicates,
+                       _RawRecord(record_id, title, len(sequence))):
+            continue
+        qualities = [scores[c] for c in quality]
+        record = SeqRecord(Seq(sequence, alphabet), id=record_id,
+                           name=record_id, description=title)
+        record.letter_annotations['phred_quality'] = qualities
+        yield record
+
+
+def _map_file(handle):
+    """
+    Read-only memory map of the file open as handle, or None if it cannot be
+    mapped (e.g. a pipe, compressed or empty file).
+    """
+    if not isinstance(handle, file):
+        return None
+    try:
+        return mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    except (EnvironmentError, ValueError):
+        return None
+
+
+def _fasta_sequence(lines):
+    """
+    Sequence of the raw sequence lines of a FASTA record, as
+    SimpleFastaParser: trailing whitespace is removed from each line, and
+    spaces and carriage returns from the whole sequence.
+    """
+    if '\t' in lines or '\x0b' in lines or '\x0c' in lines:
+        lines = '\n'.join(line.rstrip() for line in lines.split('\n'))
+    return lines.translate(None, '\n\r ')
+
+
+class _LazyRecord(SeqRecord):
+    """
+    A SeqRecord read from a memory-mapped FASTA file, whose sequence lines
+    are only decoded when the sequence is first accessed.  Until then,
+    ``raw`` holds the lines as read, which VerbatimFastaWriter may copy.
+
+    Pickled (e.g. by _record_buffer) as a plain SeqRecord.
+    """
+    _lines = None
+
+    @classmethod
+    def from_lines(cls, data, start, end, alphabet, record_id, description,
+                   name=None):
+        """
+        Record with sequence lines ``data[start:end]``
+        """
+        record = cls(None, id=record_id,
+                     name=record_id if name is None else name,
+                     description=description)
+        record._lines = data, start, end
+        record._alphabet = alphabet
+        # Sized on first use, as it requires the sequence
+        record._letters = None
+        return record
+
+    @property
+    def raw(self):
+        """
+        The raw sequence lines, or None once the sequence has been accessed
+        or replaced
+        """
+        if self._lines is not None:
+            data, start, end = self._lines
+            return data[start:end]
+
+    def with_header(self, record_id, description):
+        """
+        New record with the same sequence lines, as SeqRecord(self.seq,
+        id=record_id, description=description)
+        """
+        if self._lines is None:
+            return SeqRecord(self.seq, id=record_id, description=description)
+        return _LazyRecord.from_lines(*self._lines, alphabet=self._alphabet,
+                                      record_id=record_id,
+                                      description=description,
+                                      name='<unknown name>')
+
+    def _get_seq(self):
+        if self._lines is not None:
+            self._sequence = Seq(_fasta_sequence(self.raw), self._alphabet)
+            self._lines = None
+        return self._sequence
+
+    def _set_seq(self, value):
+        self._lines = None
+        self._sequence = value
+
+    _seq = property(_get_seq, _set_seq)
+
+    def _get_letters(self):
+        if self._letters is None:
+            self._letters = _RestrictedDict(length=len(self))
+        return self._letters
+
+    def _set_letters(self, value):
+        self._letters = value
+
+    _per_letter_annotations = property(_get_letters, _set_letters)
+
+    def __reduce__(self):
+        return SeqRecord, (self.seq, self.id, self.name, self.description,
+                           self.dbxrefs, self.features, self.annotations,
+                           dict(self.letter_annotations))
+
+
+def _lazy_records_work():
+    """
+    Whether _LazyRecord works with the installed Biopython: it overrides the
+    private SeqRecord attributes holding the sequence and per-letter
+    annotations, so must still decode its sequence on first use and behave
+    as a SeqRecord after.
+    """
+    if _RestrictedDict is None:
+        return False
+    try:
+        record = _LazyRecord.from_lines('AC\nG\n', 0, 5,
+                                        Alphabet.generic_dna, 'x', 'x y')
+        if record.raw != 'AC\nG\n' or len(record) != 3:
+            return False
+        record.letter_annotations['q'] = [1, 2, 3]
+        part = record[1:]
+        return (record.raw is None and str(record.seq) == 'ACG' and
+                (record.id, record.description) == ('x', 'x y') and
+                str(part.seq) == 'CG' and
+                part.letter_annotations == {'q': [2, 3]})
+    except Exception:
+        return False
+
+
+# Whether parse_filtered may read _LazyRecords, falling back to decoding
+# every sequence if not
+LAZY_RECORDS = _lazy_records_work()
+
+
+def _parse_fasta_mapped(data, start, alphabet, header_predicates=(),
+                        length_predicates=()):
+    """
+    _LazyRecords of the FASTA file mapped as data from offset start, as
+    _parse_fasta.  Records are found by searching for header lines, so the
+    sequence lines are not read unless a record passes header_predicates
+    and there are length_predicates.
+    """
+    size = len(data)
+    # Skip any text before the first record
+    if data[start:start + 1] != '>':
+        start = data.find('\n>', start)
+        start = size if start < 0 else start + 1
+    while start < size:
+        eol = data.find('\n', start)
+        eol = size if eol < 0 else eol
+        end = data.find('\n>', eol)
+        end = size if end < 0 else end + 1
+        title = data[start + 1:eol].rstrip()
+        first_word = title.split(None, 1)[0] if title else ''
+        lines_start, start = min(eol + 1, end), end
+
+        raw = _RawRecord(first_word, title)
+        if not _passes(header_predicates, raw):
+            continue
+        record = _LazyRecord.from_lines(data, lines_start, end, alphabet,
+                                        first_word, title)
+        if length_predicates:
+            raw.length = len(record)
+            if not _passes(length_predicates, raw):
+                continue
+        yield record
+
+
+# Whitespace other than newlines
+_INLINE_WHITESPACE = re.compile('[ \t\r\x0b\x0c]')
+
+
+def _is_wrapped(lines, wrap):
+    """
+    Whether the raw FASTA sequence lines are exactly as FastaWriter would
+    write them with ``wrap``: a newline after every ``wrap`` residues and at
+    the end, and no other whitespace.
+    """
+    if not lines.endswith('\n') or _INLINE_WHITESPACE.search(lines):
+        return False
+    newlines = lines.count('\n')
+    if not wrap:
+        return newlines == 1
+    residues = len(lines) - newlines
+    return (newlines == -(-residues // wrap) and
+            not lines[wrap::wrap + 1].strip('\n'))
+
+
+class VerbatimFastaWriter(FastaIO.FastaWriter):
+    """
+    FastaWriter which copies the sequence lines of _LazyRecords whose
+    sequences were never accessed, when already wrapped as they would be
+    written, rather than decoding and rewrapping them.
+    """
+
+    def write_record(self, record):
+        lines = getattr(record, 'raw', None)
+        if (lines is None or self.record2title or
+                not _is_wrapped(lines, self.wrap)):
+            return FastaIO.FastaWriter.write_record(self, record)
+
+        self._record_written = True
+        # As FastaWriter
+        record_id = self.clean(record.id)
+        description = self.clean(record.description)
+        if description and description.split(None, 1)[0] == record_id:
+            title = description
+        elif description:
+            title = "%s %s" % (record_id, description)
+        else:
+            title = record_id
+        self.handle.write(">%s\n" % title)
+        self.handle.write(lines)
+
+
+# Bytes of a memory-mapped file scanned at a time by scan_headers
+HEADER_SCAN_BLOCK = 67108864  # 64 * 2**20
+
+# Header lines per chunk when scanning files which cannot be mapped
+_HEADER_BATCH = 65536
+
+_FASTQ_FORMATS = frozenset(['fastq', 'fastq-sanger', 'fastq-solexa',
+                            'fastq-illumina'])
+
+# First word of each header line following a newline, as record.id
+_HEADER_IDS = re.compile(r'\n[>@][^\S\n]*(\S*)')
+
+
+def _header_text(headers, descriptions=False):
+    """
+    IDs, or with descriptions the whole titles, of FASTA or FASTQ header
+    lines, one per line.
+    """
+    if not headers:
+        return ''
+    joined = '\n' + '\n'.join(map(str.rstrip, headers))
+    if descriptions:
+        # Drop the > or @ starting each line
+        return joined.replace(joined[:2], '\n')[1:] + '\n'
+    return '\n'.join(_HEADER_IDS.findall(joined)) + '\n'
+
+
+def _next_line(data, start, prefix):
+    """
+    Offset of the first line of data at or after start which begins with
+    prefix, or len(data)
+    """
+    if data[start:start + 1] == prefix and (not start or
+                                            data[start - 1] == '\n'):
+        return start
+    start = data.find('\n' + prefix, start)
+    return len(data) if start < 0 else start + 1
+
+
+def _fastq_boundary(data, start):
+    """
+    Offset of the first four-line FASTQ record of data at or after start: an
+    @ line, a sequence line, a + line and a quality line of the same length,
+    followed by another @ line or the end of the file.  Quality lines may
+    also begin with @, but are never followed two lines later by a + line.
+    """
+    size = len(data)
+    find = data.find
+    start = _next_line(data, start, '@')
+    while start < size:
+        sequence = find('\n', start) + 1
+        plus = find('\n', sequence) + 1 if sequence else 0
+        quality = find('\n', plus) + 1 if plus else 0
+        if quality:
+            end = find('\n', quality)
+            end = size if end < 0 else end
+            if (data[plus] == '+' and plus - 1 - sequence == end - quality
+                    and data[end + 1:end + 2] in ('@', '')):
+                return start
+        start = _next_line(data, start + 1, '@')
+    return size
+
+
+def _fasta_region(data, start, end, descriptions=False):
+    """
+    _header_text of the FASTA records of data starting in [start, end),
+    start being the offset of a header line
+    """
+    find = data.find
+    headers = []
+    while start < end:
+        eol = find('\n', start)
+        eol = len(data) if eol < 0 else eol
+        headers.append(data[start:eol])
+        start = find('\n>', eol)
+        if start < 0:
+            break
+        start += 1
+    return _header_text(headers, descriptions)
+
+
+def _fastq_region(data, start, end, descriptions=False):
+    """
+    _header_text of the FASTQ records in data[start:end], or None unless it
+    holds only four-line records as found by _fastq_boundary, with no
+    caption on the + line other than the title.
+    """
+    text = data[start:end]
+    lines = text.split('\n')
+    if text.endswith('\n'):
+        lines.pop()
+    if len(lines) % 4:
+        return None
+    headers, pluses = lines[0::4], lines[2::4]
+    if (map(len, lines[1::4]) != map(len, lines[3::4]) or
+            ('\n' + '\n'.join(headers)).count('\n@') != len(headers) or
+            ('\n' + '\n'.join(pluses)).count('\n+') != len(pluses)):
+        return None
+    if pluses and max(map(len, pluses)) > 1:
+        for header, plus in itertools.izip(headers, pluses):
+            plus = plus[1:].rstrip()
+            if plus and plus != header[1:].rstrip():
+                return None
+    return _header_text(headers, descriptions)
+
+
+def _line_headers(handle, fastq, descriptions=False):
+    """
+    _header_text of the records of a FASTA or FASTQ file which cannot be
+    mapped, read line by line, in chunks of _HEADER_BATCH records
+    """
+    if fastq:
+        headers = ('@' + title for title, _, _ in FastqGeneralIterator(handle))
+    else:
+        headers = (line for line in handle if line.startswith('>'))
+    while True:
+        text = _header_text(list(itertools.islice(headers, _HEADER_BATCH)),
+                            descriptions)
+        if not text:
+            break
+        yield text
+
+
+def _record_headers(records, descriptions=False):
+    """
+    IDs, or with descriptions the descriptions, of parsed records, one per
+    line, in chunks of _HEADER_BATCH records
+    """
+    attribute = operator.attrgetter('description' if descriptions else 'id')
+    while True:
+        batch = map(attribute, itertools.islice(records, _HEADER_BATCH))
+        if not batch:
+            break
+        yield '\n'.join(batch) + '\n'
+
+
+# Memory map and region scanner used by worker processes in _mapped_headers
+_worker_scan = None
+
+
+def _init_scan_worker(data, scan):
+    global _worker_scan
+    _worker_scan = functools.partial(scan, data)
+
+
+def _scan_region(bounds):
+    return _worker_scan(*bounds)
+
+
+def _mapped_headers(data, handle, fastq, descriptions=False, processes=1):
+    """
+    _header_text of the records of a FASTA or FASTQ file mapped as data,
+    from the offset of handle, a region of about HEADER_SCAN_BLOCK bytes at
+    a time.
+
+    Region boundaries are found by searching from evenly spaced offsets, so
+    regions may be scanned in ``processes`` worker processes.  FASTQ regions
+    not holding only four-line records are read from handle by
+    FastqGeneralIterator instead, as is the rest of the file.
+    """
+    size = len(data)
+    block = HEADER_SCAN_BLOCK
+    if processes > 1:
+        # At least 4 regions per process, of at least 1 MiB
+        block = min(block, max(size // (4 * processes), 1 << 20))
+    scan = functools.partial(_fastq_region if fastq else _fasta_region,
+                             descriptions=descriptions)
+    start = _next_line(data, handle.tell(), '@' if fastq else '>')
+
+    def regions(start):
+        for offset in xrange(start + block, size, block):
+            if fastq:
+                end = _fastq_boundary(data, offset)
+            else:
+                end = _next_line(data, offset, '>')
+            if end > start:
+                yield start, end
+                start = end
+        if start < size:
+            yield start, size
+
+    def results():
+        if processes <= 1:
+            for bounds in regions(start):
+                yield bounds, scan(data, *bounds)
+            return
+        pool = multiprocessing.Pool(processes, _init_scan_worker,
+                                    (data, scan))
+        # Results in file order, at most 2 per process in flight
+        pending = collections.deque()
+        try:
+            for bounds in regions(start):
+                pending.append((bounds, pool.apply_async(_scan_region,
+                                                         (bounds,))))
+                if len(pending) > 2 * processes:
+                    bounds, result = pending.popleft()
+                    yield bounds, result.get()
+            while pending:
+                bounds, result = pending.popleft()
+                yield bounds, result.get()
+            pool.close()
+        finally:
+            pool.terminate()
+
+    for (start, end), text in results():
+        if text is None:
+            handle.seek(start)
+            for text in _line_headers(handle, fastq, descriptions):
+                yield text
+            return
+        if text:
+            yield text
+
+
+def scan_headers(handle, file_format, descriptions=False, processes=1):
+    """
+    The ID of each record of handle, as SeqIO.parse, one per line, in chunks
+    of text; with ``descriptions``, the description.
+
+    FASTA and FASTQ files are scanned for header lines without building
+    records: the sequence and quality lines are checked only for the
+    structure of each record.  Files which can be memory-mapped are scanned
+    in regions, by ``processes`` processes if more than one.
+    """
+    fastq = file_format in _FASTQ_FORMATS
+    if not fastq and file_format != 'fasta':
+        return _record_headers(SeqIO.parse(handle, file_format),
+                               descriptions)
+    data = _map_file(handle)
+    if data is None:
+        return _line_headers(handle, fastq, descriptions)
+    return _mapped_headers(data, handle, fastq, descriptions, processes)
+
+
 def sort_length(source_file, source_file_type, direction=1):
     """
     Sort sequences by length. 1 is ascending (default) and 0 is descending.
@@ -749,18 +3295,9 @@ def sort_length(source_file, source_file_type, direction=1):
         ids = [seq_id for (length, seq_id) in len_and_ids]
     del len_and_ids  # free this memory
 
-    # SeqIO.index does not handle gzip instances
-    if isinstance(source_file, gzip.GzipFile):
-        tmpfile = tempfile.NamedTemporaryFile()
-        source_file.seek(0)
-        tmpfile.write(source_file.read())
-        tmpfile.seek(0)
-        source_file = tmpfile
-
-    record_index = SeqIO.index(source_file.name, source_file_type)
-
-    for seq_id in ids:
-        yield record_index[seq_id]
+    with record_index(source_file, source_file_type) as index:
+        for seq_id in ids:
+            yield index[seq_id]
 
 
 def sort_name(source_file, source_file_type, direction=1):
@@ -774,22 +3311,14 @@ def sort_name(source_file, source_file_type, direction=1):
 
     # Adapted from the Biopython tutorial example.
 
-    # Sort on id
-    ids = sorted((rec.id) for rec in SeqIO.parse(source_file,
-                                                 source_file_type))
+    # Sort on id, without decoding sequences where possible
+    ids = sorted((rec.id) for rec in parse_filtered(source_file,
+                                                    source_file_type,
+                                                    lazy=True))
 
     if direction == 0:
         ids = reversed(ids)
 
-    # SeqIO.index does not handle gzip instances
-    if isinstance(source_file, gzip.GzipFile):
-        tmpfile = tempfile.NamedTemporaryFile()
-        source_file.seek(0)
-        tmpfile.write(source_file.read())
-        tmpfile.seek(0)
-        source_file = tmpfile
-
-    record_index = SeqIO.index(source_file.name, source_file_type)
-
-    for id in ids:
-        yield record_index[id]
+    with record_index(source_file, source_file_type) as index:
+        for id in ids:
+            yield index[id]
@@ -16,7 +16,9 @@ if sys.version_info < (2, 7):
     print 'ERROR: seqmagick requires at least Python 2.7 to run.'
     sys.exit(1)
 
-requires = ['biopython>=1.58']
+# transform._LazyRecord relies on SeqRecord internals, tested with 1.58 to
+# 1.76 (see LAZY_RECORDS)
+requires = ['biopython>=1.58,<1.77']
 
 setup(name='seqmagick',
       version=version,